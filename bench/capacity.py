@@ -0,0 +1,270 @@
+import asyncio
+import json
+import os
+import random
+import shlex
+import sys
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+from bench.hdrhistogram import HdrHistogram
+from bench.results import merge_hdr_files
+from bench.telemetry import CsTelemetry, SloViolation, WINDOW_PERCENTILES
+
+# Search for the highest fixed rate whose tail latencies stay under an SLO.
+#
+# The control logic (find_capacity) only needs a measure(rate) coroutine
+# returning a Measurement, so it can run against the cluster (CsMeasure) or
+# against a simulated latency model (SimulatedSystem). It first makes sure the
+# lower bound passes, then finds a failing rate (the given upper bound, or by
+# doubling), then bisects between the highest passing and the lowest failing
+# rate until they are within `resolution` of each other or the step budget is
+# used up. Every step is kept, so the result is also the throughput-latency
+# curve of the system.
+#
+# A step is stopped early once it clearly fails: when the live windows exceed
+# abort_factor times a latency limit for abort_windows windows in a row.
+
+# percentiles: {percentile: ms}. aborted: stopped early because it clearly failed.
+Measurement = namedtuple('Measurement', ['rate', 'op_rate', 'percentiles', 'aborted', 'seconds'])
+
+class Step(namedtuple('Step', Measurement._fields + ('ok', 'reasons'))):
+    def __str__(self):
+        percentiles = " ".join(f"p{p:g}={v:.2f}" for p, v in self.percentiles.items())
+        verdict = "ok" if self.ok else f"FAIL ({'; '.join(self.reasons)})"
+        return f"{self.rate:>10.0f}/s achieved={self.op_rate:.0f}/s {percentiles} {self.seconds:.0f}s {verdict}"
+
+class SloTarget:
+    # limits_ms: {percentile: ms}. A step also fails when it achieves less than min_rate_ratio
+    # of the requested rate. hdr_tags are the tags of the HDR logs which are judged (pooled);
+    # by default the response-time ("-rt") tags of cassandra-stress, or all tags if there are none.
+    # The live windows of `tag` are used for early termination, with the limits of the
+    # percentiles the windows have (WINDOW_PERCENTILES).
+    def __init__(self, limits_ms, min_rate_ratio=0.95, hdr_tags=None, tag="total", abort_factor=3.0, abort_windows=10):
+        self.limits_ms = dict(limits_ms)
+        self.min_rate_ratio = min_rate_ratio
+        self.hdr_tags = hdr_tags
+        self.tag = tag
+        self.abort_factor = abort_factor
+        self.abort_windows = abort_windows
+
+    def violations(self, m):
+        reasons = ["aborted"] if m.aborted else []
+        for p, limit in self.limits_ms.items():
+            value = m.percentiles.get(p)
+            if value is None or value > limit:
+                reasons.append(f"p{p:g} {'missing' if value is None else f'{value:.2f}ms'} > {limit:g}ms")
+        if m.op_rate < self.min_rate_ratio * m.rate:
+            reasons.append(f"achieved {m.op_rate / m.rate:.0%} of the rate")
+        return reasons
+
+    def judge(self, m):
+        reasons = self.violations(m)
+        return Step(*m, not reasons, reasons)
+
+    def __call__(self, window):
+        # The CsTelemetry SLO for early termination.
+        limits = [(p, limit) for p, limit in self.limits_ms.items() if p in WINDOW_PERCENTILES]
+        if window.tag != self.tag or not limits:
+            return None
+        return any(window.percentiles[p] > self.abort_factor * limit for p, limit in limits)
+
+class CapacityResult(namedtuple('CapacityResult', ['best', 'steps', 'bounded'])):
+    # best: the highest passing rate (None if even the lower bound fails). bounded is False
+    # when no failing rate was found within the step budget, so the capacity may be higher.
+    @property
+    def curve(self):
+        return sorted(self.steps, key=lambda s: s.rate)
+
+    def __str__(self):
+        lines = [str(s) for s in self.curve]
+        if self.best is None:
+            lines.append("capacity: below the lowest rate")
+        else:
+            lines.append(f"capacity: {self.best:.0f}/s{'' if self.bounded else ' (or more)'} after {len(self.steps)} steps")
+        return "\n".join(lines)
+
+def quantize(rate, granularity):
+    return max(granularity, round(rate / granularity) * granularity)
+
+async def find_capacity(measure, slo, low, high=None, resolution=0.05, granularity=1000, max_steps=12, on_step=None):
+    # Rates are rounded to multiples of granularity. on_step(step) is called after every step.
+    steps = []
+
+    async def probe(rate):
+        step = slo.judge(await measure(rate))
+        steps.append(step)
+        print(f"capacity step {len(steps)}: {step}")
+        if on_step is not None:
+            on_step(step)
+        return step.ok
+
+    low = quantize(low, granularity)
+    if not await probe(low):
+        return CapacityResult(None, steps, True)
+    best, failing = low, None
+    if high is not None:
+        high = quantize(high, granularity)
+        if high > low and len(steps) < max_steps:
+            if await probe(high):
+                return CapacityResult(high, steps, False)
+            failing = high
+    else:
+        rate = low * 2
+        while len(steps) < max_steps:
+            if not await probe(rate):
+                failing = rate
+                break
+            best, rate = rate, rate * 2
+    if failing is None:
+        return CapacityResult(best, steps, False)
+    while failing - best > max(resolution * best, granularity) and len(steps) < max_steps:
+        rate = quantize((best + failing) / 2, granularity)
+        if rate <= best or rate >= failing:
+            break
+        if await probe(rate):
+            best = rate
+        else:
+            failing = rate
+    return CapacityResult(best, steps, True)
+
+def pooled_histogram(histograms, tags=None):
+    if tags is None:
+        tags = [tag for tag in histograms if tag and tag.endswith("-rt")] or list(histograms)
+    pooled = None
+    for tag in tags:
+        h = histograms.get(tag)
+        if h is None:
+            continue
+        if pooled is None:
+            pooled = HdrHistogram(h.lowest_trackable_value, h.highest_trackable_value, h.significant_digits)
+            pooled.start_time_ms, pooled.end_time_ms = h.start_time_ms, h.end_time_ms
+        pooled.add(h)
+        pooled.start_time_ms = min(pooled.start_time_ms, h.start_time_ms)
+        pooled.end_time_ms = max(pooled.end_time_ms, h.end_time_ms)
+    return pooled
+
+def measurement(rate, h, percentiles, aborted, seconds):
+    # From a histogram of latencies in ns; the achieved rate is its count over the time it covers.
+    if h is None or h.total_count == 0:
+        return Measurement(rate, 0.0, {}, aborted, seconds)
+    covered = (h.end_time_ms - h.start_time_ms) / 1000
+    values = h.values_at_percentiles(percentiles)
+    return Measurement(rate, h.total_count / covered if covered > 0 else 0.0,
+                       {p: v / 1e6 for p, v in zip(percentiles, values)}, aborted, seconds)
+
+class CsMeasure:
+    # Runs a cassandra-stress step on the deployment. cs_options is formatted with {rate}
+    # (ops/s, e.g. "-rate threads=300 fixed={rate}/s") and {hdr_file}, which must be logged to.
+    # restore: "each" restores the data and starts the cluster before every step, "once" only
+    # before the first one, so that later steps reuse warm caches, and "never" uses the running
+    # cluster as it is. The first `warmup` seconds of every step are left out of its latencies;
+    # settle is a pause between steps with warm caches, for the backlog of an overloaded step to clear.
+    def __init__(self, deployment, results_dir, cs_options, slo, server_hosts=None, cs="cassandra-stress", backup="default",
+                 restore="each", warmup=30, settle=0, store=None):
+        if restore not in ("each", "once", "never"):
+            raise ValueError(f"Unknown restore mode: {restore}")
+        if "{hdr_file}" not in cs_options:
+            raise ValueError("cs_options must log to {hdr_file}")
+        self.d = deployment
+        self.results_dir = results_dir
+        self.cs_options = cs_options
+        self.slo = slo
+        self.server_hosts = list(server_hosts or deployment.server_hosts)
+        self.cs = cs
+        self.backup = backup
+        self.restore = restore
+        self.warmup = warmup
+        self.settle = settle
+        self.store = store
+        self.steps = 0
+
+    async def __call__(self, rate):
+        self.steps += 1
+        step_id = f"{self.steps:02d}-{rate:.0f}"
+        if self.restore == "each" or (self.restore == "once" and self.steps == 1):
+            await self.d.stop_cs()
+            await self.d.restore_data(self.backup)
+            await self.d.start_cluster(self.server_hosts)
+        elif self.steps > 1 and self.settle:
+            await asyncio.sleep(self.settle)
+        remote_dir = f"capacity/{step_id}"
+        hdr_file = f"{remote_dir}/cs.hdr"
+        (await self.d.pssh(self.d.client_hosts, f"rm -rf {shlex.quote(remote_dir)} && mkdir -p {shlex.quote(remote_dir)}")).check()
+        options = self.cs_options.format(rate=f"{rate:.0f}", hdr_file=hdr_file)
+        telemetry = CsTelemetry(slo=self.slo, consecutive=self.slo.abort_windows)
+        start = time.monotonic()
+        aborted = False
+        try:
+            await self.d.cs(options, server_hosts={x: self.d.server_hosts[x] for x in self.server_hosts}, cs=self.cs, telemetry=telemetry)
+        except SloViolation as e:
+            print(f"capacity step {step_id}: stopped early: {e}")
+            aborted = True
+        seconds = time.monotonic() - start
+        hdr_dir = f"{self.results_dir}/{step_id}/hdr"
+        await self.d.collect(self.d.client_hosts, hdr_file, hdr_dir)
+        async with self.d.hdr_slots or nullcontext():
+            histograms = await asyncio.to_thread(merge_hdr_files, hdr_dir, "cs", self.warmup)
+        if self.store is not None and histograms:
+            self.store.add_run(f"{os.path.basename(os.path.normpath(self.results_dir))}/{step_id}", histograms,
+                               config={"rate": rate}, cs_options=options, metadata={"aborted": aborted})
+        return measurement(rate, pooled_histogram(histograms, self.slo.hdr_tags), list(self.slo.limits_ms), aborted, seconds)
+
+class CapacityLog:
+    # Records the steps of a search in a JSON file as they finish.
+    def __init__(self, path):
+        self.path = path
+        self.steps = []
+
+    def __call__(self, step):
+        self.steps.append(step._asdict())
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"steps": self.steps}, f, indent=1)
+        os.replace(tmp, self.path)
+
+async def search_capacity(deployment, results_dir, cs_options, slo, low, high=None, resolution=0.05, granularity=1000,
+                          max_steps=12, **kwargs):
+    # find_capacity on the deployment; the curve is recorded in {results_dir}/capacity.json.
+    os.makedirs(results_dir, exist_ok=True)
+    measure = CsMeasure(deployment, results_dir, cs_options, slo, **kwargs)
+    return await find_capacity(measure, slo, low, high, resolution, granularity, max_steps,
+                               on_step=CapacityLog(f"{results_dir}/capacity.json"))
+
+class SimulatedSystem:
+    # A latency model for exercising the search: an M/M/1-like queue whose latencies grow
+    # as 1 / (1 - utilization) and which can't go faster than its capacity. Above capacity the
+    # queue grows for the whole step, so latencies are in the order of the step duration.
+    def __init__(self, capacity, service_ms=0.5, tail=(4.0, 10.0), duration=60, noise=0.03, seed=None):
+        self.capacity = capacity
+        self.service_ms = service_ms
+        # Multipliers of the mean latency for p99 and p99.9 (an exponential tail has 4.6 and 6.9).
+        self.tail = dict(zip((99, 99.9), tail))
+        self.duration = duration
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.calls = []
+
+    async def __call__(self, rate):
+        self.calls.append(rate)
+        utilization = rate / self.capacity * (1 + self.random.gauss(0, self.noise))
+        if utilization < 1:
+            mean_ms = self.service_ms / (1 - utilization)
+            op_rate = rate
+        else:
+            mean_ms = (utilization - 1) / utilization * self.duration * 1000 / 2 + self.service_ms
+            op_rate = self.capacity
+        percentiles = {p: mean_ms * k for p, k in self.tail.items()}
+        return Measurement(rate, op_rate, percentiles, False, float(self.duration))
+
+async def main():
+    # Runs the search against the latency model: python -m bench.capacity <capacity> <p99 ms> [low] [high]
+    capacity, limit = float(sys.argv[1]), float(sys.argv[2])
+    low = float(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    high = float(sys.argv[4]) if len(sys.argv) > 4 else None
+    system = SimulatedSystem(capacity, seed=0)
+    result = await find_capacity(system, SloTarget({99: limit}), low, high)
+    print(result)
+
+if __name__ == "__main__":
+    asyncio.run(main())
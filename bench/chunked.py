@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+
+# Work-stealing loads: the key space is cut into chunks on a shared queue and
+# every worker takes the next chunk as soon as it is done with the previous one,
+# so fast clients do more of the work instead of waiting for the slowest one.
+
+class ChunksFailed(Exception):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        super().__init__(f"{len(chunks)} chunks failed: {', '.join(f'{a + 1}..{b}' for a, b in chunks[:10])}")
+
+class ChunkState:
+    # Completed chunks, persisted after each one when `path` is given, so that an
+    # interrupted load resumes where it stopped. The file is removed once everything is done.
+    def __init__(self, n_rows, chunk_size, path=None, key=None):
+        self.n_rows = n_rows
+        self.chunk_size = chunk_size
+        self.path = path
+        self.key = key
+        self.completed = set()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if (saved["n_rows"], saved["chunk_size"], saved["key"]) != (n_rows, chunk_size, key):
+                raise ValueError(f"{path} belongs to a different load; remove it to start over")
+            self.completed = set(saved["completed"])
+
+    def chunks(self):
+        return [(start, min(start + self.chunk_size, self.n_rows)) for start in range(0, self.n_rows, self.chunk_size)]
+
+    def pending(self):
+        return [chunk for chunk in self.chunks() if chunk[0] not in self.completed]
+
+    @property
+    def completed_rows(self):
+        return sum(end - start for start, end in self.chunks() if start in self.completed)
+
+    def complete(self, chunk):
+        self.completed.add(chunk[0])
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"n_rows": self.n_rows, "chunk_size": self.chunk_size, "key": self.key, "completed": sorted(self.completed)}, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+class Progress:
+    def __init__(self, total, done=0, name="populate", period=10):
+        self.total = total
+        self.done = done
+        self.name = name
+        self.period = period
+        self.start = time.monotonic()
+        self.start_done = done
+        self.last_report = None
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        return (self.done - self.start_done) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        return (self.total - self.done) / self.rate if self.rate > 0 else float("inf")
+
+    def update(self, n):
+        self.done += n
+        now = time.monotonic()
+        if self.last_report is None or now - self.last_report >= self.period or self.done == self.total:
+            self.last_report = now
+            print(self)
+
+    def __str__(self):
+        eta = time.strftime("%H:%M:%S", time.gmtime(self.eta)) if self.eta != float("inf") else "?"
+        return (f"{self.name}: {self.done}/{self.total} rows ({100 * self.done / max(self.total, 1):.1f}%), "
+                f"{self.rate:.0f} rows/s, ETA {eta}")
+
+async def run_chunks(state, hosts, load_chunk, concurrency=1, retries=2):
+    # load_chunk(host, (start, end)) loads rows start+1..end and returns (stdout, stderr, returncode).
+    # A failed chunk goes back on the queue up to `retries` times; a host whose
+    # loads keep failing stops taking chunks.
+    queue = deque(state.pending())
+    progress = Progress(state.n_rows, state.completed_rows)
+    attempts = {}
+    failed = []
+
+    in_flight = 0
+    changed = asyncio.Condition()
+
+    async def worker(host):
+        nonlocal in_flight
+        consecutive_failures = 0
+        while consecutive_failures <= retries:
+            async with changed:
+                # A chunk in flight elsewhere may still fail and come back to the queue.
+                await changed.wait_for(lambda: queue or not in_flight)
+                if not queue:
+                    return
+                chunk = queue.popleft()
+                in_flight += 1
+            try:
+                _, stderr, returncode = await load_chunk(host, chunk)
+                if returncode == 0:
+                    consecutive_failures = 0
+                    state.complete(chunk)
+                    progress.update(chunk[1] - chunk[0])
+                    continue
+                consecutive_failures += 1
+                attempts[chunk] = attempts.get(chunk, 0) + 1
+                tail = (stderr or b"").decode("utf-8", errors="replace").strip().splitlines()[-3:]
+                print(f"{host}: rows {chunk[0] + 1}..{chunk[1]} failed with exit code {returncode} (attempt {attempts[chunk]})", *tail, sep="\n    ")
+                if attempts[chunk] <= retries:
+                    queue.append(chunk)
+                else:
+                    failed.append(chunk)
+            finally:
+                async with changed:
+                    in_flight -= 1
+                    changed.notify_all()
+
+    await asyncio.gather(*(worker(host) for host in hosts for _ in range(concurrency)))
+    failed.extend(queue)
+    if failed:
+        raise ChunksFailed(sorted(failed))
+    state.remove()
+    return progress
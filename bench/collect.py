@@ -0,0 +1,189 @@
+import asyncio
+import os
+import shlex
+import time
+from collections import namedtuple
+from bench import tracing
+from bench.transport import _drain
+
+# Collection of files from the hosts as one compressed tar stream per host,
+# extracted locally while it arrives: no staging copies on the nodes and no
+# per-file round trips like with rsync. Streams are zstd-compressed (all cores)
+# where the host has zstd and gzip-compressed otherwise; the local side tells
+# them apart by their magic bytes. All streams of a collection share one
+# bandwidth limit.
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_MAGIC = b"\x1f\x8b"
+CHUNK = 1 << 16
+
+class CollectResult(namedtuple('CollectResult', ['host', 'files', 'compressed_bytes', 'seconds', 'compression', 'truncated'])):
+    @property
+    def throughput(self):
+        return self.compressed_bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        truncated = ", truncated" if self.truncated else ""
+        return (f"{self.host}: {self.files} files, {self.compressed_bytes / 2**20:.1f} MiB {self.compression} "
+                f"in {self.seconds:.1f}s ({self.throughput / 2**20:.1f} MiB/s{truncated})")
+
+class CollectError(Exception):
+    def __init__(self, host, message):
+        self.host = host
+        super().__init__(f"{host}: {message}")
+
+class RateLimiter:
+    # Token bucket shared by all streams, in bytes per second. Waiters are served in order.
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate / 10, CHUNK)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, n):
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+def find_command(include=(), exclude=(), max_file_size=None):
+    # Patterns are matched against paths relative to the root, like fnmatch ('*' also matches '/').
+    command = "find . \\( -type f -o -type l \\)"
+    if include:
+        command += " \\( " + " -o ".join(f"-path {shlex.quote('./' + p)}" for p in include) + " \\)"
+    for p in exclude:
+        command += f" ! -path {shlex.quote('./' + p)}"
+    if max_file_size is not None:
+        command += f" -size -{int(max_file_size) + 1}c"
+    return f"{command} -print0"
+
+def archive_command(root, include=(), exclude=(), max_file_size=None, sudo=False, level=3):
+    script = (f"cd {shlex.quote(root)} && {find_command(include, exclude, max_file_size)}"
+              f" | tar --null --no-recursion -T - -cf -"
+              f" | if command -v zstd >/dev/null; then zstd -q -T0 -{level} -c; else gzip -{min(level, 9)} -c; fi")
+    # Without pipefail: files which vanish or change while tar reads them (tar exits with 1)
+    # shouldn't fail the whole collection. Such warnings are printed from stderr.
+    return f"{'sudo ' if sudo else ''}bash -c {shlex.quote(script)}"
+
+async def collect_archive(transport, host, root, dest_dir, include=(), exclude=(), max_file_size=None, max_bytes=None,
+                          sudo=False, limiter=None, level=3):
+    # Files under root on the host end up under dest_dir. With max_bytes, the stream is cut off
+    # after that many compressed bytes, keeping the files which arrived completely.
+    os.makedirs(dest_dir, exist_ok=True)
+    command = archive_command(root, include, exclude, max_file_size, sudo, level)
+    start = time.monotonic()
+    received = 0
+    truncated = False
+    compression = None
+    extract = None
+    files = 0
+    ok = False
+
+    async def count_files(reader):
+        nonlocal files
+        while await reader.readline():
+            files += 1
+
+    async with transport.session(host):
+        channel = await transport.open(host, command)
+        channel.close_stdin()
+        stderr = asyncio.create_task(channel.stderr.read())
+        counting = None
+        try:
+            head = await channel.stdout.readexactly(len(ZSTD_MAGIC))
+        except asyncio.IncompleteReadError as e:
+            head = e.partial
+        try:
+            if head:
+                if head.startswith(ZSTD_MAGIC):
+                    compression, decompress = "zstd", ["-I", "zstd -d"]
+                elif head.startswith(GZIP_MAGIC):
+                    compression, decompress = "gzip", ["-z"]
+                else:
+                    raise CollectError(host, f"unknown stream format {head!r}")
+                extract = await asyncio.create_subprocess_exec("tar", "-x", "-v", *decompress, "-f", "-", "-C", dest_dir,
+                                                               stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                               stderr=asyncio.subprocess.PIPE)
+                extract_stderr = asyncio.create_task(extract.stderr.read())
+                counting = asyncio.create_task(count_files(extract.stdout))
+                chunk = head
+                while chunk:
+                    if max_bytes is not None and received + len(chunk) > max_bytes:
+                        truncated = True
+                        break
+                    if limiter is not None:
+                        await limiter.acquire(len(chunk))
+                    extract.stdin.write(chunk)
+                    await extract.stdin.drain()
+                    received += len(chunk)
+                    chunk = await channel.stdout.read(CHUNK)
+                extract.stdin.close()
+            if truncated:
+                channel.terminate()
+                returncode, _ = await asyncio.gather(channel.wait(), _drain(channel.stdout, asyncio.subprocess.DEVNULL, None))
+            else:
+                returncode = await channel.wait()
+            if extract is not None:
+                extract_returncode = await extract.wait()
+                await counting
+            if not truncated:
+                messages = (await stderr).decode(errors='replace').strip()
+                if returncode != 0:
+                    raise CollectError(host, f"archiving failed with exit code {returncode}: {messages}")
+                if extract is not None and extract_returncode != 0:
+                    raise CollectError(host, f"extraction failed with exit code {extract_returncode}: "
+                                             f"{(await extract_stderr).decode(errors='replace').strip()}")
+                if messages:
+                    print(f"{host}: {messages}")
+            ok = True
+        finally:
+            if extract is not None and extract.returncode is None:
+                extract.kill()
+                await extract.wait()
+            if counting is not None:
+                counting.cancel()
+            channel.terminate()
+            stderr.cancel()
+            end = time.monotonic()
+            transport.stats[host].record(start, end, 0 if ok else 1, 0, received)
+            if tracing.enabled():
+                tracing.record(f"collect {root}", "ssh", host, start, end, command=tracing.short_command(command, 500),
+                               returncode=0 if ok else 1, bytes_out=received, files=files)
+    return CollectResult(host, files, received, time.monotonic() - start, compression, truncated)
+
+async def collect_archives(transport, hosts, root, dest_dir, bandwidth=None, report=True, **kwargs):
+    # Collects root from every host into dest_dir/{host}/. bandwidth caps the total over all hosts, in bytes per second.
+    limiter = RateLimiter(bandwidth) if bandwidth else None
+    results = await asyncio.gather(*(collect_archive(transport, host, root, f"{dest_dir}/{host}", limiter=limiter, **kwargs) for host in hosts))
+    if report:
+        for r in results:
+            print(r)
+        seconds = max((r.seconds for r in results), default=0.0)
+        total = sum(r.compressed_bytes for r in results)
+        print(f"collected {total / 2**20:.1f} MiB from {len(results)} hosts in {seconds:.1f}s ({total / 2**20 / max(seconds, 1e-9):.1f} MiB/s)")
+    return {r.host: r for r in results}
+
+async def main():
+    # Local test bed: every subdirectory of `root` is a host, as with LocalTransport(root).
+    import argparse
+    from bench.transport import LocalTransport
+    parser = argparse.ArgumentParser(description="Collect a directory from LocalTransport hosts as compressed streams")
+    parser.add_argument("root", help="directory with one subdirectory per host")
+    parser.add_argument("src", help="directory to collect, relative to each host's directory")
+    parser.add_argument("dest_dir")
+    parser.add_argument("--include", action="append", default=[])
+    parser.add_argument("--exclude", action="append", default=[])
+    parser.add_argument("--max-file-size", type=int, default=None)
+    parser.add_argument("--max-bytes", type=int, default=None)
+    parser.add_argument("--bandwidth", type=float, default=None, help="total bytes per second")
+    args = parser.parse_args()
+    hosts = sorted(h for h in os.listdir(args.root) if os.path.isdir(os.path.join(args.root, h)))
+    await collect_archives(LocalTransport(args.root), hosts, args.src, args.dest_dir, bandwidth=args.bandwidth,
+                           include=args.include, exclude=args.exclude, max_file_size=args.max_file_size, max_bytes=args.max_bytes)
+
+if __name__ == "__main__":
+    asyncio.run(main())
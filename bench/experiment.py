@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import shlex
+import time
+import traceback
+from collections import namedtuple
+from contextlib import nullcontext
+from bench.hdr import process_hdr_file_set
+from bench.results import merge_hdr_files, summarize
+from bench.saturation import ClientSampler
+
+# Parameter sweeps over a Deployment. Every run restores the data, configures
+# scylla.yaml with the run's options, starts the cluster and runs the load.
+# Only those steps need the cluster to itself: collecting the run's files and
+# metrics and processing its HDR logs happen in the background, while the next
+# run is already restoring and starting up.
+#
+# Progress is checkpointed in {results_dir}/experiment.json. A sweep which is
+# started again skips the finished runs, and for runs whose load finished but
+# whose results weren't collected yet, only redoes the collection.
+#
+# With a ResultStore, the merged histograms and summaries of the runs are also
+# recorded there, along with their scylla.yaml options and cs options.
+#
+# With sample_clients, the clients are sampled during every load and runs in
+# which a client was the bottleneck are marked client_bound in the checkpoint.
+
+Run = namedtuple('Run', ['id', 'scylla_yaml', 'cs'])
+
+def run_id(scylla_yaml, cs):
+    # Stable across reorderings and extensions of the matrix, so a checkpoint stays valid.
+    params = json.dumps({"scylla_yaml": scylla_yaml, "cs": cs}, sort_keys=True)
+    return hashlib.blake2b(params.encode(), digest_size=5).hexdigest()
+
+def product(axes):
+    # {"a": [1, 2], "b": [3]} -> [{"a": 1, "b": 3}, {"a": 2, "b": 3}]
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*(axes[n] for n in names))]
+
+def expand_matrix(scylla_yaml=None, cs=None):
+    # scylla_yaml: scylla.yaml option -> values, passed to configure_scylla_yaml(extra_opts).
+    # cs: template parameter -> values, substituted into the cs options template.
+    return [Run(run_id(y, c), y, c) for y in product(scylla_yaml or {}) for c in product(cs or {})]
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.runs = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.runs = json.load(f)["runs"]
+
+    def get(self, run):
+        return self.runs.get(run.id, {})
+
+    def update(self, run, **fields):
+        entry = self.runs.setdefault(run.id, {"scylla_yaml": run.scylla_yaml, "cs": run.cs})
+        entry.update(fields)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"runs": self.runs}, f, indent=1)
+        os.replace(tmp, self.path)
+
+class Experiment:
+    # cs_options is a template for the options of Deployment.cs, formatted with the run's cs
+    # parameters and {hdr_file}, a log path unique to the run. Runs whose options don't log
+    # to {hdr_file} get no latency summary.
+    #
+    # backlog bounds how many finished runs may be waiting for collection at a time;
+    # the next load only starts when there is room.
+    def __init__(self, deployment, results_dir, cs_options, runs, server_hosts=None, cs="cassandra-stress", backup="default",
+                 traces=False, backlog=1, hdr_engine="native", store=None, sample_clients=False):
+        self.d = deployment
+        self.results_dir = results_dir
+        self.cs_options = cs_options
+        self.runs = runs
+        self.server_hosts = list(server_hosts or deployment.server_hosts)
+        self.cs = cs
+        self.backup = backup
+        self.traces = traces
+        self.backlog = asyncio.Semaphore(backlog)
+        self.hdr_engine = hdr_engine
+        self.store = store
+        self.sample_clients = sample_clients
+        os.makedirs(results_dir, exist_ok=True)
+        self.checkpoint = Checkpoint(f"{results_dir}/experiment.json")
+        # Snapshots of the same Prometheus, so downloads into the shared directory take turns.
+        self.metrics_lock = asyncio.Lock()
+
+    def run_dir(self, run):
+        return f"{self.results_dir}/{run.id}"
+
+    def remote_dir(self, run):
+        return f"experiments/{run.id}"
+
+    def trace_dir(self, run):
+        return f"/var/lib/scylla/backup/experiments/{run.id}/traces"
+
+    def hdr_file(self, run):
+        return f"{self.remote_dir(run)}/cs.hdr"
+
+    def options(self, run):
+        return self.cs_options.format(hdr_file=self.hdr_file(run), **run.cs)
+
+    async def prepare(self, run):
+        await self.d.stop_cs()
+        await self.d.restore_data(self.backup)
+        await self.d.configure_scylla_yaml(run.scylla_yaml)
+        await self.d.start_cluster(self.server_hosts)
+
+    async def load(self, run):
+        (await self.d.pssh(self.d.client_hosts, f"mkdir -p {shlex.quote(self.remote_dir(run))}")).check()
+        sampler = ClientSampler(self.d, dest_dir=f"{self.run_dir(run)}/saturation") if self.sample_clients else None
+        start = time.time()
+        result = await self.d.cs(self.options(run), server_hosts={x: self.d.server_hosts[x] for x in self.server_hosts}, cs=self.cs,
+                                 saturation=sampler)
+        end = time.time()
+        if self.traces:
+            # The next restore_data wipes /var/lib/scylla/traces, so the traces are moved (renamed,
+            # not copied) under /var/lib/scylla/backup, which restore_data leaves alone, and
+            # streamed from there later.
+            traces = shlex.quote(self.trace_dir(run))
+            (await self.d.pssh(self.server_hosts, f"""
+                bash <<EOF
+                curl -s -X POST 127.0.0.1:10000/system/dump_trace
+                sudo mkdir -p {traces}
+                sudo find /var/lib/scylla/traces -mindepth 1 -maxdepth 1 -exec mv -t {traces} {{}} +
+                \nEOF""")).check()
+        window = {"start": start, "end": end, "failed_clients": [r.host for r in result.failed]}
+        if sampler is not None:
+            window["client_bound"] = {host: v.reasons for host, v in sampler.report.verdicts.items() if v.client_bound}
+        return window
+
+    async def collect(self, run):
+        run_dir = self.run_dir(run)
+        tasks = [self.d.collect(self.d.client_hosts, self.hdr_file(run), f"{run_dir}/hdr")]
+        if self.traces:
+            tasks.append(self.d.collect_archive(self.server_hosts, self.trace_dir(run), f"{run_dir}/traces", sudo=True))
+        await asyncio.gather(*tasks)
+        if self.traces:
+            (await self.d.pssh(self.server_hosts, f"sudo rm -rf {shlex.quote(os.path.dirname(self.trace_dir(run)))}")).check()
+
+    async def download_metrics(self):
+        async with self.metrics_lock:
+            await self.d.download_metrics(f"{self.results_dir}/metrics")
+
+    async def analyze(self, run):
+        hdr_dir = f"{self.run_dir(run)}/hdr"
+        if "{hdr_file}" not in self.cs_options or not os.path.isdir(hdr_dir):
+            return None
+        if self.store is None:
+            summary = await process_hdr_file_set(hdr_dir, "cs", engine=self.hdr_engine, slots=self.d.hdr_slots)
+        else:
+            async with self.d.hdr_slots or nullcontext():
+                histograms = await asyncio.to_thread(merge_hdr_files, hdr_dir, "cs")
+            summary = summarize(histograms)
+            entry = self.checkpoint.get(run)
+            self.store.add_run(f"{os.path.basename(os.path.normpath(self.results_dir))}/{run.id}", histograms, summary,
+                               config=run.scylla_yaml, cs_options=self.options(run),
+                               metadata={"cs": run.cs, "start": entry.get("start"), "end": entry.get("end"),
+                                         "client_bound": entry.get("client_bound")})
+        return {tag: r._asdict() for tag, r in summary.items()}
+
+    async def collect_and_analyze(self, run):
+        await self.collect(run)
+        return await self.analyze(run)
+
+    async def finish(self, run):
+        try:
+            _, summary = await asyncio.gather(self.download_metrics(), self.collect_and_analyze(run))
+            self.checkpoint.update(run, status="done", summary=summary, error=None)
+            print(f"experiment {run.id}: done")
+        except Exception as e:
+            # Stays "loaded", so that a rerun only retries the collection.
+            self.checkpoint.update(run, error=f"collection: {e!r}")
+            print(f"experiment {run.id}: collection failed", traceback.format_exc(), sep="\n")
+        finally:
+            self.backlog.release()
+
+    async def finish_in_background(self, run, finishing):
+        await self.backlog.acquire()
+        finishing.append(asyncio.create_task(self.finish(run)))
+
+    async def sweep(self):
+        # Returns the checkpoint entries of all runs.
+        finishing = []
+        try:
+            for run in self.runs:
+                if self.checkpoint.get(run).get("status") == "loaded":
+                    await self.finish_in_background(run, finishing)
+            for i, run in enumerate(self.runs):
+                if self.checkpoint.get(run).get("status") in ("loaded", "done"):
+                    continue
+                print(f"experiment {run.id} ({i + 1}/{len(self.runs)}): scylla.yaml {run.scylla_yaml}, cs {run.cs}")
+                try:
+                    await self.prepare(run)
+                    # Runs of which the results are still being collected use the monitor and
+                    # the clients' disks, so the load waits for room in the backlog.
+                    await self.backlog.acquire()
+                    self.backlog.release()
+                    window = await self.load(run)
+                except Exception as e:
+                    self.checkpoint.update(run, status="failed", error=repr(e))
+                    print(f"experiment {run.id}: failed", traceback.format_exc(), sep="\n")
+                    continue
+                self.checkpoint.update(run, status="loaded", error=None, **window)
+                await self.finish_in_background(run, finishing)
+        finally:
+            await asyncio.gather(*finishing)
+        return {run.id: self.checkpoint.get(run) for run in self.runs}
@@ -0,0 +1,135 @@
+import asyncio
+import math
+import time
+from collections import namedtuple
+
+BEST_EFFORT = "best-effort"
+FAIL_FAST = "fail-fast"
+
+class HostResult(namedtuple('HostResult', ['host', 'returncode', 'stdout', 'stderr', 'start', 'end', 'timed_out', 'error'])):
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def ok(self, ok_codes=(0,)):
+        return not self.timed_out and self.error is None and self.returncode in ok_codes
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return math.nan
+    k = (len(values) - 1) * p / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+class FanoutError(Exception):
+    def __init__(self, result):
+        self.result = result
+        super().__init__(result.report())
+
+class FanoutResult:
+    def __init__(self, results, ok_codes=(0,)):
+        self.results = results
+        self.ok_codes = ok_codes
+
+    def __getitem__(self, host):
+        return self.results[host]
+
+    def __iter__(self):
+        return iter(self.results.values())
+
+    @property
+    def failed(self):
+        return [r for r in self.results.values() if not r.ok(self.ok_codes)]
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    @property
+    def wall_time(self):
+        if not self.results:
+            return 0.0
+        return max(r.end for r in self.results.values()) - min(r.start for r in self.results.values())
+
+    def stragglers(self, p=90, factor=1.5):
+        # Hosts slower than `factor` times the p-th percentile of the other hosts.
+        # Hosts cancelled by a fail-fast policy did not run to completion and are left out.
+        durations = {r.host: r.duration for r in self.results.values() if not isinstance(r.error, asyncio.CancelledError)}
+        if len(durations) < 3:
+            return []
+        slow = []
+        for host, duration in durations.items():
+            peers = [d for h, d in durations.items() if h != host]
+            if duration > factor * percentile(peers, p):
+                slow.append(self.results[host])
+        return sorted(slow, key=lambda r: -r.duration)
+
+    def check(self):
+        if self.failed:
+            raise FanoutError(self)
+        return self
+
+    def report(self, p=90, factor=1.5):
+        lines = [f"{len(self.results) - len(self.failed)}/{len(self.results)} hosts ok in {self.wall_time:.1f}s"]
+        for r in self.failed:
+            if r.timed_out:
+                reason = "timed out"
+            elif r.error is not None:
+                reason = f"error: {r.error!r}"
+            else:
+                reason = f"exit code {r.returncode}"
+            lines.append(f"  {r.host}: {reason} after {r.duration:.1f}s")
+            tail = (r.stderr or b"").decode("utf-8", errors="replace").strip().splitlines()[-5:]
+            lines.extend(f"    {line}" for line in tail)
+        for r in self.stragglers(p, factor):
+            peers = [x.duration for x in self.results.values() if x.host != r.host and not isinstance(x.error, asyncio.CancelledError)]
+            lines.append(f"  straggler {r.host}: {r.duration:.1f}s (p{p} of peers: {percentile(peers, p):.1f}s)")
+        return "\n".join(lines)
+
+async def fanout(hosts, fn, limit=None, timeout=None, policy=BEST_EFFORT, ok_codes=(0,)):
+    semaphore = asyncio.Semaphore(limit) if limit else None
+    results = {}
+
+    async def run_one(host):
+        start = time.time()
+        stdout = stderr = returncode = error = None
+        timed_out = False
+        try:
+            stdout, stderr, returncode = await asyncio.wait_for(fn(host), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+        except (asyncio.CancelledError, Exception) as e:
+            error = e
+        results[host] = HostResult(host, returncode, stdout, stderr, start, time.time(), timed_out, error)
+        return results[host]
+
+    async def one(host):
+        if semaphore is None:
+            return await run_one(host)
+        async with semaphore:
+            return await run_one(host)
+
+    tasks = {asyncio.create_task(one(host)): host for host in hosts}
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if policy == FAIL_FAST and any(t.cancelled() or not t.result().ok(ok_codes) for t in done):
+                for t in pending:
+                    t.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                break
+    except asyncio.CancelledError:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    now = time.time()
+    for host in tasks.values():
+        # Hosts cancelled while still waiting for a concurrency slot never started.
+        results.setdefault(host, HostResult(host, None, None, None, now, now, False, asyncio.CancelledError()))
+    result = FanoutResult({host: results[host] for host in tasks.values()}, ok_codes)
+    if policy == FAIL_FAST:
+        result.check()
+    return result
@@ -0,0 +1,209 @@
+import asyncio
+import itertools
+import os
+import time
+import traceback
+from collections import Counter, deque, namedtuple
+
+# Several deployments driven from one event loop. Run separately, every script
+# has its own unbounded fan-outs of ssh and rsync processes and its own HDR
+# processing pool, and side by side they exhaust local file descriptors and CPU.
+# A Fleet gives all its deployments shares of global budgets instead:
+#
+#     ssh    concurrent commands over the transports (long-lived streams, which
+#            often wait for other commands to finish, are left out)
+#     rsync  concurrent rsync transfers
+#     hdr    concurrent HDR processing jobs (threads or java processes)
+#
+# A freed slot goes to the waiting deployment which holds the fewest slots of
+# that budget, and among those to the one served least recently, so one
+# deployment fanning out over many hosts can't starve the others. Every
+# `progress_interval` seconds, one table shows what each deployment holds and
+# waits for.
+#
+#     fleet = Fleet(FleetLimits(ssh=32))
+#     for name in names:
+#         fleet.add(Deployment(name), job)    # async def job(deployment): ...
+#     results = await fleet.run()
+
+FleetLimits = namedtuple('FleetLimits', ['ssh', 'rsync', 'hdr'], defaults=[64, 8, len(os.sched_getaffinity(0))])
+
+class FairBudget:
+    # At most `limit` slots held at once (unlimited with None), shared by owners.
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.in_use = 0
+        self.held = Counter()
+        self.granted = Counter()
+        self.wait_time = Counter()
+        self.waiting = {}
+        self.last_served = {}
+        self.serial = itertools.count()
+
+    def share(self, owner):
+        return BudgetShare(self, owner)
+
+    def waiters(self, owner):
+        return len(self.waiting.get(owner, ()))
+
+    def _grant(self, owner):
+        self.in_use += 1
+        self.held[owner] += 1
+        self.granted[owner] += 1
+        self.last_served[owner] = next(self.serial)
+
+    async def acquire(self, owner):
+        if not self.waiting and (self.limit is None or self.in_use < self.limit):
+            self._grant(owner)
+            return
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(owner, deque()).append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the waiter was cancelled.
+                self.release(owner)
+            else:
+                self._forget(owner, future)
+            raise
+        finally:
+            self.wait_time[owner] += time.monotonic() - start
+
+    def _forget(self, owner, future):
+        queue = self.waiting.get(owner)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self.waiting[owner]
+
+    def release(self, owner):
+        self.in_use -= 1
+        self.held[owner] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.waiting and (self.limit is None or self.in_use < self.limit):
+            owner = min(self.waiting, key=lambda o: (self.held[o], self.last_served.get(o, -1)))
+            queue = self.waiting[owner]
+            future = queue.popleft()
+            if not queue:
+                del self.waiting[owner]
+            if not future.done():
+                self._grant(owner)
+                future.set_result(None)
+
+    def __str__(self):
+        limit = "∞" if self.limit is None else self.limit
+        return f"{self.name} {self.in_use}/{limit} waiting {sum(len(q) for q in self.waiting.values())}"
+
+class BudgetShare:
+    # An owner's async context manager for one slot of a budget. Like a semaphore, it can be
+    # entered by many tasks at once, so it stands in for one (Transport.slots, Deployment.rsync_slots...).
+    def __init__(self, budget, owner):
+        self.budget = budget
+        self.owner = owner
+
+    async def __aenter__(self):
+        await self.budget.acquire(self.owner)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.budget.release(self.owner)
+        return False
+
+class Member:
+    def __init__(self, deployment, job):
+        self.deployment = deployment
+        self.job = job
+        self.state = "pending"
+        self.phase = ""
+        self.start = None
+        self.end = None
+        self.result = None
+        self.error = None
+
+    @property
+    def commands(self):
+        stats = self.deployment.transport.stats.values()
+        return sum(s.commands for s in stats), sum(s.failures for s in stats)
+
+class Fleet:
+    def __init__(self, limits=FleetLimits(), progress_interval=10):
+        self.budgets = {kind: FairBudget(kind, limit) for kind, limit in limits._asdict().items()}
+        self.progress_interval = progress_interval
+        self.members = {}
+        self.start = None
+
+    def add(self, deployment, job):
+        # job(deployment) is a coroutine function. The fleet closes the deployment after it.
+        if deployment.name in self.members:
+            raise ValueError(f"Deployment {deployment.name} is already in the fleet")
+        deployment.transport.slots = self.budgets["ssh"].share(deployment.name)
+        deployment.rsync_slots = self.budgets["rsync"].share(deployment.name)
+        deployment.hdr_slots = self.budgets["hdr"].share(deployment.name)
+        self.members[deployment.name] = Member(deployment, job)
+
+    def set_phase(self, deployment, phase):
+        # What the deployment is doing, for the progress table.
+        self.members[deployment.name].phase = phase
+
+    async def drive(self, member):
+        member.state = "running"
+        member.start = time.monotonic()
+        try:
+            member.result = await member.job(member.deployment)
+            member.state = "done"
+        except Exception as e:
+            member.error = e
+            member.state = "failed"
+            print(f"fleet {member.deployment.name}: failed", traceback.format_exc(), sep="\n")
+        finally:
+            member.end = time.monotonic()
+            try:
+                await member.deployment.close()
+            except Exception as e:
+                print(f"fleet {member.deployment.name}: close failed: {e!r}")
+
+    def progress(self):
+        now = time.monotonic()
+        lines = [f"fleet: {now - self.start:.0f}s, " + ", ".join(str(b) for b in self.budgets.values())]
+        width = max((len(name) for name in self.members), default=0)
+        for name, m in self.members.items():
+            elapsed = ((m.end or now) - m.start) if m.start is not None else 0.0
+            commands, failures = m.commands
+            slots = " ".join(f"{kind}={b.held[name]}+{b.waiters(name)}w" for kind, b in self.budgets.items())
+            lines.append(f"  {name:<{width}} {m.state:<7} {elapsed:6.0f}s {slots} commands={commands} failed={failures} {m.phase}".rstrip())
+        return "\n".join(lines)
+
+    def summary(self):
+        lines = [self.progress(), "waited for slots:"]
+        for name in self.members:
+            waited = " ".join(f"{kind}={b.wait_time[name]:.1f}s/{b.granted[name]}" for kind, b in self.budgets.items())
+            lines.append(f"  {name} {waited}")
+        return "\n".join(lines)
+
+    async def report_progress(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            print(self.progress(), flush=True)
+
+    async def run(self):
+        # Runs all jobs to completion; returns {name: result, or the exception the job failed with}.
+        self.start = time.monotonic()
+        reporter = asyncio.create_task(self.report_progress()) if self.progress_interval else None
+        try:
+            await asyncio.gather(*(self.drive(m) for m in self.members.values()))
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+                await asyncio.gather(reporter, return_exceptions=True)
+            print(self.summary(), flush=True)
+        return {name: m.error if m.state == "failed" else m.result for name, m in self.members.items()}
+
+    @property
+    def failed(self):
+        return [name for name, m in self.members.items() if m.state == "failed"]
@@ -2,20 +2,77 @@ import os
 import asyncio
 import glob
 import shlex
-import csv
+import heapq
+import numpy as np
 from collections import namedtuple
+from contextlib import nullcontext
+from bench.hdrhistogram import HdrHistogram, LogWriter, read_log
 
-async def process_hdr_file_set(dir, name, java, time_start=None, time_end=None):
-    p = HdrLogProcessor(java=java, time_start=time_start, time_end=time_end)
+async def process_hdr_file_set(dir, name, java=None, time_start=None, time_end=None, engine="native", slots=None):
+    # slots limits the concurrent processing jobs (a semaphore, or Deployment.hdr_slots):
+    # the native engine is one job, the jar engine runs one per java process.
+    if engine == "native":
+        p = NativeHdrLogProcessor(time_start=time_start, time_end=time_end)
+        async with slots or nullcontext():
+            return await p.process_hdr_file_set(dir, name)
+    elif engine == "jar":
+        p = HdrLogProcessor(java=java, time_start=time_start, time_end=time_end, slots=slots)
+    else:
+        raise ValueError(f"Unknown HDR processing engine: {engine}")
     return await p.process_hdr_file_set(dir, name)
 
+def input_hdr_files(dir, name):
+    return sorted(file for file in glob.iglob(f'{dir}/**/{name}.hdr', recursive=True) if not file.endswith("trimmed.hdr"))
+
+class NativeHdrLogProcessor:
+    def __init__(self, /, time_start=None, time_end=None, write_merged_log=True):
+        self.time_start = time_start
+        self.time_end = time_end
+        self.write_merged_log = write_merged_log
+
+    async def process_hdr_file_set(self, dir, name):
+        return await asyncio.to_thread(self.process_files, dir, name)
+
+    def process_files(self, dir, name):
+        merged_log = f'{dir}/{name}.trimmed.hdr' if self.write_merged_log else None
+        histograms = self.merge(input_hdr_files(dir, name), merged_log)
+        summary_text = format_profile_summary(histograms)
+        with open(f'{dir}/{name}.trimmed-summary.txt', 'w') as f:
+            f.write(summary_text)
+        return parse_profile_summary(summary_text.splitlines())
+
+    def merge(self, files, merged_log=None):
+        # Trim, union and accumulate in one pass: intervals from all files are
+        # consumed in start time order, holding one decoded histogram per file.
+        inputs = [open(file) for file in files]
+        try:
+            intervals = heapq.merge(*(read_log(f, self.time_start, self.time_end) for f in inputs), key=lambda h: h.start_time_ms)
+            out = open(merged_log, 'w') if merged_log else None
+            try:
+                writer = None
+                totals = {}
+                for h in intervals:
+                    if out is not None:
+                        writer = writer or LogWriter(out, h.start_time_ms)
+                        writer.write(h)
+                    if h.tag not in totals:
+                        totals[h.tag] = HdrHistogram(h.lowest_trackable_value, h.highest_trackable_value, h.significant_digits)
+                        totals[h.tag].tag = h.tag
+                    totals[h.tag].add(h)
+                return totals
+            finally:
+                if out is not None:
+                    out.close()
+        finally:
+            for f in inputs:
+                f.close()
+
 class HdrLogProcessor:
-    def __init__(self, /, java, time_start, time_end):
-        self.dir = dir
+    def __init__(self, /, java, time_start, time_end, slots=None):
         self.java = java
         self.time_start = time_start
         self.time_end = time_end
-        self.semaphore = asyncio.Semaphore(2 * len(os.sched_getaffinity(0)))
+        self.semaphore = slots or asyncio.Semaphore(2 * len(os.sched_getaffinity(0)))
 
     async def run(self, *args):
         from bench.utils import run
@@ -61,60 +118,152 @@ class HdrLogProcessor:
 
     async def process(self, file):
         file_no_ext = os.path.splitext(file)[0]
-        tags = set()
-        with open(file, "r") as hdr_file:
-            reader = csv.reader(hdr_file, delimiter=',')
-            # Skip headers
-            for i in range(5):
-                next(reader, None)
-            for row in reader:
-                first_column = row[0]
-                tag = first_column[4:]
-                tags.add(tag)
-
+        logprocessor = f'{self.java} -cp lib/HdrHistogram-2.1.12.jar org.HdrHistogram.HistogramLogProcessor'
         tasks = []
-        for tag in tags:
-            logprocessor = f'{self.java} -cp lib/HdrHistogram-2.1.12.jar org.HdrHistogram.HistogramLogProcessor'
-            args = f"-i {shlex.quote(file)} -o {shlex.quote(file_no_ext)}_{tag} -tag {tag}"
+        for tag in log_tags(file) or [None]:
+            if tag is None:
+                args = f"-i {shlex.quote(file)} -o {shlex.quote(file_no_ext)}"
+            else:
+                args = f"-i {shlex.quote(file)} -o {shlex.quote(file_no_ext)}_{shlex.quote(tag)} -tag {shlex.quote(tag)}"
             tasks.append(self.run(shlex.split(f'{logprocessor} {args}')))
-        asyncio.gather(*tasks)
+        await asyncio.gather(*tasks)
 
     async def process_recursively(self, dir, name):
         files = glob.iglob(f'{dir}/**/{name}.trimmed.hdr', recursive=True)
         await asyncio.gather(*(self.process(file) for file in files))
 
+def log_tags(file):
+    # Tags of the intervals in a log, without decoding any histogram.
+    tags = set()
+    with open(file) as f:
+        for line in f:
+            if line.startswith("Tag="):
+                tags.add(line[4:line.index(",")])
+    return sorted(tags)
+
+# Per-interval latency time series: every interval of the logs becomes one row per tag with
+# its count, percentiles and max (ms). Intervals of all the input logs (e.g. one per client)
+# which end in the same `resolution_ms` window of wall-clock time are merged into one row.
+# timestamp is the end of that window in seconds since the epoch, which is how Prometheus
+# timestamps a scrape covering the time before it, so the rows line up with the series
+# from tsdb.read_series on the data of download_metrics.
+#
+# The logs are streamed in start time order and only the windows which can still get
+# intervals are held, so memory doesn't grow with the length of the logs.
+SERIES_PERCENTILES = [50, 99, 99.9]
+
+def series_column(p):
+    return f"p{p:g}"
+
+def interval_series(files, resolution_ms=1000, percentiles=SERIES_PERCENTILES, tags=None, time_start=None, time_end=None):
+    # Returns {tag: {"timestamp": ..., "count": ..., "p50": ..., ..., "max": ...}} of NumPy arrays.
+    names = ["timestamp", "count", *(series_column(p) for p in percentiles), "max"]
+    rows = {}
+    pending = {}
+
+    def emit(key):
+        tag, window = key
+        h = pending.pop(key)
+        row = [window * resolution_ms / 1000, h.total_count]
+        if h.total_count:
+            row += [v / 1e6 for v in h.values_at_percentiles(percentiles)] + [h.max_value() / 1e6]
+        else:
+            row += [0.0] * (len(percentiles) + 1)
+        rows.setdefault(tag, []).append(row)
+
+    inputs = [open(file) for file in files]
+    try:
+        intervals = heapq.merge(*(read_log(f, time_start, time_end, tags) for f in inputs), key=lambda h: h.start_time_ms)
+        for h in intervals:
+            # Everything still to come ends after this interval starts, so windows ending
+            # before that are complete.
+            for key in sorted((key for key in pending if key[1] * resolution_ms <= h.start_time_ms), key=lambda k: k[1]):
+                emit(key)
+            key = (h.tag, -(-h.end_time_ms // resolution_ms))
+            if key in pending:
+                pending[key].add(h)
+            else:
+                pending[key] = h.copy()
+        for key in sorted(pending, key=lambda k: k[1]):
+            emit(key)
+    finally:
+        for f in inputs:
+            f.close()
+    return {tag: {name: np.array(column, dtype=np.int64 if name == "count" else np.float64) for name, column in zip(names, zip(*r))}
+            for tag, r in rows.items()}
+
+def series_to_columns(series):
+    # Long format, one row per tag and window, like tsdb.to_columns.
+    if not series:
+        return {"tag": np.empty(0, dtype=object)}
+    columns = {"tag": np.concatenate([np.full(len(c["timestamp"]), tag, dtype=object) for tag, c in series.items()])}
+    for name in next(iter(series.values())):
+        columns[name] = np.concatenate([c[name] for c in series.values()])
+    return columns
+
+def write_series_npz(series, path):
+    np.savez(path, **{f"{tag}/{name}": values for tag, columns in series.items() for name, values in columns.items()})
+
+def write_series_parquet(series, path):
+    import pyarrow
+    import pyarrow.parquet
+    columns = series_to_columns(series)
+    pyarrow.parquet.write_table(pyarrow.table({name: pyarrow.array(values) for name, values in columns.items()}), path)
+
 ProfileSummaryResult = namedtuple('ProfileSummaryResult',
                                   ['ops_count', 'stress_time_s', 'throughput_per_second', 'mean_latency_ms',
                                    'median_latency_ms', 'p90_latency_ms', 'p99_latency_ms', 'p99_9_latency_ms',
                                    'p99_99_latency_ms', 'p99_999_latency_ms'])
 
+SUMMARY_PERCENTILES = [50.0, 90.0, 99.0, 99.9, 99.99, 99.999]
+
+def format_profile_summary(histograms):
+    lines = []
+    for tag, h in histograms.items():
+        prefix = f"{tag}." if tag is not None else ""
+        total = h.total_count
+        period_ms = h.end_time_ms - h.start_time_ms
+        throughput = total * 1000.0 / period_ms if period_ms > 0 else 0.0
+        lines.append(f"{prefix}TotalCount={total}")
+        lines.append(f"{prefix}Period(ms)={period_ms}")
+        lines.append(f"{prefix}Throughput(ops/sec)={throughput:.2f}")
+        lines.append(f"{prefix}Min={h.min_value()}")
+        lines.append(f"{prefix}Mean={h.mean():.2f}")
+        for p, v in zip(SUMMARY_PERCENTILES, h.values_at_percentiles(SUMMARY_PERCENTILES)):
+            lines.append(f"{prefix}{p:.3f}ptile={v}")
+        lines.append(f"{prefix}Max={h.max_value()}")
+        lines.append(f"{prefix}StdDev={h.std_deviation():.2f}")
+    return "".join(f"{line}\n" for line in lines)
+
 def parse_profile_summary_file(path):
     with open(path) as f:
-        lines = f.readlines()
-        summary = dict([x.split('=') for x in lines])
-        tags = set([x.split('.')[0] for x in lines])
-        result = {}
-        for tag in tags:
-            ops_count = int(summary[f'{tag}.TotalCount'])
-            stress_time_s = float(summary[f'{tag}.Period(ms)']) / 1000
-            throughput_per_second = float(summary[f'{tag}.Throughput(ops/sec)'])
-            mean_latency_ms = float(summary[f'{tag}.Mean']) / 1_000_000
-            median_latency_ms = float(summary[f'{tag}.50.000ptile']) / 1_000_000
-            p90_latency_ms = float(summary[f'{tag}.90.000ptile']) / 1_000_000
-            p99_latency_ms = float(summary[f'{tag}.99.000ptile']) / 1_000_000
-            p99_9_latency_ms = float(summary[f'{tag}.99.900ptile']) / 1_000_000
-            p99_99_latency_ms = float(summary[f'{tag}.99.990ptile']) / 1_000_000
-            p99_999_latency_ms = float(summary[f'{tag}.99.999ptile']) / 1_000_000
-
-            result[tag] = ProfileSummaryResult(
-                ops_count=ops_count,
-                stress_time_s=stress_time_s,
-                throughput_per_second=throughput_per_second,
-                mean_latency_ms=mean_latency_ms,
-                median_latency_ms=median_latency_ms,
-                p90_latency_ms=p90_latency_ms,
-                p99_latency_ms=p99_latency_ms,
-                p99_9_latency_ms=p99_9_latency_ms,
-                p99_99_latency_ms=p99_99_latency_ms,
-                p99_999_latency_ms=p99_999_latency_ms)
-        return result
+        return parse_profile_summary(f.readlines())
+
+def parse_profile_summary(lines):
+    summary = dict([x.split('=') for x in lines])
+    tags = set([x.split('.')[0] for x in lines])
+    result = {}
+    for tag in tags:
+        ops_count = int(summary[f'{tag}.TotalCount'])
+        stress_time_s = float(summary[f'{tag}.Period(ms)']) / 1000
+        throughput_per_second = float(summary[f'{tag}.Throughput(ops/sec)'])
+        mean_latency_ms = float(summary[f'{tag}.Mean']) / 1_000_000
+        median_latency_ms = float(summary[f'{tag}.50.000ptile']) / 1_000_000
+        p90_latency_ms = float(summary[f'{tag}.90.000ptile']) / 1_000_000
+        p99_latency_ms = float(summary[f'{tag}.99.000ptile']) / 1_000_000
+        p99_9_latency_ms = float(summary[f'{tag}.99.900ptile']) / 1_000_000
+        p99_99_latency_ms = float(summary[f'{tag}.99.990ptile']) / 1_000_000
+        p99_999_latency_ms = float(summary[f'{tag}.99.999ptile']) / 1_000_000
+
+        result[tag] = ProfileSummaryResult(
+            ops_count=ops_count,
+            stress_time_s=stress_time_s,
+            throughput_per_second=throughput_per_second,
+            mean_latency_ms=mean_latency_ms,
+            median_latency_ms=median_latency_ms,
+            p90_latency_ms=p90_latency_ms,
+            p99_latency_ms=p99_latency_ms,
+            p99_9_latency_ms=p99_9_latency_ms,
+            p99_99_latency_ms=p99_99_latency_ms,
+            p99_999_latency_ms=p99_999_latency_ms)
+    return result
@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from bench.hdr import process_hdr_file_set
+from bench.hdrhistogram import HdrHistogram, LogWriter
+
+# Compares the native HDR pipeline against lib/processor.jar on synthetic cassandra-stress logs:
+#   python -m bench.hdr_benchmark --hours 3 --clients 4 --java java
+
+def write_synthetic_log(path, hours, seed, tags=("READ-st", "READ-rt"), ops_per_interval=6000, start_time_ms=1_700_000_000_000):
+    rng = np.random.default_rng(seed)
+    with open(path, "w") as f:
+        writer = LogWriter(f, start_time_ms)
+        for second in range(int(hours * 3600)):
+            for tag in tags:
+                h = HdrHistogram()
+                h.tag = tag
+                h.start_time_ms = start_time_ms + second * 1000
+                h.end_time_ms = h.start_time_ms + 1000
+                latencies_ns = rng.lognormal(mean=13.5, sigma=0.6, size=ops_per_interval).astype(np.int64)
+                h.record_values(latencies_ns)
+                writer.write(h)
+
+async def benchmark(dir, name, java, time_start, time_end):
+    results = {}
+    engines = ["native"] + (["jar"] if java else [])
+    for engine in engines:
+        for file in os.listdir(dir):
+            if "trimmed" in file:
+                os.remove(os.path.join(dir, file))
+        start = time.monotonic()
+        results[engine] = await process_hdr_file_set(dir, name, java, time_start, time_end, engine=engine)
+        print(f"{engine}: {time.monotonic() - start:.2f}s")
+    if "jar" in results:
+        for tag, native in results["native"].items():
+            jar = results["jar"][tag]
+            for field in native._fields:
+                a, b = getattr(native, field), getattr(jar, field)
+                if not np.isclose(a, b, rtol=1e-6):
+                    print(f"{tag}.{field}: native={a} jar={b}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, default=3)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--java", default=shutil.which("java"))
+    parser.add_argument("--time-start", type=float, default=None)
+    parser.add_argument("--time-end", type=float, default=None)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as dir:
+        start = time.monotonic()
+        for i in range(args.clients):
+            os.makedirs(f"{dir}/client-{i}")
+            write_synthetic_log(f"{dir}/client-{i}/cs.hdr", args.hours, seed=i)
+        print(f"generated {args.clients} x {args.hours}h logs in {time.monotonic() - start:.2f}s")
+        results = asyncio.run(benchmark(dir, "cs", args.java, args.time_start, args.time_end))
+        for tag, summary in results["native"].items():
+            print(tag, summary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+import base64
+import math
+import re
+import struct
+import zlib
+import numpy as np
+
+# HdrHistogram V2 serialization, as written by cassandra-stress and the JAR tools.
+V2_ENCODING_COOKIE = 0x1c849303
+V2_COMPRESSED_ENCODING_COOKIE = 0x1c849304
+V2_HEADER = struct.Struct(">iiiiqqd")
+COMPRESSED_HEADER = struct.Struct(">ii")
+
+LOG_HEADER = '"StartTimestamp","Interval_Length","Interval_Max","Interval_Compressed_Histogram"'
+MAX_VALUE_UNIT_RATIO = 1_000_000.0
+
+def zigzag_leb128_decode(payload):
+    data = np.frombuffer(payload, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    if len(ends) == 0 or ends[-1] != len(data) - 1 or np.diff(ends, prepend=-1).max() > 8:
+        # A 9-byte LEB128 group only appears for counts above 2^55; not worth vectorizing.
+        return _zigzag_leb128_decode_slow(payload)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    position = np.arange(len(data)) - starts[group]
+    values = np.zeros(len(ends), dtype=np.uint64)
+    for i in range(int(position.max()) + 1):
+        at = position == i
+        values[group[at]] |= (data[at] & 0x7f).astype(np.uint64) << np.uint64(7 * i)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+def _zigzag_leb128_decode_slow(payload):
+    values = []
+    pos = 0
+    while pos < len(payload):
+        value = 0
+        for i in range(9):
+            b = payload[pos]
+            pos += 1
+            if i == 8:
+                value |= b << 56
+                break
+            value |= (b & 0x7f) << (7 * i)
+            if b < 0x80:
+                break
+        values.append((value >> 1) ^ -(value & 1))
+    return np.array(values, dtype=np.int64)
+
+def zigzag_leb128_encode(values):
+    values = np.asarray(values, dtype=np.int64)
+    zz = ((values << 1) ^ (values >> 63)).astype(np.uint64)
+    n_bytes = np.ones(len(zz), dtype=np.int64)
+    for i in range(1, 8):
+        n_bytes += zz >= np.uint64(1 << (7 * i))
+    n_bytes += zz >= np.uint64(1 << 56)
+    shifts = np.arange(9, dtype=np.uint64) * np.uint64(7)
+    groups = ((zz[:, None] >> shifts) & np.uint64(0x7f)).astype(np.uint8)
+    groups[:, 8] = (zz >> np.uint64(56)).astype(np.uint8)
+    position = np.arange(9)
+    groups[:, :8] |= np.where(position[:8] < (n_bytes[:, None] - 1), 0x80, 0).astype(np.uint8)
+    return groups[position < n_bytes[:, None]].tobytes()
+
+class HdrHistogram:
+    def __init__(self, lowest_trackable_value=1, highest_trackable_value=3_600_000_000_000, significant_digits=3, counts=None):
+        self.lowest_trackable_value = lowest_trackable_value
+        self.highest_trackable_value = highest_trackable_value
+        self.significant_digits = significant_digits
+        largest_single_unit = 2 * 10 ** significant_digits
+        sub_bucket_count_magnitude = math.ceil(math.log2(largest_single_unit))
+        self.sub_bucket_half_count_magnitude = max(sub_bucket_count_magnitude, 1) - 1
+        self.sub_bucket_count = 1 << (self.sub_bucket_half_count_magnitude + 1)
+        self.sub_bucket_half_count = self.sub_bucket_count // 2
+        self.unit_magnitude = int(math.floor(math.log2(lowest_trackable_value)))
+        self.sub_bucket_mask = (self.sub_bucket_count - 1) << self.unit_magnitude
+        length = self.counts_length_for(highest_trackable_value)
+        if counts is None:
+            counts = np.zeros(length, dtype=np.int64)
+        elif len(counts) < length:
+            counts = np.concatenate((counts, np.zeros(length - len(counts), dtype=np.int64)))
+        self.counts = counts
+        self.start_time_ms = None
+        self.end_time_ms = None
+        self.tag = None
+        self.encoded = None
+        self.encoded_max = None
+
+    def layout(self):
+        return (self.unit_magnitude, self.sub_bucket_half_count_magnitude)
+
+    def counts_length_for(self, highest_trackable_value):
+        smallest_untrackable = self.sub_bucket_count << self.unit_magnitude
+        buckets = 1
+        while smallest_untrackable <= highest_trackable_value:
+            if smallest_untrackable > (1 << 62):
+                buckets += 1
+                break
+            smallest_untrackable <<= 1
+            buckets += 1
+        return (buckets + 1) * self.sub_bucket_half_count
+
+    def value_from_index(self, index):
+        index = np.asarray(index, dtype=np.int64)
+        bucket = (index >> self.sub_bucket_half_count_magnitude) - 1
+        sub_bucket = (index & (self.sub_bucket_half_count - 1)) + self.sub_bucket_half_count
+        sub_bucket = np.where(bucket < 0, sub_bucket - self.sub_bucket_half_count, sub_bucket)
+        bucket = np.maximum(bucket, 0)
+        return sub_bucket << (bucket + self.unit_magnitude)
+
+    def equivalent_range_from_index(self, index):
+        bucket = np.maximum((np.asarray(index, dtype=np.int64) >> self.sub_bucket_half_count_magnitude) - 1, 0)
+        return np.int64(1) << (bucket + self.unit_magnitude)
+
+    def index_of(self, values):
+        values = np.asarray(values, dtype=np.int64)
+        masked = values | self.sub_bucket_mask
+        _, exponent = np.frexp(masked.astype(np.float64))
+        exponent = exponent.astype(np.int64)
+        # frexp rounds values above 2^53; correct the exponent where it overshot.
+        exponent -= (np.int64(1) << (exponent - 1)) > masked
+        bucket = exponent - self.unit_magnitude - self.sub_bucket_half_count_magnitude - 1
+        sub_bucket = values >> (bucket + self.unit_magnitude)
+        return ((bucket + 1) << self.sub_bucket_half_count_magnitude) + (sub_bucket - self.sub_bucket_half_count)
+
+    def _ensure_length(self, length):
+        if length > len(self.counts):
+            self.counts = np.concatenate((self.counts, np.zeros(length - len(self.counts), dtype=np.int64)))
+
+    def record_values(self, values, counts=1):
+        index = self.index_of(values)
+        self._ensure_length(int(index.max()) + 1 if len(index) else 0)
+        np.add.at(self.counts, index, counts)
+
+    def add(self, other):
+        if other.layout() == self.layout():
+            self._ensure_length(len(other.counts))
+            self.counts[:len(other.counts)] += other.counts
+        else:
+            nonzero = np.flatnonzero(other.counts)
+            self.record_values(other.value_from_index(nonzero), other.counts[nonzero])
+        for attr, pick in (("start_time_ms", min), ("end_time_ms", max)):
+            theirs = getattr(other, attr)
+            if theirs is not None:
+                ours = getattr(self, attr)
+                setattr(self, attr, theirs if ours is None else pick(ours, theirs))
+
+    def copy(self):
+        h = HdrHistogram(self.lowest_trackable_value, self.highest_trackable_value, self.significant_digits, self.counts.copy())
+        h.start_time_ms, h.end_time_ms, h.tag = self.start_time_ms, self.end_time_ms, self.tag
+        return h
+
+    @property
+    def total_count(self):
+        return int(self.counts.sum())
+
+    def _recorded(self):
+        index = np.flatnonzero(self.counts)
+        return index, self.value_from_index(index), self.counts[index]
+
+    def min_value(self):
+        if self.counts[0] > 0 or self.total_count == 0:
+            return 0
+        return int(self.value_from_index(np.flatnonzero(self.counts)[0]))
+
+    def max_value(self):
+        index = np.flatnonzero(self.counts)
+        if len(index) == 0:
+            return 0
+        return int(self.value_from_index(index[-1]) + self.equivalent_range_from_index(index[-1]) - 1)
+
+    def mean(self):
+        index, values, counts = self._recorded()
+        if len(index) == 0:
+            return 0.0
+        medians = values + (self.equivalent_range_from_index(index) >> 1)
+        return float((medians.astype(np.float64) * counts).sum() / counts.sum())
+
+    def std_deviation(self):
+        index, values, counts = self._recorded()
+        if len(index) == 0:
+            return 0.0
+        medians = (values + (self.equivalent_range_from_index(index) >> 1)).astype(np.float64)
+        mean = (medians * counts).sum() / counts.sum()
+        return float(math.sqrt(((medians - mean) ** 2 * counts).sum() / counts.sum()))
+
+    def values_at_percentiles(self, percentiles):
+        # Same rounding as HdrHistogram 2.1.10, which is what lib/processor.jar bundles.
+        percentiles = np.minimum(np.asarray(percentiles, dtype=np.float64), 100.0)
+        total = self.total_count
+        if total == 0:
+            return np.zeros(len(percentiles), dtype=np.int64)
+        targets = np.maximum(((percentiles / 100.0) * total + 0.5).astype(np.int64), 1)
+        index = np.minimum(np.searchsorted(np.cumsum(self.counts), targets, side="left"), len(self.counts) - 1)
+        values = self.value_from_index(index)
+        highest = values + self.equivalent_range_from_index(index) - 1
+        return np.where(percentiles == 0.0, values, highest)
+
+    def value_at_percentile(self, percentile):
+        return int(self.values_at_percentiles([percentile])[0])
+
+    @classmethod
+    def decode(cls, data):
+        cookie, length = COMPRESSED_HEADER.unpack_from(data)
+        # Bits 4-7 of the cookie carry the word size, which V2 encoding ignores.
+        if cookie & ~0xf0 == V2_COMPRESSED_ENCODING_COOKIE:
+            data = zlib.decompress(data[COMPRESSED_HEADER.size:COMPRESSED_HEADER.size + length])
+            cookie, = struct.unpack_from(">i", data)
+        if cookie & ~0xf0 != V2_ENCODING_COOKIE:
+            raise ValueError(f"Unsupported HdrHistogram encoding cookie: {cookie:#x}")
+        _, payload_length, normalizing_offset, digits, lowest, highest, _ = V2_HEADER.unpack_from(data)
+        if normalizing_offset != 0:
+            raise ValueError("Shifted histograms (non-zero normalizing index offset) are not supported")
+        tokens = zigzag_leb128_decode(data[V2_HEADER.size:V2_HEADER.size + payload_length])
+        widths = np.where(tokens < 0, -tokens, 1)
+        starts = np.cumsum(widths) - widths
+        counts = np.zeros(int(widths.sum()), dtype=np.int64)
+        positive = tokens > 0
+        counts[starts[positive]] = tokens[positive]
+        return cls(lowest, highest, digits, counts)
+
+    def encode(self):
+        nonzero = np.flatnonzero(self.counts)
+        if len(nonzero):
+            gaps = np.diff(nonzero, prepend=-1) - 1
+            tokens = np.empty(2 * len(nonzero), dtype=np.int64)
+            tokens[0::2] = np.where(gaps > 1, -gaps, 0)
+            tokens[1::2] = self.counts[nonzero]
+            # A single zero is written as a literal 0, longer runs as their negated length.
+            tokens = tokens[np.repeat(gaps > 0, 2) | np.tile([False, True], len(nonzero))]
+            payload = zigzag_leb128_encode(tokens)
+        else:
+            payload = b""
+        header = V2_HEADER.pack(V2_ENCODING_COOKIE, len(payload), 0, self.significant_digits,
+                                self.lowest_trackable_value, self.highest_trackable_value, 1.0)
+        compressed = zlib.compress(header + payload)
+        return COMPRESSED_HEADER.pack(V2_COMPRESSED_ENCODING_COOKIE, len(compressed)) + compressed
+
+    def encode_base64(self):
+        return base64.b64encode(self.encode()).decode("ascii")
+
+class LogParser:
+    # Turns log lines into interval histograms with absolute start/end timestamps (ms since epoch),
+    # one line at a time, so that it can also follow a log which is still being written.
+    # time_start/time_end are seconds relative to the log start, like the JAR tools.
+    def __init__(self, time_start=None, time_end=None, tags=None):
+        self.time_start = time_start
+        self.time_end = time_end
+        self.tags = tags
+        self.start_time_sec = None
+        self.base_time_sec = None
+        self.observed_base_time = False
+        self.done = False
+
+    def parse(self, line):
+        if line.startswith("#"):
+            m = re.match(r"#\[StartTime: ([0-9.]+)", line)
+            if m:
+                self.start_time_sec = float(m.group(1))
+            m = re.match(r"#\[BaseTime: ([0-9.]+)", line)
+            if m:
+                self.base_time_sec = float(m.group(1))
+                self.observed_base_time = True
+            return None
+        if self.done or line.startswith('"') or not line.strip():
+            return None
+        fields = line.rstrip("\n").split(",")
+        tag = None
+        if fields[0].startswith("Tag="):
+            tag = fields[0][4:]
+            fields = fields[1:]
+        timestamp_sec = float(fields[0])
+        if self.start_time_sec is None:
+            self.start_time_sec = timestamp_sec
+        if not self.observed_base_time:
+            self.base_time_sec = self.start_time_sec if timestamp_sec < self.start_time_sec - 365 * 24 * 3600.0 else 0.0
+            self.observed_base_time = True
+        absolute_start_sec = timestamp_sec + self.base_time_sec
+        offset_sec = absolute_start_sec - self.start_time_sec
+        if self.time_start is not None and offset_sec < self.time_start:
+            return None
+        if self.time_end is not None and offset_sec > self.time_end:
+            self.done = True
+            return None
+        if self.tags is not None and tag not in self.tags:
+            return None
+        h = HdrHistogram.decode(base64.b64decode(fields[3]))
+        h.encoded, h.encoded_max = fields[3], fields[2]
+        h.tag = tag
+        h.start_time_ms = round(absolute_start_sec * 1000)
+        h.end_time_ms = round((absolute_start_sec + float(fields[1])) * 1000)
+        return h
+
+def read_log(f, time_start=None, time_end=None, tags=None):
+    parser = LogParser(time_start, time_end, tags)
+    for line in f:
+        h = parser.parse(line)
+        if parser.done:
+            return
+        if h is not None:
+            yield h
+
+class LogWriter:
+    def __init__(self, f, start_time_ms, base_time_ms=None):
+        self.f = f
+        self.base_time_ms = start_time_ms if base_time_ms is None else base_time_ms
+        f.write("#[Logged with bench.hdrhistogram]\n")
+        f.write(f"#[StartTime: {start_time_ms / 1000:.3f} (seconds since epoch)]\n")
+        f.write(f"#[BaseTime: {self.base_time_ms / 1000:.3f} (seconds since epoch)]\n")
+        f.write(LOG_HEADER + "\n")
+
+    def write(self, h):
+        tag = f"Tag={h.tag}," if h.tag is not None else ""
+        start = (h.start_time_ms - self.base_time_ms) / 1000
+        length = (h.end_time_ms - h.start_time_ms) / 1000
+        if h.encoded is not None:
+            max_value, encoded = h.encoded_max, h.encoded
+        else:
+            max_value, encoded = f"{h.max_value() / MAX_VALUE_UNIT_RATIO:.3f}", h.encode_base64()
+        self.f.write(f"{tag}{start:.3f},{length:.3f},{max_value},{encoded}\n")
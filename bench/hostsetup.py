@@ -0,0 +1,150 @@
+import hashlib
+import posixpath
+import shlex
+from collections import namedtuple
+
+# Idempotent host setup. A setup is a list of named steps, each a bash script
+# run with `bash -xeu` as the login user. Every step has a fingerprint: the
+# hash of its script chained with the fingerprints of the steps before it, so
+# changing a step also reapplies the steps after it. When a step succeeds, its
+# fingerprint is written to ~/.bench-setup/{step} on the host, and later setups
+# skip the hosts whose stamp matches. Reading all stamps costs one command per
+# host, so a setup which is already applied is cheap to repeat.
+#
+# Packages and artifacts come through caches on the monitor host, over the
+# private network: apt-cacher-ng for apt and a plain HTTP server for files such
+# as the cassandra-stress tarball, which the monitor downloads once per
+# deployment. Hosts fall back to the origin when the monitor's caches aren't up.
+# Hosts find the caches at the address in CACHE_IP_FILE, which every setup
+# rewrites (point_to_cache) instead of baking it into the steps, so hosts set up
+# before the monitor existed don't redo their steps once it does.
+
+STAMP_DIR = ".bench-setup"
+APT = "sudo DEBIAN_FRONTEND=noninteractive apt-get -oDPkg::Lock::Timeout=-1"
+APT_CACHER_PORT = 3142
+ARTIFACT_PORT = 8080
+ARTIFACT_DIR = "/var/cache/bench-artifacts"
+CACHE_IP_FILE = "/etc/bench-cache-ip"
+
+SetupStep = namedtuple('SetupStep', ['name', 'script'])
+# Hosts on which a step was applied and on which it was already up to date.
+StepResult = namedtuple('StepResult', ['applied', 'skipped'])
+
+def fingerprints(steps):
+    fingerprint = ""
+    result = {}
+    for step in steps:
+        fingerprint = hashlib.sha256(f"{fingerprint}\0{step.name}\0{step.script}".encode()).hexdigest()[:16]
+        result[step.name] = fingerprint
+    return result
+
+def parse_stamps(output):
+    # `grep -H . ~/.bench-setup/*` output -> {step: fingerprint}
+    stamps = {}
+    for line in output.decode("utf-8", errors="replace").splitlines():
+        path, _, fingerprint = line.partition(":")
+        stamps[posixpath.basename(path)] = fingerprint.strip()
+    return stamps
+
+def plan_setup(steps, stamps, force=False):
+    # stamps: {host: {step: fingerprint}} -> {step: [hosts which need it]}
+    wanted = fingerprints(steps)
+    return {step.name: [host for host, s in stamps.items() if force or s.get(step.name) != wanted[step.name]] for step in steps}
+
+def step_script(step, fingerprint):
+    return (f"{step.script}\n"
+            f"mkdir -p ~/{STAMP_DIR} && echo {fingerprint} > ~/{STAMP_DIR}/{shlex.quote(step.name)}.tmp"
+            f" && mv ~/{STAMP_DIR}/{shlex.quote(step.name)}.tmp ~/{STAMP_DIR}/{shlex.quote(step.name)}\n")
+
+async def read_stamps(deployment, hosts):
+    result = (await deployment.pssh(hosts, f"grep -H . ~/{STAMP_DIR}/* 2>/dev/null", ok_codes=(0, 1, 2))).check()
+    return {host: parse_stamps(result[host].stdout or b"") for host in hosts}
+
+async def run_setup(deployment, hosts, steps, force=False):
+    # Applies the steps in order on the hosts which need them; a step failing on any host stops
+    # the setup (with FanoutError) before the next step. Returns {step: StepResult}.
+    hosts = list(hosts)
+    if not hosts or not steps:
+        return {}
+    plan = plan_setup(steps, await read_stamps(deployment, hosts), force)
+    wanted = fingerprints(steps)
+    report = {}
+    for step in steps:
+        needed = plan[step.name]
+        if needed:
+            (await deployment.pssh(needed, "bash -xeu", stdin_data=step_script(step, wanted[step.name]).encode())).check()
+        report[step.name] = StepResult(needed, [host for host in hosts if host not in needed])
+        print(f"setup {step.name}: applied on {len(needed)} hosts, up to date on {len(hosts) - len(needed)}")
+    return report
+
+async def point_to_cache(deployment, hosts, cache_ip):
+    # Tells the hosts where the monitor's caches are; with None, that there are none.
+    if cache_ip is None:
+        command = f"sudo rm -f {CACHE_IP_FILE}"
+    else:
+        command = f"echo {shlex.quote(cache_ip)} | sudo tee {CACHE_IP_FILE} >/dev/null"
+    (await deployment.pssh(hosts, command)).check()
+
+def applied(report, step):
+    return bool(report.get(step, StepResult([], [])).applied)
+
+# Steps
+
+def apt_install(packages, name="packages"):
+    return SetupStep(name, f"{APT} update\n{APT} install -y {' '.join(packages)}")
+
+def apt_proxy():
+    # apt asks the detect script for the proxy before every download, so hosts go direct while
+    # the monitor's apt-cacher-ng isn't known or isn't reachable.
+    detect = (f"#!/bin/bash\n"
+              f"ip=$(cat {CACHE_IP_FILE} 2>/dev/null)\n"
+              f"if [ -n \"$ip\" ] && timeout 1 bash -c \"</dev/tcp/$ip/{APT_CACHER_PORT}\" 2>/dev/null; "
+              f"then echo http://$ip:{APT_CACHER_PORT}; else echo DIRECT; fi\n")
+    return SetupStep("apt-proxy", f"""
+sudo tee /usr/local/bin/bench-apt-proxy >/dev/null <<'EOF'
+{detect}EOF
+sudo chmod +x /usr/local/bin/bench-apt-proxy
+echo 'Acquire::http::Proxy-Auto-Detect "/usr/local/bin/bench-apt-proxy";' | sudo tee /etc/apt/apt.conf.d/01bench-proxy >/dev/null
+""")
+
+def artifact_server():
+    # Runs on the monitor, which must have apt-cacher-ng and python3.
+    unit = f"""[Unit]
+Description=bench artifact cache
+After=network.target
+[Service]
+ExecStart=/usr/bin/python3 -m http.server {ARTIFACT_PORT} --directory {ARTIFACT_DIR}
+Restart=always
+[Install]
+WantedBy=multi-user.target
+"""
+    return SetupStep("artifact-server", f"""
+sudo mkdir -p {ARTIFACT_DIR}
+sudo tee /etc/systemd/system/bench-artifacts.service >/dev/null <<'EOF'
+{unit}EOF
+sudo systemctl daemon-reload
+sudo systemctl enable --now apt-cacher-ng bench-artifacts
+sudo systemctl restart bench-artifacts
+""")
+
+def artifact_path(url):
+    # Path of a cached artifact, relative to ARTIFACT_DIR.
+    return f"{hashlib.sha256(url.encode()).hexdigest()[:12]}/{posixpath.basename(url)}"
+
+def cache_artifact(url):
+    # Downloads url into the monitor's artifact cache, once.
+    path = shlex.quote(f"{ARTIFACT_DIR}/{artifact_path(url)}")
+    return SetupStep(f"artifact-{artifact_path(url).replace('/', '-')}", f"""
+sudo mkdir -p $(dirname {path})
+test -s {path} || (sudo wget -q -O {path}.tmp {shlex.quote(url)} && sudo mv {path}.tmp {path})
+""")
+
+def fetch_artifact(url):
+    # Script which downloads url into the current directory, from the monitor's cache if the host knows it.
+    name = shlex.quote(posixpath.basename(url))
+    origin = f"wget -q -O {name} {shlex.quote(url)}"
+    cached = f"http://$(cat {CACHE_IP_FILE}):{ARTIFACT_PORT}/{artifact_path(url)}"
+    return f'(test -s {CACHE_IP_FILE} && wget -q -T 10 -t 1 -O {name} "{cached}") || {origin}'
+
+def fetch_and_unpack(name, url):
+    return SetupStep(name, f"{fetch_artifact(url)}\ntar xf {shlex.quote(posixpath.basename(url))}")
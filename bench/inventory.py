@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import yaml
+
+# `bin/ansible-inventory` takes a second or more per call, so the groups it
+# returns are cached in {deployment}/inventory.json. prov/terraform.py writes
+# the cache after each apply; the cache is recompiled whenever it is missing,
+# has another version, or was made from a different inventory file.
+
+CACHE_VERSION = 1
+
+def cache_path(deployment_name):
+    return f"{deployment_name}/inventory.json"
+
+def inventory_hash(deployment_name):
+    with open(f"{deployment_name}/inventory", "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def compile_inventory(deployment_name):
+    inventory_yaml = subprocess.run(['bin/ansible-inventory', deployment_name, '--list', '--yaml'], check=True, capture_output=True).stdout
+    groups = yaml.load(inventory_yaml, Loader=yaml.SafeLoader)["all"]["children"]
+    cache = {"version": CACHE_VERSION, "inventory_sha256": inventory_hash(deployment_name), "groups": groups}
+    tmp = f"{cache_path(deployment_name)}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, cache_path(deployment_name))
+    return groups
+
+def load_cached_inventory(deployment_name):
+    try:
+        with open(cache_path(deployment_name)) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if cache.get("version") != CACHE_VERSION or cache.get("inventory_sha256") != inventory_hash(deployment_name):
+        return None
+    return cache["groups"]
+
+def load_inventory(deployment_name):
+    groups = load_cached_inventory(deployment_name)
+    if groups is None:
+        groups = compile_inventory(deployment_name)
+    return groups
+
+if __name__ == "__main__":
+    compile_inventory(sys.argv[1])
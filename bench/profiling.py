@@ -0,0 +1,346 @@
+import asyncio
+import html
+import json
+import os
+import re
+import shlex
+import sys
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from bench.hdrhistogram import HdrHistogram
+
+# Profiling captures on the nodes with the tools setup_servers installs:
+#   perf      perf record -g of all CPUs, turned into `perf script` text on the node
+#             (where the symbols are) and into folded stacks and a flamegraph here
+#   blktrace  blktrace of the scylla data device, parsed with blkparse on the node
+#             and turned into per-operation I/O latency histograms here
+#   lttng     a kernel lttng session, collected as is
+#
+# All hosts of a capture start at the same wall-clock moment. A capture either
+# lasts a fixed window (duration) or covers a phase of the test, e.g. a cs() call,
+# which tags it with its phase (the cs command, e.g. "read") and options:
+#
+#     await d.cs(options, profile=d.profile(d.server_hosts, ["perf", "blktrace"]))
+#
+#     async with d.profile(d.server_hosts, ["perf"], phase="bootstrap"):
+#         ...
+#
+# Results land in {dest_dir}/{capture id}/{host}/ with a capture.json recording
+# the phase and the time range covered. When the profiled phase fails, the
+# profilers are stopped and their outputs discarded. The post-processing functions work on
+# plain files, so recorded outputs can be reprocessed with
+# `python -m bench.profiling <capture dir>`.
+
+KINDS = ("perf", "blktrace", "lttng")
+LTTNG_EVENTS = "block_rq_issue,block_rq_complete,sched_switch"
+IO_PERCENTILES = [50, 90, 99, 99.9]
+
+# Sleeps until the given unix time, so that the hosts start together regardless of ssh latency.
+WAIT_UNTIL = """sleep $(awk -v t={start_at} 'BEGIN {{ "date +%s.%N" | getline now; d = t - now; print (d > 0 ? d : 0) }}')"""
+
+def start_command(kind, dir, start_at, duration=None, perf_frequency=99, devices=None, lttng_events=LTTNG_EVENTS):
+    q = shlex.quote(dir)
+    wait = WAIT_UNTIL.format(start_at=start_at)
+    if kind == "perf":
+        until = f"-- sleep {duration}" if duration else ""
+        tool = f"perf record -F {perf_frequency} -g -a -o {q}/perf.data {until}"
+    elif kind == "blktrace":
+        devices = " ".join(f"-d {shlex.quote(dev)}" for dev in devices) if devices else '-d "$(findmnt -no SOURCE -T /var/lib/scylla)"'
+        until = f"-w {duration}" if duration else ""
+        tool = f"blktrace {devices} -D {q}/blktrace {until}"
+    elif kind == "lttng":
+        session = f"bench-{os.path.basename(dir)}"
+        return (f"mkdir -p {q} && {wait} && sudo lttng create {session} --output={q}/lttng >{q}/lttng.log"
+                f" && sudo lttng enable-event -k {shlex.quote(lttng_events)} >>{q}/lttng.log && sudo lttng start >>{q}/lttng.log"
+                f" && echo {session} > {q}/lttng.session")
+    else:
+        raise ValueError(f"Unknown profiling kind: {kind}")
+    return (f"mkdir -p {q}{'/blktrace' if kind == 'blktrace' else ''} && {wait} && "
+            f"(sudo nohup {tool} >{q}/{kind}.log 2>&1 </dev/null & echo $! > {q}/{kind}.pid)")
+
+def stop_command(kind, dir, interrupt=True):
+    # Interrupts the tool (unless it was given a duration and should finish by itself), waits
+    # for it to exit and leaves text outputs to collect.
+    q = shlex.quote(dir)
+    if kind == "lttng":
+        stop = f"sudo lttng stop $(cat {q}/lttng.session) >>{q}/lttng.log && sudo lttng destroy $(cat {q}/lttng.session) >>{q}/lttng.log"
+    else:
+        pid = f"$(cat {q}/{kind}.pid)"
+        stop = f"{f'sudo kill -INT {pid} 2>/dev/null; ' if interrupt else ''}while [ -e /proc/{pid} ]; do sleep 0.2; done"
+    if kind == "perf":
+        stop += f" && sudo perf script -i {q}/perf.data > {q}/perf.script 2>{q}/perf-script.log"
+    elif kind == "blktrace":
+        stop += (f" && for f in {q}/blktrace/*.blktrace.0; do n=$(basename $f .blktrace.0);"
+                 f" sudo blkparse -D {q}/blktrace -i $n > {q}/blkparse-$n.txt; done")
+    return f"{stop}; sudo chown -R $(id -u) {q}"
+
+# perf
+
+PERF_HEADER = re.compile(r"^(\S.*?)\s+\d+(?:/\d+)?\s+(?:\[\d+\]\s+)?[\d.]+:")
+
+def fold_perf_script(lines):
+    # Folded stacks like stackcollapse-perf.pl: "comm;root;...;leaf" -> samples.
+    folded = Counter()
+    comm = None
+    frames = []
+    def flush():
+        if comm is not None:
+            folded[";".join([comm, *reversed(frames)])] += 1
+    for line in lines:
+        if not line.strip():
+            flush()
+            comm, frames = None, []
+        elif line[0] in " \t":
+            if comm is None:
+                continue
+            parts = line.split(None, 1)
+            symbol = parts[1] if len(parts) > 1 else "[unknown]"
+            # "sym+0x1f (dso)" -> "sym"; unknown symbols are named after their dso.
+            m = re.match(r"(.*?)(?:\+0x[0-9a-f]+)?\s+\((.*)\)\s*$", symbol)
+            if m:
+                name, dso = m.groups()
+                symbol = name if name and name != "[unknown]" else f"[{os.path.basename(dso)}]"
+            frames.append(symbol.strip().replace(";", ":"))
+        else:
+            flush()
+            m = PERF_HEADER.match(line)
+            comm, frames = (m.group(1).replace(" ", "_") if m else line.split()[0]), []
+    flush()
+    return folded
+
+def write_folded(folded, path):
+    with open(path, "w") as f:
+        for stack, count in sorted(folded.items()):
+            f.write(f"{stack} {count}\n")
+
+def read_folded(path):
+    folded = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            folded[stack] += int(count)
+    return folded
+
+def frame_color(name):
+    # Stable warm colors, like flamegraph.pl's "hot" palette.
+    h = zlib.crc32(name.encode())
+    return f"rgb({205 + h % 50},{(h >> 8) % 230},{(h >> 16) % 55})"
+
+def flamegraph_svg(folded, title="Flame Graph", width=1200, frame_height=16, min_width=0.1):
+    root = {"name": "all", "value": 0, "children": {}}
+    for stack, count in folded.items():
+        node = root
+        node["value"] += count
+        for frame in stack.split(";"):
+            node = node["children"].setdefault(frame, {"name": frame, "value": 0, "children": {}})
+            node["value"] += count
+    total = root["value"] or 1
+    scale = (width - 20) / total
+    rects = []
+    todo = [(root, 10.0, 0)]
+    while todo:
+        node, x, depth = todo.pop()
+        w = node["value"] * scale
+        if w < min_width:
+            continue
+        rects.append((node, x, depth, w))
+        for child in sorted(node["children"].values(), key=lambda c: c["name"]):
+            todo.append((child, x, depth + 1))
+            x += child["value"] * scale
+    depth = max((d for _, _, d, _ in rects), default=0) + 1
+    height = depth * frame_height + 50
+    out = [f'<?xml version="1.0" standalone="no"?>',
+           f'<svg version="1.1" width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg" font-family="Verdana" font-size="12">',
+           f'<rect x="0" y="0" width="{width}" height="{height}" fill="#f8f8f8"/>',
+           f'<text x="{width / 2}" y="24" text-anchor="middle" font-size="17">{html.escape(title)}</text>']
+    for node, x, d, w in rects:
+        y = height - 10 - (d + 1) * frame_height
+        name = html.escape(node["name"])
+        label = node["name"][:int(w / 7)] if w > 21 else ""
+        if label and len(label) < len(node["name"]):
+            label = label[:-2] + ".."
+        out.append(f'<g><title>{name} ({node["value"]} samples, {100 * node["value"] / total:.2f}%)</title>'
+                   f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{frame_height - 1}" fill="{frame_color(node["name"])}" rx="2"/>'
+                   + (f'<text x="{x + 3:.1f}" y="{y + frame_height - 4}">{html.escape(label)}</text>' if label else "") + '</g>')
+    out.append("</svg>")
+    return "\n".join(out) + "\n"
+
+# blktrace
+
+BLKPARSE_LINE = re.compile(r"^\s*(\d+,\d+)\s+\d+\s+\d+\s+([\d.]+)\s+\d+\s+([A-Z]+)\s+(\S+)\s+(\d+)\s+\+\s+(\d+)")
+
+def io_operation(rwbs):
+    if "D" in rwbs:
+        return "discard"
+    if "R" in rwbs:
+        return "read"
+    if "W" in rwbs:
+        return "write"
+    return None
+
+def io_latency_histograms(lines):
+    # {(operation, stage): HdrHistogram of ns}, stage "d2c" (device time, issue to completion)
+    # or "q2c" (queue to completion), from blkparse's default output.
+    queued = {}
+    issued = {}
+    values = {}
+    for line in lines:
+        m = BLKPARSE_LINE.match(line)
+        if m is None:
+            continue
+        dev, t, action, rwbs, sector, _ = m.groups()
+        key = (dev, int(sector))
+        t = round(float(t) * 1e9)
+        if action == "Q":
+            queued[key] = t
+        elif action == "D":
+            issued[key] = t
+        elif action == "C":
+            operation = io_operation(rwbs)
+            for stage, started in (("d2c", issued.pop(key, None)), ("q2c", queued.pop(key, None))):
+                if operation is not None and started is not None and t >= started:
+                    values.setdefault((operation, stage), []).append(max(t - started, 1))
+    histograms = {}
+    for key, v in values.items():
+        histograms[key] = HdrHistogram()
+        histograms[key].record_values(v)
+    return histograms
+
+def format_io_histograms(histograms):
+    lines = []
+    for (operation, stage), h in sorted(histograms.items()):
+        percentiles = " ".join(f"p{p:g}={v / 1000:.0f}us" for p, v in zip(IO_PERCENTILES, h.values_at_percentiles(IO_PERCENTILES)))
+        lines.append(f"{operation} {stage}: {h.total_count} IOs, mean={h.mean() / 1000:.0f}us {percentiles} max={h.max_value() / 1000:.0f}us")
+        # log2 buckets in us
+        index = np.flatnonzero(h.counts)
+        buckets = Counter()
+        for value, count in zip(h.value_from_index(index), h.counts[index]):
+            buckets[max(int(value // 1000), 1).bit_length() - 1] += int(count)
+        peak = max(buckets.values())
+        for b in range(min(buckets), max(buckets) + 1):
+            n = buckets.get(b, 0)
+            lines.append(f"  {1 << b:>8}-{(2 << b) - 1:<8}us {n:>9} {'#' * round(40 * n / peak)}")
+    return "".join(f"{line}\n" for line in lines)
+
+# Post-processing of one host's directory, run in a worker process.
+
+def process_host_dir(dir, title=""):
+    results = {}
+    if os.path.exists(f"{dir}/perf.script"):
+        with open(f"{dir}/perf.script", errors="replace") as f:
+            folded = fold_perf_script(f)
+        write_folded(folded, f"{dir}/perf.folded")
+        with open(f"{dir}/flamegraph.svg", "w") as f:
+            f.write(flamegraph_svg(folded, title=f"{title} {os.path.basename(dir)}".strip()))
+        results["perf_samples"] = sum(folded.values())
+    blkparse = sorted(name for name in os.listdir(dir) if name.startswith("blkparse-") and name.endswith(".txt"))
+    if blkparse:
+        histograms = {}
+        for name in blkparse:
+            with open(f"{dir}/{name}", errors="replace") as f:
+                for key, h in io_latency_histograms(f).items():
+                    histograms.setdefault(key, HdrHistogram()).add(h)
+        with open(f"{dir}/io-latency.txt", "w") as f:
+            f.write(format_io_histograms(histograms))
+        results["ios"] = {f"{op} {stage}": h.total_count for (op, stage), h in histograms.items()}
+    return results
+
+async def process_capture_dir(dir, title="", jobs=None):
+    hosts = sorted(h for h in os.listdir(dir) if os.path.isdir(os.path.join(dir, h)))
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(jobs or min(len(hosts), os.cpu_count()) or 1) as pool:
+        results = await asyncio.gather(*(loop.run_in_executor(pool, process_host_dir, os.path.join(dir, h), title) for h in hosts))
+    return dict(zip(hosts, results))
+
+class ProfileCapture:
+    # options go to start_command, e.g. perf_frequency, devices (for blktrace) or lttng_events.
+    # The raw perf.data and blktrace files stay on the nodes unless keep_raw is set.
+    def __init__(self, deployment, hosts, kinds=("perf",), dest_dir="profiles", phase=None, duration=None, lead=2.0, keep_raw=False,
+                 **options):
+        for kind in kinds:
+            if kind not in KINDS:
+                raise ValueError(f"Unknown profiling kind: {kind}")
+        self.d = deployment
+        self.hosts = list(hosts)
+        self.kinds = list(kinds)
+        self.phase = phase
+        self.duration = duration
+        self.lead = lead
+        self.keep_raw = keep_raw
+        self.options = options
+        self.start = None
+        self.end = None
+        self.id = None
+        self.dest_dir = dest_dir
+        self.results = None
+        self.cs_options = None
+
+    @property
+    def remote_dir(self):
+        return f"profiling/{self.id}"
+
+    @property
+    def local_dir(self):
+        return f"{self.dest_dir}/{self.id}"
+
+    async def begin(self):
+        self.start = time.time() + self.lead
+        self.id = time.strftime("%Y%m%d-%H%M%S", time.gmtime(self.start))
+        if self.phase:
+            self.id += "-" + re.sub(r"[^\w.-]", "_", self.phase)
+        command = " & ".join(f"({start_command(kind, self.remote_dir, self.start, self.duration, **self.options)})" for kind in self.kinds)
+        (await self.d.pssh(self.hosts, f"{command}; wait")).check()
+        print(f"profiling {self.id}: {', '.join(self.kinds)} on {len(self.hosts)} hosts from {time.strftime('%H:%M:%S', time.localtime(self.start))}")
+
+    async def finish(self):
+        if self.duration:
+            await asyncio.sleep(max(self.start + self.duration - time.time(), 0))
+        self.end = time.time()
+        interrupt = not self.duration
+        command = " & ".join(f"({stop_command(kind, self.remote_dir, interrupt)})" for kind in self.kinds)
+        (await self.d.pssh(self.hosts, f"{command}; wait")).check()
+        exclude = [] if self.keep_raw else ["perf.data", "blktrace/*"]
+        await self.d.collect_archive(self.hosts, self.remote_dir, self.local_dir, exclude=exclude)
+        with open(f"{self.local_dir}/capture.json", "w") as f:
+            json.dump({"id": self.id, "phase": self.phase, "cs_options": self.cs_options, "kinds": self.kinds, "hosts": self.hosts,
+                       "start": self.start, "end": self.end}, f, indent=1)
+        self.results = await process_capture_dir(self.local_dir, title=self.phase or "")
+        if not self.keep_raw:
+            (await self.d.pssh(self.hosts, f"rm -rf {shlex.quote(self.remote_dir)}")).check()
+        return self.results
+
+    async def abort(self):
+        # Stops the profilers and removes their outputs, without collecting them.
+        command = " & ".join(f"({stop_command(kind, self.remote_dir, True)})" for kind in self.kinds)
+        (await self.d.pssh(self.hosts, f"{command}; wait; rm -rf {shlex.quote(self.remote_dir)}")).check()
+
+    async def run(self):
+        # A fixed window: starts, waits `duration` seconds and finishes.
+        await self.begin()
+        return await self.finish()
+
+    async def __aenter__(self):
+        await self.begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.finish()
+            return False
+        # The profiled phase failed: its error is the one which matters.
+        try:
+            await self.abort()
+        except Exception as e:
+            print(f"profiling {self.id}: stopping after a failure failed: {e!r}")
+        return False
+
+async def main():
+    results = await process_capture_dir(sys.argv[1], title=sys.argv[2] if len(sys.argv) > 2 else "")
+    for host, r in results.items():
+        print(host, r)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+import asyncio
+import http.client
+import json
+import time
+import urllib.parse
+from collections import namedtuple
+import numpy as np
+
+Series = namedtuple('Series', ['timestamps', 'values'])
+
+class PrometheusError(Exception):
+    pass
+
+def labels_key(metric):
+    return tuple(sorted(metric.items()))
+
+def to_series(data):
+    result_type, result = data["resultType"], data["result"]
+    if result_type in ("scalar", "string"):
+        return {(): Series(np.array([float(result[0])]), np.array([float(result[1])]))}
+    series = {}
+    for r in result:
+        samples = r["values"] if "values" in r else [r["value"]]
+        samples = np.array(samples, dtype=np.float64).reshape(-1, 2)
+        series[labels_key(r["metric"])] = Series(samples[:, 0], samples[:, 1])
+    return series
+
+# Several expressions are evaluated in one request by tagging each one's series with its
+# index in this label and joining them with "or". The expressions must return instant
+# vectors (wrap scalars with vector()).
+BATCH_LABEL = "__bench_batch"
+
+def batch_query(exprs):
+    return " or ".join(f'label_replace(({expr}), "{BATCH_LABEL}", "{i}", "", "")' for i, expr in enumerate(exprs))
+
+def split_batch(series, n):
+    # The results of batch_query's expressions, in order, without the index label.
+    results = [{} for _ in range(n)]
+    for labels, s in series.items():
+        labels = dict(labels)
+        index = labels.pop(BATCH_LABEL, None)
+        if index is not None:
+            results[int(index)][labels_key(labels)] = s
+    return results
+
+def scalar(series, default=None):
+    # The latest value of a single-series result, e.g. of sum(...) or max(...).
+    if not series:
+        return default
+    if len(series) > 1:
+        raise PrometheusError(f"Expected a single series, got {len(series)}")
+    return float(next(iter(series.values())).values[-1])
+
+class PrometheusClient:
+    def __init__(self, host, port, ttl=0.5, timeout=30):
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.timeout = timeout
+        self.conn = None
+        self.lock = asyncio.Lock()
+        self.cache = {}
+        self.requests = 0
+
+    def _request(self, path, params):
+        body = urllib.parse.urlencode(params)
+        headers = {"Content-Type": "application/x-www-form-urlencoded", "Connection": "keep-alive"}
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request("POST", path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                payload = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError, OSError):
+                # The kept-alive connection may have been closed by the server; reconnect once.
+                self.conn.close()
+                self.conn = None
+                if attempt == 1:
+                    raise
+        self.requests += 1
+        decoded = json.loads(payload.decode("utf-8"))
+        if decoded.get("status") != "success":
+            raise PrometheusError(f"{path} {params}: {decoded.get('errorType')}: {decoded.get('error')}")
+        return decoded
+
+    async def _call(self, path, params):
+        key = (path, tuple(sorted(params.items())))
+        now = time.monotonic()
+        cached = self.cache.get(key)
+        if cached is not None and (not cached[1].done() or cached[0] > now):
+            return await asyncio.shield(cached[1])
+        for k in [k for k, (expiry, f) in self.cache.items() if f.done() and expiry <= now]:
+            del self.cache[k]
+        future = asyncio.ensure_future(self._locked_request(path, params))
+        self.cache[key] = (now + self.ttl, future)
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            self.cache.pop(key, None)
+            raise
+
+    async def _locked_request(self, path, params):
+        async with self.lock:
+            result = await asyncio.to_thread(self._request, path, params)
+        # The TTL counts from when the answer arrived, not from when it was asked for.
+        key = (path, tuple(sorted(params.items())))
+        if key in self.cache:
+            self.cache[key] = (time.monotonic() + self.ttl, self.cache[key][1])
+        return result
+
+    async def query_raw(self, expr, time=None):
+        params = {"query": expr}
+        if time is not None:
+            params["time"] = str(time)
+        return await self._call("/api/v1/query", params)
+
+    async def query(self, expr, time=None):
+        return to_series((await self.query_raw(expr, time))["data"])
+
+    async def query_range(self, expr, start, end, step):
+        params = {"query": expr, "start": str(start), "end": str(end), "step": str(step)}
+        return to_series((await self._call("/api/v1/query_range", params))["data"])
+
+    async def query_many(self, exprs, time=None):
+        # One request for all expressions; returns their results in order.
+        if not exprs:
+            return []
+        return split_batch(await self.query(batch_query(exprs), time), len(exprs))
+
+    async def query_range_many(self, exprs, start, end, step):
+        if not exprs:
+            return []
+        return split_batch(await self.query_range(batch_query(exprs), start, end, step), len(exprs))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,49 @@
+import asyncio
+import importlib.util
+import os
+from bench.transport import wait_for_port
+
+def load_terraform_module():
+    path = os.path.join(os.path.dirname(__file__), "..", "prov", "terraform.py")
+    spec = importlib.util.spec_from_file_location("terraform", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+async def provision(deployment_name, terraform_plan, config, on_host=None, auto_approve=False, ssh_timeout=600):
+    # Runs prov/terraform.py's apply and, for every instance, awaits on_host(group, host, instance)
+    # as soon as the instance accepts SSH connections, while terraform is still creating the
+    # others. ssh_config is up to date for every host handed to on_host, but the inventory is only
+    # complete after provision() returns, so on_host should pass its host explicitly, e.g.
+    #
+    #     d = Deployment(name)
+    #     async def on_host(group, host, instance):
+    #         if group == "client":
+    #             await d.setup_clients([host])
+    #     await provision(name, "prov/ec2", config, on_host)
+    terraform = load_terraform_module()
+    loop = asyncio.get_running_loop()
+    tasks = []
+
+    async def setup(group, instance):
+        host = f"{group}-{instance['index']}"
+        await wait_for_port(instance["public_ip"], 22, timeout=ssh_timeout)
+        print(f"{host}: accepting SSH connections")
+        if on_host is not None:
+            await on_host(group, host, instance)
+
+    def on_instance(group, instance):
+        # Called from the thread running terraform.
+        loop.call_soon_threadsafe(lambda: tasks.append(asyncio.create_task(setup(group, instance))))
+
+    try:
+        instances = await asyncio.to_thread(terraform.apply, deployment_name, terraform_plan, config, on_instance, auto_approve)
+        # Let the callbacks scheduled by the last on_instance calls run.
+        await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return instances
@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+# Runs on the node for as long as we watch it and prints a line as soon as the
+# state changes, and once a second otherwise: "cql" once port 9042 is listening,
+# else the output of `systemctl is-active`.
+WATCH_SCRIPT = r'''
+prev=
+i=0
+while true; do
+    if grep -q "^[^:]*:9042" <(ss -tln); then
+        state=cql
+    else
+        state=$(systemctl is-active scylla-server)
+    fi
+    if [ "$state" != "$prev" ] || [ $((i % 5)) -eq 0 ]; then
+        echo "$state"
+        prev=$state
+    fi
+    i=$((i + 1))
+    sleep 0.2
+done
+'''
+
+class NodeFailed(Exception):
+    pass
+
+class NodeWatcher:
+    def __init__(self, deployment, host, script=WATCH_SCRIPT):
+        self.deployment = deployment
+        self.host = host
+        self.script = script
+        self.state = None
+        self.reported_at = None
+        self.history = []
+        self.task = None
+        self.changed = asyncio.Condition()
+
+    def ensure_started(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        try:
+            async for name, line in self.deployment.ssh_stream(self.host, self.script):
+                if name == "stdout":
+                    await self._set(line.decode("utf-8", errors="replace").strip())
+        finally:
+            await self._set(None)
+
+    async def _set(self, state):
+        async with self.changed:
+            if state != self.state:
+                self.history.append((time.time(), state))
+            self.state = state
+            self.reported_at = time.monotonic()
+            self.changed.notify_all()
+
+    async def wait_for(self, *states, fail_on=("failed",), reported_after=None):
+        # With reported_after (a time.monotonic() value), states reported
+        # before that moment are considered stale.
+        while True:
+            if self.task is not None and self.task.done():
+                # The watcher session ended (e.g. the node rebooted); back off before reconnecting.
+                await asyncio.sleep(1)
+            self.ensure_started()
+            async with self.changed:
+                fresh = reported_after is None or (self.reported_at is not None and self.reported_at > reported_after)
+                if fresh and self.state in states:
+                    return self.state
+                if fresh and self.state in fail_on:
+                    raise NodeFailed(f"{self.host}: scylla-server is {self.state}")
+                await self.changed.wait()
+
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+class ReadinessMonitor:
+    def __init__(self, deployment):
+        self.deployment = deployment
+        self.watchers = {}
+
+    def watcher(self, host):
+        if host not in self.watchers:
+            self.watchers[host] = NodeWatcher(self.deployment, host)
+        self.watchers[host].ensure_started()
+        return self.watchers[host]
+
+    async def wait_for_cql(self, host):
+        await self.watcher(host).wait_for("cql")
+
+    async def close(self):
+        await asyncio.gather(*(w.stop() for w in self.watchers.values()))
+
+async def start_node(deployment, host):
+    watcher = deployment.readiness.watcher(host)
+    start = time.monotonic()
+    _, stderr, returncode = await deployment.ssh(host, 'sudo systemctl start scylla-server', stderr=asyncio.subprocess.PIPE)
+    if returncode != 0:
+        raise NodeFailed(f"{host}: systemctl start failed: {stderr.decode('utf-8', errors='replace').strip()}")
+    # Skip reports that may have been sampled before the start, e.g. a stale "cql" right after a stop.
+    await watcher.wait_for("cql", reported_after=time.monotonic() + 0.2)
+    elapsed = time.monotonic() - start
+    print(f'{host}: CQL up after {elapsed:.1f}s')
+    return elapsed
+
+async def start_nodes(deployment, seeds, others, concurrency=1):
+    # Seeds are started first, one at a time. The remaining nodes are started
+    # with up to `concurrency` bootstraps in flight.
+    times = {}
+    for host in seeds:
+        times[host] = await start_node(deployment, host)
+    semaphore = asyncio.Semaphore(concurrency)
+    async def bootstrap(host):
+        async with semaphore:
+            times[host] = await start_node(deployment, host)
+    await asyncio.gather(*(bootstrap(host) for host in others))
+    return {host: times[host] for host in [*seeds, *others]}
@@ -0,0 +1,226 @@
+import json
+import sqlite3
+import time
+from collections import namedtuple
+import numpy as np
+from bench.hdr import NativeHdrLogProcessor, ProfileSummaryResult, format_profile_summary, input_hdr_files, parse_profile_summary
+from bench.hdrhistogram import HdrHistogram
+
+# A local store of run results: every run's merged per-tag histograms (in the
+# compressed HdrHistogram V2 encoding), its ProfileSummaryResult per tag, and
+# the config and cassandra-stress options it was run with, in one SQLite file.
+#
+# Summaries are plain columns, so listing and filtering hundreds of runs only
+# touches small rows; histograms are decoded only for comparisons.
+
+# Summary fields which are counts; the others are REAL.
+INTEGER_FIELDS = {"ops_count"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    created REAL NOT NULL,
+    config TEXT NOT NULL,
+    cs_options TEXT,
+    metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_name ON runs (name, created);
+CREATE TABLE IF NOT EXISTS summaries (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    tag TEXT NOT NULL,
+    {summary_columns},
+    PRIMARY KEY (run_id, tag)
+);
+CREATE TABLE IF NOT EXISTS histograms (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    tag TEXT NOT NULL,
+    start_time_ms INTEGER,
+    end_time_ms INTEGER,
+    data BLOB NOT NULL,
+    PRIMARY KEY (run_id, tag)
+);
+""".format(summary_columns=",\n    ".join(f"{field} {'INTEGER' if field in INTEGER_FIELDS else 'REAL'}" for field in ProfileSummaryResult._fields))
+
+def summary_result(values):
+    # Stores made before the count columns were INTEGER return them as floats.
+    return ProfileSummaryResult(*(int(v) if field in INTEGER_FIELDS and v is not None else v
+                                  for field, v in zip(ProfileSummaryResult._fields, values)))
+
+StoredRun = namedtuple('StoredRun', ['id', 'name', 'created', 'config', 'cs_options', 'metadata'])
+
+# Latencies in ms. [low, high] is the bootstrap confidence interval of candidate - baseline;
+# the difference is significant when the interval doesn't contain 0.
+PercentileDelta = namedtuple('PercentileDelta', ['percentile', 'baseline_ms', 'candidate_ms', 'delta_ms', 'low_ms', 'high_ms',
+                                                 'relative', 'significant'])
+
+COMPARE_PERCENTILES = [50, 90, 99, 99.9]
+
+def merge_hdr_files(dir, name, time_start=None, time_end=None):
+    # Merged per-tag histograms of the {name}.hdr logs under dir, like process_hdr_file_set does.
+    p = NativeHdrLogProcessor(time_start=time_start, time_end=time_end, write_merged_log=False)
+    return p.merge(input_hdr_files(dir, name))
+
+def summarize(histograms):
+    return parse_profile_summary(format_profile_summary(histograms).splitlines()) if histograms else {}
+
+class ResultStore:
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_run(self, name, histograms, summary=None, config=None, cs_options=None, metadata=None, created=None):
+        # histograms: {tag: HdrHistogram}. The summary is computed from them unless given.
+        if summary is None:
+            summary = summarize(histograms)
+        with self.db:
+            run_id = self.db.execute("INSERT INTO runs (name, created, config, cs_options, metadata) VALUES (?, ?, ?, ?, ?)",
+                                     (name, created or time.time(), json.dumps(config or {}, sort_keys=True), cs_options,
+                                      json.dumps(metadata or {}))).lastrowid
+            self.db.executemany(f"INSERT INTO summaries VALUES (?, ?, {', '.join('?' * len(ProfileSummaryResult._fields))})",
+                                [(run_id, tag, *s) for tag, s in summary.items()])
+            self.db.executemany("INSERT INTO histograms VALUES (?, ?, ?, ?, ?)",
+                                [(run_id, tag, h.start_time_ms, h.end_time_ms, h.encode()) for tag, h in histograms.items()])
+        return run_id
+
+    def add_hdr_files(self, name, dir, hdr_name, time_start=None, time_end=None, **kwargs):
+        return self.add_run(name, merge_hdr_files(dir, hdr_name, time_start, time_end), **kwargs)
+
+    def delete_run(self, run_id):
+        with self.db:
+            self.db.execute("DELETE FROM runs WHERE id = ?", (run_id,))
+
+    def runs(self, name=None, since=None, until=None, **config):
+        # Runs, oldest first. name may be a GLOB pattern; keyword arguments match top-level config values.
+        where, params = [], []
+        if name is not None:
+            where.append("name GLOB ?")
+            params.append(name)
+        if since is not None:
+            where.append("created >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("created < ?")
+            params.append(until)
+        for key, value in config.items():
+            where.append("json_extract(config, ?) = json_extract(?, '$')")
+            params += [f"$.{key}", json.dumps(value)]
+        rows = self.db.execute(f"SELECT * FROM runs {'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY created, id", params)
+        return [StoredRun(id, name, created, json.loads(config), cs_options, json.loads(metadata))
+                for id, name, created, config, cs_options, metadata in rows]
+
+    def summary(self, run_id):
+        rows = self.db.execute("SELECT * FROM summaries WHERE run_id = ?", (run_id,))
+        return {tag: summary_result(values) for _, tag, *values in rows}
+
+    def summaries(self, run_ids, tag):
+        # {run_id: ProfileSummaryResult} of one tag, for trends over many runs.
+        run_ids = list(run_ids)
+        rows = self.db.execute(f"SELECT * FROM summaries WHERE tag = ? AND run_id IN ({', '.join('?' * len(run_ids))})", (tag, *run_ids))
+        return {run_id: summary_result(values) for run_id, _, *values in rows}
+
+    def histograms(self, run_id, tags=None):
+        rows = self.db.execute("SELECT tag, start_time_ms, end_time_ms, data FROM histograms WHERE run_id = ?", (run_id,))
+        result = {}
+        for tag, start_time_ms, end_time_ms, data in rows:
+            if tags is not None and tag not in tags:
+                continue
+            h = HdrHistogram.decode(data)
+            h.tag, h.start_time_ms, h.end_time_ms = tag, start_time_ms, end_time_ms
+            result[tag] = h
+        return result
+
+    def compare(self, baseline, candidate, tags=None, percentiles=COMPARE_PERCENTILES, n_boot=1000, confidence=0.95, seed=None):
+        # baseline and candidate are run ids or lists of run ids (repeats of the same setup).
+        # Returns {tag: [PercentileDelta]} for the tags both sides have.
+        baseline = [baseline] if isinstance(baseline, int) else list(baseline)
+        candidate = [candidate] if isinstance(candidate, int) else list(candidate)
+        sides = [[self.histograms(run_id, tags) for run_id in side] for side in (baseline, candidate)]
+        common = set.intersection(*(set(h) for side in sides for h in side))
+        rng = np.random.default_rng(seed)
+        return {tag: compare_histograms([h[tag] for h in sides[0]], [h[tag] for h in sides[1]], percentiles, n_boot, confidence, rng)
+                for tag in sorted(common)}
+
+def common_layout(histograms):
+    # Counts of all histograms on the layout of the first one, as one (runs, buckets) matrix.
+    first = histograms[0]
+    aligned = []
+    for h in histograms:
+        if h.layout() != first.layout():
+            converted = HdrHistogram(first.lowest_trackable_value, first.highest_trackable_value, first.significant_digits)
+            converted.add(h)
+            h = converted
+        aligned.append(h.counts)
+    length = max(len(c) for c in aligned)
+    counts = np.zeros((len(aligned), length), dtype=np.int64)
+    for i, c in enumerate(aligned):
+        counts[i, :len(c)] = c
+    return first, counts
+
+def bootstrap_percentiles(histograms, percentiles, n_boot, rng):
+    # Two-level bootstrap: runs are resampled with replacement (run-to-run noise), then the
+    # operations of the chosen runs (sampling noise). Returns (point estimates, (n_boot, len(percentiles))) in ns.
+    #
+    # Resampling millions of operations isn't needed: the k-th smallest of n resampled values
+    # is F^-1(U) of the pooled distribution F, where U ~ Beta(k, n - k + 1) is the k-th smallest of
+    # n uniform values. So each percentile of each resample costs one Beta draw.
+    layout, counts = common_layout(histograms)
+    if counts.sum() == 0:
+        return np.zeros(len(percentiles)), np.zeros((n_boot, len(percentiles)))
+    nonzero = np.flatnonzero(counts.sum(axis=0))
+    counts = counts[:, nonzero]
+    highest = layout.value_from_index(nonzero) + layout.equivalent_range_from_index(nonzero) - 1
+    percentiles = np.asarray(percentiles, dtype=np.float64)
+
+    def ranks(totals):
+        # Same rounding as HdrHistogram.values_at_percentiles.
+        return np.maximum(((percentiles / 100.0) * totals[:, None] + 0.5).astype(np.int64), 1)
+
+    def values(cumulative, positions):
+        # Values of the buckets at the given positions of the cumulative counts.
+        return highest[np.minimum(np.searchsorted(cumulative, positions), len(nonzero) - 1)]
+
+    pooled = counts.sum(axis=0)
+    point = values(np.cumsum(pooled), ranks(pooled.sum(keepdims=True))[0])
+
+    picks = rng.integers(len(histograms), size=(n_boot, len(histograms)))
+    weights = np.zeros((n_boot, len(histograms)), dtype=np.int64)
+    np.add.at(weights, (np.arange(n_boot)[:, None], picks), 1)
+    # Few runs give few distinct combinations, and only those are pooled.
+    combinations, which = np.unique(weights, axis=0, return_inverse=True)
+    which = which.ravel()
+    cumulative = np.cumsum(combinations @ counts, axis=1)
+    totals = cumulative[:, -1]
+    k = ranks(totals)
+    u = rng.beta(k[which], (totals[:, None] - k + 1)[which])
+    samples = np.empty(u.shape, dtype=np.int64)
+    for i in range(len(combinations)):
+        rows = which == i
+        samples[rows] = values(cumulative[i], u[rows] * totals[i])
+    return point, samples
+
+def compare_histograms(baseline, candidate, percentiles=COMPARE_PERCENTILES, n_boot=1000, confidence=0.95, rng=None):
+    rng = rng or np.random.default_rng()
+    b_point, b_boot = bootstrap_percentiles(baseline, percentiles, n_boot, rng)
+    c_point, c_boot = bootstrap_percentiles(candidate, percentiles, n_boot, rng)
+    deltas = (c_boot - b_boot) / 1e6
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(deltas, [alpha, 1 - alpha], axis=0)
+    result = []
+    for i, p in enumerate(percentiles):
+        b, c = float(b_point[i]) / 1e6, float(c_point[i]) / 1e6
+        result.append(PercentileDelta(p, b, c, c - b, float(low[i]), float(high[i]), (c - b) / b if b else float("nan"),
+                                      bool(low[i] > 0 or high[i] < 0)))
+    return result
@@ -0,0 +1,228 @@
+import asyncio
+import os
+import shlex
+import sys
+from collections import namedtuple
+import numpy as np
+from bench.telemetry import parse_cs_interval
+
+# Detection of client-bound runs: a cassandra-stress client whose CPU, network
+# or JVM is saturated caps the throughput it reports, and the result says more
+# about the client than about Scylla.
+#
+# While a load runs, every client streams snapshots of /proc/stat and
+# /proc/net/dev over one long-lived session (a shell loop, no agent). GC pauses
+# come from the gc columns of the cassandra-stress interval lines. The raw
+# snapshots are recorded as text, one file per client, and all the analysis
+# works on such recordings:
+#
+#     @ <unix time>           starts a snapshot, followed by the cpu lines of
+#                             /proc/stat and the interface lines of /proc/net/dev
+#     speed <iface> <Mb/s>    link speeds, from /sys/class/net, once at the start
+#     gc <s> <#> <max ms> <sum ms>   one cassandra-stress interval (seconds since its start)
+#
+# `python -m bench.saturation <dir>` judges the {host}.proc recordings in a directory.
+
+SAMPLER_SCRIPT = """
+for f in /sys/class/net/*/speed; do echo "speed $(basename $(dirname $f)) $(cat $f 2>/dev/null)"; done
+while :; do echo "@ $(date +%s.%N)"; grep ^cpu /proc/stat; tail -n +3 /proc/net/dev; sleep {interval}; done
+"""
+
+Snapshot = namedtuple('Snapshot', ['time', 'cpu', 'net'])
+# cpu: busy fraction of all CPUs, cpu_max: of the busiest CPU, steal: stolen fraction;
+# network totals over all interfaces but lo, in Gbit/s and packets/s.
+ClientSample = namedtuple('ClientSample', ['time', 'cpu', 'cpu_max', 'steal', 'rx_gbps', 'tx_gbps', 'rx_pps', 'tx_pps'])
+# time is seconds since the start of cassandra-stress; fraction is the share of the interval spent in GC.
+GcSample = namedtuple('GcSample', ['time', 'count', 'max_ms', 'sum_ms', 'fraction'])
+
+# A client is bound when a threshold is crossed in at least `sustained` of its samples.
+# net is a fraction of the link speed; net_gbps overrides the link speed, which virtual
+# NICs often don't report (EC2 instances also have a lower sustained than burst bandwidth).
+SaturationThresholds = namedtuple('SaturationThresholds', ['cpu', 'steal', 'net', 'net_gbps', 'gc_fraction', 'gc_max_ms', 'sustained'],
+                                  defaults=[0.9, 0.1, 0.9, None, 0.1, 1000.0, 0.2])
+
+class ClientVerdict(namedtuple('ClientVerdict', ['host', 'client_bound', 'reasons', 'samples', 'cpu_p90', 'steal_mean',
+                                                 'net_gbps_p90', 'gc_fraction_max', 'gc_max_ms'])):
+    def __str__(self):
+        verdict = f"CLIENT-BOUND ({'; '.join(self.reasons)})" if self.client_bound else "ok"
+        return (f"{self.host}: {verdict}: cpu p90={self.cpu_p90:.0%} steal={self.steal_mean:.0%} "
+                f"net p90={self.net_gbps_p90:.2f}Gbit/s gc max={self.gc_fraction_max:.0%}/{self.gc_max_ms:.0f}ms")
+
+class SaturationReport:
+    def __init__(self, verdicts, samples, gc):
+        self.verdicts = verdicts
+        self.samples = samples
+        self.gc = gc
+
+    @property
+    def client_bound(self):
+        return any(v.client_bound for v in self.verdicts.values())
+
+    @property
+    def bound_hosts(self):
+        return [host for host, v in self.verdicts.items() if v.client_bound]
+
+    def __str__(self):
+        return "\n".join(str(v) for v in self.verdicts.values())
+
+def parse_recording(lines):
+    # -> (link speeds in Mb/s, [Snapshot], [GcSample]). Incomplete trailing snapshots are dropped.
+    speeds = {}
+    snapshots = []
+    gc = []
+    current = None
+    def flush():
+        if current is not None and current.cpu and current.net:
+            snapshots.append(current)
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == "@":
+            flush()
+            current = Snapshot(float(fields[1]), {}, {})
+        elif fields[0] == "speed":
+            if len(fields) == 3 and fields[2].lstrip("-").isdigit() and int(fields[2]) > 0:
+                speeds[fields[1]] = int(fields[2])
+        elif fields[0] == "gc":
+            t, count, max_ms, sum_ms = map(float, fields[1:5])
+            previous = gc[-1].time if gc else 0.0
+            gc.append(GcSample(t, count, max_ms, sum_ms, sum_ms / 1000 / (t - previous) if t > previous else 0.0))
+        elif current is None:
+            continue
+        elif fields[0].startswith("cpu"):
+            current.cpu[fields[0]] = [int(x) for x in fields[1:9]]
+        elif ":" in line:
+            iface, _, counters = line.partition(":")
+            counters = counters.split()
+            if iface.strip() != "lo" and len(counters) >= 10:
+                # rx bytes, rx packets, tx bytes, tx packets
+                current.net[iface.strip()] = (int(counters[0]), int(counters[1]), int(counters[8]), int(counters[9]))
+    flush()
+    return speeds, snapshots, gc
+
+def cpu_busy(before, after):
+    # /proc/stat: user nice system idle iowait irq softirq steal (guest time is included in user).
+    delta = np.subtract(after, before)
+    total = delta.sum()
+    if total <= 0:
+        return 0.0, 0.0
+    return float((total - delta[3] - delta[4]) / total), float(delta[7] / total)
+
+def client_samples(snapshots):
+    samples = []
+    for before, after in zip(snapshots, snapshots[1:]):
+        seconds = after.time - before.time
+        if seconds <= 0:
+            continue
+        cpu, steal = cpu_busy(before.cpu["cpu"], after.cpu["cpu"])
+        cores = [cpu_busy(before.cpu[name], after.cpu[name])[0] for name in after.cpu if name != "cpu" and name in before.cpu]
+        net = np.zeros(4)
+        for iface, counters in after.net.items():
+            if iface in before.net:
+                # Counters are reset when an interface goes down and up.
+                net += np.maximum(np.subtract(counters, before.net[iface]), 0)
+        rx_bytes, rx_packets, tx_bytes, tx_packets = (float(x) for x in net / seconds)
+        samples.append(ClientSample(after.time, cpu, max(cores, default=cpu), steal, rx_bytes * 8 / 1e9, tx_bytes * 8 / 1e9,
+                                    rx_packets, tx_packets))
+    return samples
+
+def judge(host, samples, gc, speeds=None, thresholds=SaturationThresholds()):
+    reasons = []
+    def sustained(values, limit):
+        return len(values) > 0 and np.mean(np.asarray(values) >= limit) >= thresholds.sustained
+
+    cpu = [s.cpu for s in samples]
+    steal = [s.steal for s in samples]
+    # Links are full duplex, so each direction is checked against the link speed.
+    net = [max(s.rx_gbps, s.tx_gbps) for s in samples]
+    if sustained(cpu, thresholds.cpu):
+        reasons.append(f"cpu >= {thresholds.cpu:.0%}")
+    if sustained(steal, thresholds.steal):
+        reasons.append(f"steal >= {thresholds.steal:.0%}")
+    link_gbps = thresholds.net_gbps or (max(speeds.values()) / 1000 if speeds else None)
+    if link_gbps and sustained(net, thresholds.net * link_gbps):
+        reasons.append(f"network >= {thresholds.net:.0%} of {link_gbps:g}Gbit/s")
+    gc_fraction = [g.fraction for g in gc]
+    if sustained(gc_fraction, thresholds.gc_fraction):
+        reasons.append(f"gc >= {thresholds.gc_fraction:.0%} of the time")
+    gc_max_ms = max((g.max_ms for g in gc), default=0.0)
+    if gc_max_ms >= thresholds.gc_max_ms:
+        reasons.append(f"gc pause of {gc_max_ms:.0f}ms")
+    return ClientVerdict(host, bool(reasons), reasons, len(samples),
+                         float(np.percentile(cpu, 90)) if cpu else 0.0, float(np.mean(steal)) if steal else 0.0,
+                         float(np.percentile(net, 90)) if net else 0.0, max(gc_fraction, default=0.0), gc_max_ms)
+
+def analyze_recordings(recordings, thresholds=SaturationThresholds()):
+    # recordings: {host: lines}
+    verdicts, samples, gc = {}, {}, {}
+    for host, lines in recordings.items():
+        speeds, snapshots, gc[host] = parse_recording(lines)
+        samples[host] = client_samples(snapshots)
+        verdicts[host] = judge(host, samples[host], gc[host], speeds, thresholds)
+    return SaturationReport(verdicts, samples, gc)
+
+def read_recordings(dir):
+    recordings = {}
+    for name in sorted(os.listdir(dir)):
+        if name.endswith(".proc"):
+            with open(os.path.join(dir, name)) as f:
+                recordings[name[:-len(".proc")]] = f.read().splitlines()
+    return recordings
+
+class ClientSampler:
+    # Samples the clients while a load runs; see Deployment.cs(saturation=...) and populate().
+    # With dest_dir, the recordings are written to {dest_dir}/{host}.proc.
+    def __init__(self, deployment, interval=1.0, thresholds=SaturationThresholds(), dest_dir=None):
+        self.d = deployment
+        self.interval = interval
+        self.thresholds = thresholds
+        self.dest_dir = dest_dir
+        self.lines = {}
+        self.tasks = []
+        self.report = None
+
+    async def follow(self, host):
+        command = f"exec bash -c {shlex.quote(SAMPLER_SCRIPT.format(interval=self.interval))}"
+        async for name, line in self.d.ssh_stream(host, command):
+            if name == "stdout":
+                self.lines[host].append(line.decode("utf-8", errors="replace").rstrip("\n"))
+
+    def start(self, hosts):
+        self.report = None
+        self.lines = {host: [] for host in hosts}
+        self.tasks = [asyncio.create_task(self.follow(host)) for host in hosts]
+
+    async def watch(self, host, stream):
+        # Passes a cassandra-stress output stream through, recording the GC columns of its total lines.
+        async for name, line in stream:
+            if name == "stdout" and host in self.lines:
+                interval = parse_cs_interval(line)
+                if interval is not None and interval.tag == "total":
+                    self.lines[host].append(f"gc {interval.time} {interval.gc_count} {interval.gc_max_ms} {interval.gc_sum_ms}")
+            yield name, line
+
+    async def stop(self):
+        # Takes a last snapshot, so that the end of the load is covered.
+        await asyncio.sleep(self.interval)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.dest_dir is not None:
+            os.makedirs(self.dest_dir, exist_ok=True)
+            for host, lines in self.lines.items():
+                with open(f"{self.dest_dir}/{host}.proc", "w") as f:
+                    f.writelines(f"{line}\n" for line in lines)
+        self.report = analyze_recordings(self.lines, self.thresholds)
+        return self.report
+
+def main():
+    report = analyze_recordings(read_recordings(sys.argv[1]))
+    print(report)
+    sys.exit(1 if report.client_bound else 0)
+
+if __name__ == "__main__":
+    main()
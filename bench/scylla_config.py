@@ -0,0 +1,208 @@
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import yaml
+from collections import namedtuple
+from bench.readiness import start_node
+
+# Declarative node configuration: /etc/scylla/scylla.yaml plus files in
+# /etc/scylla.d (io_properties.yaml, io.conf, cpuset.conf, ...).
+#
+# The last-known scylla.yaml of every node is cached in
+# {deployment}/scylla-config.json along with its sha256. Planning costs one
+# round trip per node, which returns the sha256 of the remote files and whether
+# scylla-server is running; scylla.yaml is only read again when its hash
+# changed. Only the nodes whose config actually changes are written, and
+# every change is classified:
+#   reload   - only live-updatable scylla.yaml options changed; SIGHUP applies them
+#   restart  - anything else, including every /etc/scylla.d file
+#   push     - the node isn't running, so writing the files is enough
+# apply() writes the files, reloads in parallel and restarts one node at a
+# time (rolling), waiting for CQL before the next one.
+
+SCYLLA_YAML = "/etc/scylla/scylla.yaml"
+SCYLLA_D = "/etc/scylla.d"
+# Marks the scylla-server state line in the output of remote_state's command.
+STATE_MARKER = "@scylla-server"
+
+# scylla.yaml options Scylla reloads on SIGHUP (liveness::LiveUpdate in db/config.cc).
+# Options which are not listed are assumed to need a restart.
+LIVE_UPDATABLE = frozenset([
+    "compaction_static_shares", "compaction_enforce_min_threshold", "compaction_throughput_mb_per_sec",
+    "stream_io_throughput_mb_per_sec", "memtable_flush_static_shares",
+    "read_request_timeout_in_ms", "write_request_timeout_in_ms", "counter_write_request_timeout_in_ms",
+    "cas_contention_timeout_in_ms", "range_request_timeout_in_ms", "truncate_request_timeout_in_ms",
+    "request_timeout_in_ms", "max_concurrent_requests_per_shard",
+    "reader_concurrency_semaphore_serialize_limit_multiplier", "reader_concurrency_semaphore_kill_limit_multiplier",
+    "reader_concurrency_semaphore_cpu_concurrency", "tombstone_warn_threshold", "query_tombstone_page_limit",
+    "view_flow_control_delay_limit_in_ms", "hinted_handoff_throttle_in_kb", "max_hint_window_in_ms",
+    "enable_compacting_data_for_streaming_and_repair", "repair_multishard_reader_buffer_hint_size",
+    "tablet_load_stats_refresh_interval_in_seconds", "index_cache_fraction", "user_defined_function_time_limit_ms",
+])
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def load_yaml(data):
+    return yaml.load(data, Loader=yaml.SafeLoader)
+
+def dump_yaml(config):
+    return yaml.dump(config, Dumper=yaml.SafeDumper).encode("utf-8")
+
+def scylla_d_files(paths):
+    # {name in /etc/scylla.d: local path} -> {name: contents}
+    files = {}
+    for name, path in paths.items():
+        with open(path, "rb") as f:
+            files[name] = f.read()
+    return files
+
+def diff_config(old, new):
+    # Top-level options only: {option: (old, new)}, with None for a missing option.
+    return {k: (old.get(k), new.get(k)) for k in sorted(set(old) | set(new)) if old.get(k) != new.get(k)}
+
+class NodePlan(namedtuple('NodePlan', ['host', 'action', 'options', 'files', 'config', 'file_data'])):
+    # options: {option: (old, new)}; files: names of the /etc/scylla.d files to write.
+    # config is the scylla.yaml to write (None if it doesn't change).
+    @property
+    def restart_options(self):
+        return [k for k in self.options if k not in LIVE_UPDATABLE]
+
+    def __str__(self):
+        parts = [f"{k}: {old!r} -> {new!r}{'' if k in LIVE_UPDATABLE else ' (restart)'}" for k, (old, new) in self.options.items()]
+        parts += [f"{SCYLLA_D}/{name} (restart)" for name in self.files]
+        return f"{self.host}: {self.action}" + "".join(f"\n    {p}" for p in parts)
+
+class ConfigPlan:
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def __getitem__(self, host):
+        return self.nodes[host]
+
+    def hosts(self, action):
+        return [host for host, node in self.nodes.items() if node.action == action]
+
+    @property
+    def changed(self):
+        return any(node.action != "none" for node in self.nodes.values())
+
+    def __str__(self):
+        unchanged = self.hosts("none")
+        lines = [str(node) for node in self.nodes.values() if node.action != "none"]
+        if unchanged:
+            lines.append(f"unchanged: {', '.join(unchanged)}")
+        return "\n".join(lines)
+
+class ScyllaConfigError(Exception):
+    def __init__(self, host, message):
+        self.host = host
+        super().__init__(f"{host}: {message}")
+
+class ScyllaConfig:
+    def __init__(self, deployment, cache_path=None):
+        self.d = deployment
+        self.cache_path = cache_path or f"{deployment.name}/scylla-config.json"
+        self.cache = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                self.cache = json.load(f)
+
+    def save_cache(self):
+        tmp = f"{self.cache_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp, self.cache_path)
+
+    async def remote_state(self, host):
+        # {"yaml_sha256", "config", "files": {name: sha256}, "active"}; the config comes from the
+        # cache when the remote scylla.yaml has the cached hash.
+        out = await self.d.ssh_output(host, f"sudo sha256sum {SCYLLA_YAML} {SCYLLA_D}/* 2>/dev/null; "
+                                            f"echo {STATE_MARKER} $(systemctl is-active scylla-server)")
+        hashes = {}
+        state = None
+        for line in out.decode().splitlines():
+            fields = line.split(maxsplit=1)
+            if fields and fields[0] == STATE_MARKER:
+                state = fields[1].strip() if len(fields) > 1 else ""
+            elif len(fields) == 2:
+                hashes[fields[1]] = fields[0]
+        if state is None:
+            raise ScyllaConfigError(host, "no scylla-server state in the output")
+        if SCYLLA_YAML not in hashes:
+            raise ScyllaConfigError(host, f"can't read {SCYLLA_YAML}")
+        yaml_sha256 = hashes.pop(SCYLLA_YAML)
+        cached = self.cache.get(host)
+        if cached is not None and cached["sha256"] == yaml_sha256:
+            config = cached["config"]
+        else:
+            data = await self.d.ssh_output(host, f"sudo cat {SCYLLA_YAML}")
+            config = load_yaml(data)
+            self.cache[host] = {"sha256": sha256(data), "config": config}
+        files = {os.path.basename(path): digest for path, digest in hashes.items()}
+        return {"yaml_sha256": yaml_sha256, "config": config, "files": files, "active": state == "active"}
+
+    async def plan(self, desired_config, files=None, hosts=None):
+        # desired_config(host, config) returns the wanted scylla.yaml given the current one.
+        # files: {name: bytes} for /etc/scylla.d, the same on every node.
+        hosts = list(hosts or self.d.server_hosts)
+        files = {name: data.encode("utf-8") if isinstance(data, str) else data for name, data in (files or {}).items()}
+        states = await asyncio.gather(*(self.remote_state(host) for host in hosts))
+        self.save_cache()
+        nodes = {}
+        for host, state in zip(hosts, states):
+            config = desired_config(host, copy.deepcopy(state["config"]))
+            options = diff_config(state["config"], config)
+            changed_files = [name for name, data in files.items() if state["files"].get(name) != sha256(data)]
+            if not options and not changed_files:
+                action = "none"
+            elif not state["active"]:
+                action = "push"
+            elif changed_files or any(k not in LIVE_UPDATABLE for k in options):
+                action = "restart"
+            else:
+                action = "reload"
+            nodes[host] = NodePlan(host, action, options, changed_files, config if options else None,
+                                   {name: files[name] for name in changed_files})
+        return ConfigPlan(nodes)
+
+    async def push(self, node):
+        if node.config is not None:
+            data = dump_yaml(node.config)
+            command = f"sudo tee {SCYLLA_YAML} >/dev/null"
+            _, _, returncode = await self.d.ssh(node.host, command, stdin_data=data)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, command)
+            self.cache[node.host] = {"sha256": sha256(data), "config": node.config}
+        for name, data in node.file_data.items():
+            command = f"sudo mkdir -p {SCYLLA_D} && sudo tee {shlex.quote(f'{SCYLLA_D}/{name}')} >/dev/null"
+            _, _, returncode = await self.d.ssh(node.host, command, stdin_data=data)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, command)
+
+    async def restart(self, host):
+        (await self.d.pssh([host], "sudo systemctl stop scylla-server")).check()
+        await start_node(self.d, host)
+
+    async def apply(self, plan, restart=True):
+        # Without restart, nodes which need one only get their files written.
+        changed = [node for node in plan.nodes.values() if node.action != "none"]
+        try:
+            await asyncio.gather(*(self.push(node) for node in changed))
+        finally:
+            self.save_cache()
+        reload = plan.hosts("reload")
+        if reload:
+            (await self.d.pssh(reload, "sudo pkill -SIGHUP scylla", ok_codes=(0, 1))).check()
+        needs_restart = plan.hosts("restart")
+        if not restart:
+            for host in needs_restart:
+                print(f"{host}: restart scylla-server to apply {', '.join(plan[host].restart_options + plan[host].files)}")
+            return plan
+        for host in needs_restart:
+            await self.restart(host)
+        return plan
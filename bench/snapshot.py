@@ -0,0 +1,338 @@
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Snapshot/restore of a directory tree (the nodes' /var/lib/scylla) into named
+# snapshots with a manifest of sizes, mtimes and hashes.
+#
+# This module is also a script which is run on the nodes themselves, by
+# piping its source into `sudo python3 - <command> ...`, so it must only use
+# the standard library.
+#
+# Files are copied in parallel, one task per directory (i.e. per table for
+# the data directory), with FICLONE reflinks where the filesystem supports
+# them and a regular copy otherwise. The stats say how many bytes were
+# reflinked and how many were copied. Restore skips files which are already
+# identical to the ones in the snapshot.
+#
+# Hashing reads every byte, which would make a reflinked snapshot as expensive
+# as a full copy, so snapshots record hashes only when asked to (--hash).
+# Without them, a verifying restore hashes both the live file and the
+# snapshot's copy.
+#
+# Backups made before named snapshots were copies of /var/lib/scylla's entries
+# straight into the backup directory; migrate_legacy() moves such a backup
+# into the "default" snapshot and writes its manifest.
+
+FICLONE = 0x40049409
+MANIFEST = "manifest.json"
+HASH_CHUNK = 1 << 20
+
+class Stats:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.reflinked_bytes = 0
+        self.copied_bytes = 0
+        self.linked_files = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.removed_files = 0
+
+    def add(self, other):
+        for k, v in vars(other).items():
+            setattr(self, k, getattr(self, k) + v)
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+def copy_file(src, dst, stats):
+    # Reflink if possible, otherwise copy the data. Ownership, mode and times are preserved like with cp -a.
+    st = os.lstat(src)
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            stats.reflinked_bytes += st.st_size
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF):
+                raise
+            shutil.copyfileobj(fsrc, fdst, HASH_CHUNK)
+            stats.copied_bytes += st.st_size
+    copy_metadata(src, dst, st)
+    stats.files += 1
+    stats.bytes += st.st_size
+
+def copy_metadata(src, dst, st=None):
+    st = st or os.lstat(src)
+    os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+class HardLinks:
+    # Files with several links (e.g. in Scylla's own snapshots directories) are
+    # copied once and linked to the copy afterwards, like cp -a does.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.copies = {}
+
+    def copy(self, src, dst, stats):
+        st = os.lstat(src)
+        key = (st.st_dev, st.st_ino)
+        if st.st_nlink > 1:
+            with self.lock:
+                first = self.copies.get(key)
+            if first is not None:
+                os.link(first, dst)
+                stats.linked_files += 1
+                return
+        copy_file(src, dst, stats)
+        if st.st_nlink > 1:
+            with self.lock:
+                self.copies.setdefault(key, dst)
+
+def copy_entry(src, dst, stats, links):
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        copy_metadata(src, dst)
+    else:
+        links.copy(src, dst, stats)
+
+def scan(root, exclude=()):
+    # Directories (parents first) and the regular files and symlinks under root, as paths relative to it.
+    dirs, files = [], []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        if rel == ".":
+            dirnames[:] = sorted(d for d in dirnames if d not in exclude)
+            filenames = [f for f in filenames if f not in exclude]
+        else:
+            dirs.append(rel)
+        for name in dirnames:
+            if os.path.islink(os.path.join(dirpath, name)):
+                files.append(os.path.normpath(os.path.join(rel, name)))
+        files.extend(os.path.normpath(os.path.join(rel, name)) for name in filenames)
+    return dirs, files
+
+def by_directory(files):
+    groups = {}
+    for f in files:
+        groups.setdefault(os.path.dirname(f), []).append(f)
+    return list(groups.values())
+
+def parallel(fn, groups, jobs):
+    # Runs fn(group, stats) for every group and returns the summed stats.
+    total = Stats()
+    def run(group):
+        stats = Stats()
+        fn(group, stats)
+        return stats
+    with ThreadPoolExecutor(jobs) as pool:
+        for stats in pool.map(run, groups):
+            total.add(stats)
+    return total
+
+def snapshot(root, snapshot_dir, exclude=(), jobs=None, hash=False):
+    start = time.monotonic()
+    tmp = f"{snapshot_dir}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    dirs, files = scan(root, exclude)
+    for d in dirs:
+        os.mkdir(os.path.join(tmp, d))
+    manifest = {}
+    links = HardLinks()
+    def copy_group(group, stats):
+        for f in group:
+            src = os.path.join(root, f)
+            copy_entry(src, os.path.join(tmp, f), stats, links)
+            st = os.lstat(src)
+            if stat.S_ISREG(st.st_mode):
+                manifest[f] = [st.st_size, st.st_mtime_ns, file_hash(src) if hash else None]
+    stats = parallel(copy_group, by_directory(files), jobs)
+    for d in reversed(dirs):
+        copy_metadata(os.path.join(root, d), os.path.join(tmp, d))
+    with open(os.path.join(tmp, MANIFEST), "w") as f:
+        json.dump({"dirs": dirs, "files": manifest, "created": time.time()}, f)
+    old = f"{snapshot_dir}.old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(snapshot_dir):
+        os.rename(snapshot_dir, old)
+    os.rename(tmp, snapshot_dir)
+    shutil.rmtree(old, ignore_errors=True)
+    return result(stats, start)
+
+def load_manifest(snapshot_dir):
+    with open(os.path.join(snapshot_dir, MANIFEST)) as f:
+        return json.load(f)
+
+def identical(path, entry, verify, snapshot_path=None):
+    # With verify, the contents are compared too: against the manifest's hash, or if it has
+    # none, against the hash of snapshot_path.
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    size, mtime_ns, digest = entry
+    if not stat.S_ISREG(st.st_mode) or st.st_size != size or st.st_mtime_ns != mtime_ns:
+        return False
+    if not verify:
+        return True
+    if digest is None:
+        if snapshot_path is None:
+            return True
+        digest = file_hash(snapshot_path)
+    return file_hash(path) == digest
+
+def restore(snapshot_dir, root, exclude=(), jobs=None, verify=False):
+    # Makes root identical to the snapshot. Files whose size and mtime (and with
+    # verify, hash) match the manifest are left alone; everything else is replaced or removed.
+    start = time.monotonic()
+    manifest = load_manifest(snapshot_dir)
+    wanted_dirs = set(manifest["dirs"])
+    _, snapshot_files = scan(snapshot_dir, exclude=(MANIFEST,))
+    wanted = set(snapshot_files)
+    live_dirs, live_files = scan(root, exclude)
+    removed = Stats()
+    for f in live_files:
+        if f not in wanted:
+            os.remove(os.path.join(root, f))
+            removed.removed_files += 1
+    for d in reversed(live_dirs):
+        path = os.path.join(root, d)
+        if d not in wanted_dirs and not os.path.islink(path):
+            shutil.rmtree(path)
+    for d in manifest["dirs"]:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    links = HardLinks()
+    def restore_group(group, stats):
+        for f in group:
+            src, dst = os.path.join(snapshot_dir, f), os.path.join(root, f)
+            entry = manifest["files"].get(f)
+            if entry is not None and identical(dst, entry, verify, src):
+                stats.skipped_files += 1
+                stats.skipped_bytes += entry[0]
+                continue
+            if os.path.lexists(dst):
+                os.remove(dst)
+            copy_entry(src, dst, stats, links)
+    stats = parallel(restore_group, by_directory(snapshot_files), jobs)
+    stats.add(removed)
+    for d in reversed(manifest["dirs"]):
+        copy_metadata(os.path.join(snapshot_dir, d), os.path.join(root, d))
+    return result(stats, start)
+
+def verify(snapshot_dir, jobs=None):
+    # Files of snapshots taken without hashes are only checked for size and mtime; "unhashed" counts them.
+    manifest = load_manifest(snapshot_dir)
+    bad = []
+    def check(group, stats):
+        for f in group:
+            if not identical(os.path.join(snapshot_dir, f), manifest["files"][f], verify=True):
+                bad.append(f)
+            stats.files += 1
+            stats.bytes += manifest["files"][f][0]
+            stats.skipped_files += manifest["files"][f][2] is None
+    stats = parallel(check, by_directory(sorted(manifest["files"])), jobs)
+    return {"files": stats.files, "bytes": stats.bytes, "unhashed": stats.skipped_files, "bad": sorted(bad)}
+
+def migrate_legacy(snapshots_root, name="default", keep=("experiments",)):
+    # A backup without a manifest has /var/lib/scylla's entries (data, commitlog...) directly in
+    # snapshots_root. They are moved (renamed, not copied) into the snapshot `name`, unless it
+    # exists. Other snapshots, leftovers of interrupted ones and the `keep` entries stay.
+    # Returns whether there was a legacy backup.
+    if not os.path.isdir(os.path.join(snapshots_root, "data")) or os.path.exists(os.path.join(snapshots_root, "data", MANIFEST)):
+        return False
+    snapshot_dir = os.path.join(snapshots_root, name)
+    if os.path.exists(snapshot_dir):
+        return False
+    tmp = f"{snapshot_dir}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.mkdir(tmp)
+    for entry in sorted(os.listdir(snapshots_root)):
+        path = os.path.join(snapshots_root, entry)
+        if (entry in keep or entry == os.path.basename(tmp) or entry.endswith((".tmp", ".old"))
+                or os.path.exists(os.path.join(path, MANIFEST))):
+            continue
+        os.rename(path, os.path.join(tmp, entry))
+    dirs, files = scan(tmp)
+    manifest = {}
+    for f in files:
+        st = os.lstat(os.path.join(tmp, f))
+        if stat.S_ISREG(st.st_mode):
+            manifest[f] = [st.st_size, st.st_mtime_ns, None]
+    created = os.stat(os.path.join(tmp, "data")).st_mtime
+    with open(os.path.join(tmp, MANIFEST), "w") as f:
+        json.dump({"dirs": dirs, "files": manifest, "created": created, "migrated": True}, f)
+    os.rename(tmp, snapshot_dir)
+    return True
+
+def list_snapshots(snapshots_root):
+    snapshots = {}
+    if os.path.isdir(snapshots_root):
+        for name in sorted(os.listdir(snapshots_root)):
+            path = os.path.join(snapshots_root, name)
+            if os.path.exists(os.path.join(path, MANIFEST)):
+                manifest = load_manifest(path)
+                snapshots[name] = {"created": manifest["created"], "files": len(manifest["files"]),
+                                   "bytes": sum(entry[0] for entry in manifest["files"].values())}
+    return snapshots
+
+def result(stats, start):
+    r = vars(stats)
+    r["seconds"] = time.monotonic() - start
+    # Reflinks were used only if everything that needed copying was reflinked.
+    r["reflink"] = r["copied_bytes"] == 0 and r["reflinked_bytes"] > 0
+    return r
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Named, verifiable snapshots of a directory tree")
+    parser.add_argument("--jobs", type=int, default=None, help="parallel copy threads")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("snapshot")
+    p.add_argument("root")
+    p.add_argument("snapshot_dir")
+    p.add_argument("--exclude", action="append", default=[], help="top-level entry of root to leave out")
+    p.add_argument("--hash", action="store_true", help="record the files' hashes, which reads all of them")
+    p = sub.add_parser("restore")
+    p.add_argument("snapshot_dir")
+    p.add_argument("root")
+    p.add_argument("--exclude", action="append", default=[], help="top-level entry of root to leave alone")
+    p.add_argument("--verify", action="store_true", help="compare hashes, not only sizes and mtimes, before skipping a file")
+    p = sub.add_parser("verify")
+    p.add_argument("snapshot_dir")
+    p = sub.add_parser("list")
+    p.add_argument("snapshots_root")
+    args = parser.parse_args(argv)
+
+    snapshots_root = args.snapshots_root if args.command == "list" else os.path.dirname(os.path.normpath(args.snapshot_dir))
+    if args.command != "verify" and migrate_legacy(snapshots_root):
+        print(f"moved the backup in {snapshots_root} without a manifest to {os.path.join(snapshots_root, 'default')}")
+    if args.command == "snapshot":
+        r = snapshot(args.root, args.snapshot_dir, args.exclude, args.jobs, hash=args.hash)
+    elif args.command == "restore":
+        r = restore(args.snapshot_dir, args.root, args.exclude, args.jobs, args.verify)
+    elif args.command == "verify":
+        r = verify(args.snapshot_dir, args.jobs)
+    else:
+        r = list_snapshots(args.snapshots_root)
+    # The last line of the output is the machine-readable result.
+    print(json.dumps(r))
+    if args.command == "verify" and r["bad"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
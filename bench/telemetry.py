@@ -0,0 +1,225 @@
+import asyncio
+import sys
+from collections import deque, namedtuple
+from bench.hdrhistogram import HdrHistogram, LogParser
+
+# Live latency telemetry from running cassandra-stress clients. Interval
+# results come either from the stdout lines cassandra-stress prints every
+# interval, or from its HDR log (-log hdrfile=...), which is followed with
+# `tail -F`. Intervals from all clients are merged into per-tag windows which
+# can be consumed as an async stream while the load is running.
+
+WINDOW_PERCENTILES = [50, 95, 99, 99.9]
+
+# One stdout interval line, e.g.
+# type, total ops, op/s, pk/s, row/s, mean, med, .95, .99, .999, max, time, stderr, errors, gc: #, max ms, sum ms, sdv ms, mb
+# Latencies are in ms, time is seconds since the start of the run.
+CsInterval = namedtuple('CsInterval', ['tag', 'total_ops', 'op_rate', 'pk_rate', 'row_rate', 'mean', 'median', 'p95', 'p99', 'p999',
+                                       'max', 'time', 'stderr', 'errors', 'gc_count', 'gc_max_ms', 'gc_sum_ms', 'gc_sdv_ms', 'gc_mb'])
+
+def parse_cs_interval(line):
+    if isinstance(line, bytes):
+        line = line.decode("utf-8", errors="replace")
+    fields = [x.strip() for x in line.split(",")]
+    if len(fields) < 14 or not fields[0] or fields[0] == "type":
+        return None
+    try:
+        numbers = [float(x) for x in fields[1:]]
+    except ValueError:
+        return None
+    # Versions without the GC columns leave them at 0.
+    numbers = (numbers + [0.0] * 18)[:18]
+    return CsInterval(fields[0], *numbers)
+
+class Window(namedtuple('Window', ['tag', 'time', 'clients', 'ops', 'op_rate', 'errors', 'mean', 'percentiles', 'max',
+                                   'gc_count', 'gc_max_ms', 'gc_sum_ms'])):
+    # Latencies are in ms. `percentiles` maps the percentiles in WINDOW_PERCENTILES to latencies.
+    def __str__(self):
+        percentiles = " ".join(f"p{p:g}={v:.2f}" for p, v in self.percentiles.items())
+        return (f"{self.time:7.1f}s {self.tag:>10} clients={self.clients} op/s={self.op_rate:.0f} errors={self.errors:.0f} "
+                f"mean={self.mean:.2f} {percentiles} max={self.max:.2f} gc={self.gc_count:.0f}/{self.gc_sum_ms:.0f}ms")
+
+def merge_cs_intervals(tag, time, intervals):
+    # Percentiles of different clients can't be merged exactly, so windows built from
+    # stdout report the worst client's percentiles. HDR windows are exact.
+    op_rate = sum(i.op_rate for i in intervals)
+    if op_rate:
+        mean = sum(i.mean * i.op_rate for i in intervals) / op_rate
+    else:
+        mean = max(i.mean for i in intervals)
+    percentiles = [max(i.median for i in intervals), max(i.p95 for i in intervals),
+                   max(i.p99 for i in intervals), max(i.p999 for i in intervals)]
+    return Window(tag, time, len(intervals), sum(i.total_ops for i in intervals), op_rate, sum(i.errors for i in intervals),
+                  mean, dict(zip(WINDOW_PERCENTILES, percentiles)), max(i.max for i in intervals),
+                  sum(i.gc_count for i in intervals), max(i.gc_max_ms for i in intervals), sum(i.gc_sum_ms for i in intervals))
+
+def merge_histograms(tag, time, histograms, interval):
+    total = HdrHistogram(histograms[0].lowest_trackable_value, histograms[0].highest_trackable_value, histograms[0].significant_digits)
+    for h in histograms:
+        total.add(h)
+    count = total.total_count
+    # HDR logs of cassandra-stress are in ns.
+    percentiles = total.values_at_percentiles(WINDOW_PERCENTILES) if count else [0] * len(WINDOW_PERCENTILES)
+    return Window(tag, time, len(histograms), count, count / interval, 0, (total.mean() if count else 0.0) / 1e6,
+                  {p: v / 1e6 for p, v in zip(WINDOW_PERCENTILES, percentiles)},
+                  (total.max_value() if count else 0) / 1e6, 0, 0.0, 0.0)
+
+class SloViolation(Exception):
+    def __init__(self, windows):
+        self.windows = windows
+        super().__init__(f"SLO violated in {len(windows)} consecutive windows, last: {windows[-1]}")
+
+class LatencySlo:
+    # Violated when the `percentile` latency of `tag` exceeds limit_ms. Both telemetry sources
+    # have "total" windows; the per-operation tags differ (e.g. READ on stdout, READ-rt in HDR logs).
+    def __init__(self, limit_ms, percentile=99, tag="total"):
+        self.limit_ms = limit_ms
+        self.percentile = percentile
+        self.tag = tag
+
+    def __call__(self, window):
+        if window.tag != self.tag:
+            return None
+        return window.percentiles[self.percentile] > self.limit_ms
+
+class CsTelemetry:
+    # `slo` is called with every window and returns True (violated), False (met) or None
+    # (does not apply). After `consecutive` violated windows in a row, `on_violation`
+    # is awaited with the violating windows; Deployment.cs uses it to stop the clients.
+    # By default the windows are only judged. keep_windows=True keeps all of them in
+    # `history` and queues them for windows(); a number keeps only that many of the newest,
+    # and drops the oldest queued ones (counted in `dropped`) when windows() falls behind.
+    def __init__(self, source="stdout", hdr_file=None, interval=1.0, slo=None, consecutive=3, on_violation=None,
+                 lag=5, passthrough=True, keep_windows=False):
+        if source not in ("stdout", "hdr"):
+            raise ValueError(f"Unknown telemetry source: {source}")
+        if source == "hdr" and hdr_file is None:
+            raise ValueError("hdr_file is required for the hdr telemetry source")
+        self.source = source
+        self.hdr_file = hdr_file
+        self.interval = interval
+        self.slo = slo
+        self.consecutive = consecutive
+        self.on_violation = on_violation
+        self.lag = lag
+        self.passthrough = passthrough
+        self.keep_windows = keep_windows
+        max_windows = None if keep_windows is True else int(keep_windows)
+        self.history = deque(maxlen=max_windows)
+        self.violation = None
+        self._violating = []
+        self._pending = {}
+        self._progress = {}
+        self._queue = asyncio.Queue(maxsize=max_windows or 0)
+        self._hdr_start = None
+        self._emitted_until = None
+        self.late = 0
+        self.dropped = 0
+        self.judged = 0
+        self.tags = set()
+
+    def _key(self, time):
+        return round(time / self.interval) * self.interval
+
+    def start(self, hosts):
+        self._progress = {host: None for host in hosts}
+
+    async def add(self, host, tag, time, item):
+        key = self._key(time)
+        if self._emitted_until is not None and key <= self._emitted_until:
+            # The window was already emitted without this client.
+            self.late += 1
+            return
+        self._pending.setdefault((key, tag), {})[host] = item
+        self._progress[host] = key if self._progress.get(host) is None else max(self._progress[host], key)
+        await self._flush()
+
+    async def finish(self, host):
+        self._progress.pop(host, None)
+        await self._flush()
+
+    async def close(self):
+        self._progress = {}
+        await self._flush(everything=True)
+        self._enqueue(None)
+        if self.slo is not None and self.tags and not self.judged:
+            print(f"telemetry: the SLO applied to none of the windows (tags: {', '.join(sorted(self.tags))})")
+
+    async def _flush(self, everything=False):
+        # A window is complete once every running client has moved past it. Windows
+        # more than `lag` intervals behind the newest one are emitted anyway, so that a
+        # stuck client doesn't stall the stream.
+        progress = [p for p in self._progress.values() if p is not None]
+        newest = max(progress, default=None)
+        def done(key):
+            return (everything or not progress or
+                    (len(progress) == len(self._progress) and min(progress) > key) or newest - key >= self.lag * self.interval)
+        for key in sorted({key for key, _ in self._pending if done(key)}):
+            tags = sorted((tag for k, tag in self._pending if k == key), key=lambda t: (t != "total", t))
+            items = {tag: self._pending.pop((key, tag)) for tag in tags}
+            self._emitted_until = key if self._emitted_until is None else max(self._emitted_until, key)
+            if self.source == "hdr":
+                # HDR logs have no total tag, so a total window pools the response-time ("-rt") tags,
+                # or all tags if there are none, and "total" means the same for both sources.
+                pooled = [h for tag in tags if tag.endswith("-rt") for h in items[tag].values()]
+                pooled = pooled or [h for tag in tags for h in items[tag].values()]
+                clients = len(set().union(*items.values()))
+                await self._emit(merge_histograms("total", key, pooled, self.interval)._replace(clients=clients))
+                for tag in tags:
+                    await self._emit(merge_histograms(tag, key, list(items[tag].values()), self.interval))
+            else:
+                for tag in tags:
+                    await self._emit(merge_cs_intervals(tag, key, list(items[tag].values())))
+
+    async def _emit(self, window):
+        self.tags.add(window.tag)
+        if self.keep_windows:
+            self.history.append(window)
+            self._enqueue(window)
+        if self.slo is None or self.violation is not None:
+            return
+        violated = self.slo(window)
+        if violated is None:
+            return
+        self.judged += 1
+        self._violating = self._violating + [window] if violated else []
+        if len(self._violating) >= self.consecutive:
+            self.violation = SloViolation(self._violating)
+            if self.on_violation is not None:
+                await self.on_violation(self.violation)
+
+    def _enqueue(self, item):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(item)
+
+    async def windows(self):
+        while (window := await self._queue.get()) is not None:
+            yield window
+
+    async def follow_stdout(self, stream, host):
+        async for name, line in stream:
+            if self.passthrough:
+                out = sys.stdout.buffer if name == "stdout" else sys.stderr.buffer
+                out.write(line)
+                out.flush()
+            if name != "stdout" or self.source != "stdout":
+                continue
+            interval = parse_cs_interval(line)
+            if interval is not None:
+                await self.add(host, interval.tag, interval.time, interval)
+
+    async def follow_hdr(self, stream, host):
+        parser = LogParser()
+        async for name, line in stream:
+            if name != "stdout":
+                continue
+            h = parser.parse(line.decode("utf-8", errors="replace"))
+            if h is None:
+                continue
+            # Clients start at slightly different times, so windows are aligned on wall-clock time,
+            # relative to the first interval seen from any client.
+            if self._hdr_start is None:
+                self._hdr_start = h.start_time_ms
+            await self.add(host, h.tag, (h.start_time_ms - self._hdr_start) / 1000, h)
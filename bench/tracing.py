@@ -0,0 +1,243 @@
+import atexit
+import functools
+import inspect
+import itertools
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+# Timeline tracing of Deployment operations. Every traced Deployment method,
+# every remote command and every local subprocess becomes a span with its host,
+# command, start and end time, exit code and bytes in and out. The current span
+# is a context variable, and asyncio tasks inherit the context they are created
+# in, so spans nest through gather() and create_task().
+#
+# Tracing is off unless BENCH_TRACE names an output file (or enable() is called);
+# then the spans are written as Chrome trace-event JSON at exit, for
+# chrome://tracing or https://ui.perfetto.dev, and the critical path is printed.
+# When it is off, a traced call costs one global lookup.
+
+_tracer = None
+_current = ContextVar("bench_span", default=None)
+
+class Span:
+    __slots__ = ("id", "parent", "name", "category", "host", "args", "start", "end")
+
+    def __init__(self, id, parent, name, category, host, args, start, end=None):
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.category = category
+        self.host = host
+        self.args = args
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def set(self, **args):
+        self.args.update(args)
+
+class NullSpan:
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Tracer:
+    def __init__(self, path=None):
+        self.path = path
+        self.spans = []
+        self.origin = time.monotonic()
+        self.ids = itertools.count(1)
+
+    def record(self, name, category, host, start, end, **args):
+        # A finished leaf span, e.g. a command whose start and end were measured by the caller.
+        parent = _current.get()
+        self.spans.append(Span(next(self.ids), parent.id if parent is not None else None, name, category, host, args, start, end))
+
+class ActiveSpan:
+    def __init__(self, tracer, name, category, host, args):
+        parent = _current.get()
+        self.tracer = tracer
+        self.span = Span(next(tracer.ids), parent.id if parent is not None else None, name, category, host, args, None)
+
+    def __enter__(self):
+        self.span.start = time.monotonic()
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.end = time.monotonic()
+        _current.reset(self.token)
+        if exc is not None:
+            self.span.args["error"] = repr(exc)
+        self.tracer.spans.append(self.span)
+        return False
+
+def enabled():
+    return _tracer is not None
+
+def enable(path=None):
+    # Starts tracing; with a path, the trace is written there at exit and the critical path printed.
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(path)
+        if path is not None:
+            atexit.register(finish)
+    return _tracer
+
+def span(name, category="deployment", host=None, **args):
+    # with span("name", host=...) as s: ...; s.set(key=value) adds to the span's args.
+    if _tracer is None:
+        return NULL_SPAN
+    return ActiveSpan(_tracer, name, category, host, args)
+
+def record(name, category, host, start, end, **args):
+    if _tracer is not None:
+        _tracer.record(name, category, host, start, end, **args)
+
+def short_command(command, n=60):
+    if not isinstance(command, str):
+        command = " ".join(map(str, command))
+    command = " ".join(command.split())
+    return command if len(command) <= n else command[:n - 3] + "..."
+
+def traced(func, name=None):
+    # Traces an async method; its `host` argument, if it has one, is recorded.
+    name = name or func.__qualname__
+    parameters = list(inspect.signature(func).parameters)
+    host_index = parameters.index("host") if "host" in parameters else None
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return await func(*args, **kwargs)
+        host = kwargs.get("host")
+        if host is None and host_index is not None and host_index < len(args):
+            host = args[host_index]
+        with ActiveSpan(_tracer, name, "deployment", host, {}):
+            return await func(*args, **kwargs)
+    return wrapper
+
+def traced_methods(exclude=()):
+    # Class decorator tracing all public async methods, except the ones in exclude.
+    def decorate(cls):
+        for attr, value in list(vars(cls).items()):
+            if not attr.startswith("_") and attr not in exclude and inspect.iscoroutinefunction(value):
+                setattr(cls, attr, traced(value))
+        return cls
+    return decorate
+
+def assign_lanes(spans):
+    # Chrome trace events on one thread must nest, while concurrent spans overlap, so spans
+    # are spread over "threads": a span goes into its parent's lane when the parent is the
+    # innermost span open there, otherwise into the first idle lane, otherwise a new one.
+    lanes = []
+    lane_of = {}
+    for s in sorted(spans, key=lambda s: (s.start, -s.end)):
+        candidates = ([lane_of[s.parent]] if s.parent in lane_of else []) + list(range(len(lanes)))
+        for lane in candidates:
+            stack = lanes[lane]
+            while stack and stack[-1].end <= s.start:
+                stack.pop()
+            if not stack or (stack[-1].id == s.parent and stack[-1].end >= s.end):
+                break
+        else:
+            lane = len(lanes)
+            lanes.append([])
+        lanes[lane].append(s)
+        lane_of[s.id] = lane
+    return lane_of
+
+def chrome_trace(spans, origin):
+    lane_of = assign_lanes(spans)
+    events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": lane, "args": {"name": f"lane {lane}"}}
+              for lane in sorted(set(lane_of.values()))]
+    for s in spans:
+        args = dict(s.args)
+        if s.host is not None:
+            args["host"] = s.host
+        events.append({"name": s.name if s.host is None else f"{s.name} [{s.host}]", "cat": s.category, "ph": "X", "pid": 1,
+                       "tid": lane_of[s.id], "ts": round((s.start - origin) * 1e6), "dur": round(s.duration * 1e6), "args": args})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def critical_path(spans):
+    # The chain of spans which determined the end of the run: from the end, the span which
+    # finished last, then the one which finished last before that one started, and so on,
+    # and the same within every span on the path. Returns [(span, depth, self time)], where
+    # the self time is the part of the span not covered by its children on the path.
+    children = defaultdict(list)
+    ids = {s.id for s in spans}
+    for s in spans:
+        children[s.parent if s.parent in ids else None].append(s)
+    for kids in children.values():
+        kids.sort(key=lambda s: s.end, reverse=True)
+
+    path = []
+    def walk(parent_id, lo, hi, depth):
+        chain = []
+        t = hi
+        for c in children.get(parent_id, ()):
+            if c.end <= t and c.start >= lo:
+                chain.append(c)
+                t = c.start
+        covered = 0.0
+        for c in reversed(chain):
+            i = len(path)
+            path.append(None)
+            child_covered = walk(c.id, c.start, c.end, depth + 1)
+            path[i] = (c, depth, c.duration - child_covered)
+            covered += c.duration
+        return covered
+
+    if spans:
+        walk(None, min(s.start for s in spans), max(s.end for s in spans), 0)
+    return path
+
+def format_critical_path(spans, min_fraction=0.01, top=15):
+    if not spans:
+        return "no spans recorded"
+    path = critical_path(spans)
+    total = max(s.end for s in spans) - min(s.start for s in spans)
+    lines = [f"critical path: {total:.1f}s over {len(spans)} spans"]
+    for s, depth, _ in path:
+        if s.duration >= min_fraction * total:
+            host = f" [{s.host}]" if s.host is not None else ""
+            lines.append(f"{'  ' * (depth + 1)}{s.duration:8.1f}s {s.duration / total:4.0%}  {s.name}{host}")
+    by_name = defaultdict(float)
+    for s, _, self_time in path:
+        by_name[s.name] += self_time
+    lines.append("critical time by operation (excluding the spans under it):")
+    for name, seconds in sorted(by_name.items(), key=lambda x: -x[1])[:top]:
+        lines.append(f"  {seconds:8.1f}s {seconds / total:4.0%}  {name}")
+    idle = total - sum(by_name.values())
+    if idle > min_fraction * total:
+        lines.append(f"  {idle:8.1f}s {idle / total:4.0%}  (untraced)")
+    return "\n".join(lines)
+
+def write_chrome_trace(path, tracer=None):
+    tracer = tracer or _tracer
+    with open(path, "w") as f:
+        json.dump(chrome_trace(tracer.spans, tracer.origin), f)
+
+def finish():
+    if _tracer is None or _tracer.path is None:
+        return
+    write_chrome_trace(_tracer.path)
+    print(format_critical_path(_tracer.spans), file=sys.stderr)
+    print(f"trace written to {_tracer.path}", file=sys.stderr)
+
+if os.environ.get("BENCH_TRACE"):
+    enable(os.environ["BENCH_TRACE"])
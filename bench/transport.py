@@ -0,0 +1,430 @@
+import asyncio
+import os
+import socket
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import AsyncExitStack, asynccontextmanager
+from bench import tracing
+
+class HostStats:
+    def __init__(self):
+        self.commands = 0
+        self.failures = 0
+        self.active = 0
+        self.busy_time = 0.0
+        self.max_latency = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.first_start = None
+        self.last_end = None
+
+    def record(self, start, end, returncode, bytes_in, bytes_out):
+        self.commands += 1
+        self.failures += returncode != 0
+        self.busy_time += end - start
+        self.max_latency = max(self.max_latency, end - start)
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.first_start = start if self.first_start is None else min(self.first_start, start)
+        self.last_end = end if self.last_end is None else max(self.last_end, end)
+
+    @property
+    def mean_latency(self):
+        return self.busy_time / self.commands if self.commands else 0.0
+
+    @property
+    def throughput(self):
+        # Bytes per second over the wall time in which this host had commands running.
+        wall = (self.last_end - self.first_start) if self.commands else 0.0
+        return (self.bytes_in + self.bytes_out) / wall if wall > 0 else 0.0
+
+    def __repr__(self):
+        return (f"HostStats(commands={self.commands}, failures={self.failures}, active={self.active}, "
+                f"mean_latency={self.mean_latency:.3f}s, max_latency={self.max_latency:.3f}s, "
+                f"bytes_in={self.bytes_in}, bytes_out={self.bytes_out}, throughput={self.throughput:.0f}B/s)")
+
+class SubprocessChannel:
+    def __init__(self, proc):
+        self.proc = proc
+        self.stdin = proc.stdin
+        self.stdout = proc.stdout
+        self.stderr = proc.stderr
+
+    def close_stdin(self):
+        self.stdin.close()
+
+    async def wait(self):
+        return await self.proc.wait()
+
+    def terminate(self):
+        if self.proc.returncode is None:
+            try:
+                self.proc.terminate()
+            except ProcessLookupError:
+                pass
+
+class SshChannel:
+    def __init__(self, process, on_close=None):
+        self.process = process
+        self.stdin = process.stdin
+        self.stdout = process.stdout
+        self.stderr = process.stderr
+        self._on_close = on_close
+
+    def _closed(self):
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close()
+
+    def close_stdin(self):
+        self.stdin.write_eof()
+
+    async def wait(self):
+        try:
+            completed = await self.process.wait(check=False)
+        finally:
+            self._closed()
+        return completed.exit_status if completed.exit_status is not None else 255
+
+    def terminate(self):
+        self.process.close()
+        self._closed()
+
+class PortForward:
+    def __init__(self, host, port, close=None):
+        self.host = host
+        self.port = port
+        self._close = close
+
+    async def close(self):
+        if self._close is not None:
+            await self._close()
+            self._close = None
+
+def free_local_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+async def _feed(channel, stdin_data):
+    try:
+        if stdin_data:
+            channel.stdin.write(stdin_data)
+            await channel.stdin.drain()
+        channel.close_stdin()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+
+async def _drain(reader, mode, passthrough):
+    chunks = []
+    n = 0
+    while chunk := await reader.read(1 << 16):
+        n += len(chunk)
+        if mode == asyncio.subprocess.PIPE:
+            chunks.append(chunk)
+        elif mode is None:
+            passthrough.write(chunk)
+            passthrough.flush()
+    return (b"".join(chunks) if mode == asyncio.subprocess.PIPE else None), n
+
+class CommandStream:
+    def __init__(self, transport, host, command, stdin_data=None):
+        self.transport = transport
+        self.host = host
+        self.command = command
+        self.stdin_data = stdin_data
+        self.returncode = None
+
+    def __aiter__(self):
+        return self._lines()
+
+    async def _lines(self):
+        stats = self.transport.stats[self.host]
+        queue = asyncio.Queue()
+        received = 0
+        start = time.monotonic()
+        async def pump(name, reader):
+            try:
+                while line := await reader.readline():
+                    await queue.put((name, line))
+            finally:
+                await queue.put(None)
+        async with self.transport.session(self.host, shared=False):
+            channel = await self.transport.open(self.host, self.command)
+            pumps = [asyncio.create_task(pump("stdout", channel.stdout)), asyncio.create_task(pump("stderr", channel.stderr))]
+            try:
+                await _feed(channel, self.stdin_data)
+                finished = 0
+                while finished < len(pumps):
+                    item = await queue.get()
+                    if item is None:
+                        finished += 1
+                        continue
+                    received += len(item[1])
+                    yield item
+                self.returncode = await channel.wait()
+            finally:
+                for task in pumps:
+                    task.cancel()
+                if self.returncode is None:
+                    # Discard unread output, otherwise the pipes never reach EOF and wait() hangs.
+                    channel.terminate()
+                    await asyncio.gather(channel.wait(), _drain(channel.stdout, asyncio.subprocess.DEVNULL, None),
+                                         _drain(channel.stderr, asyncio.subprocess.DEVNULL, None))
+                end = time.monotonic()
+                returncode = self.returncode if self.returncode is not None else -1
+                stats.record(start, end, returncode, len(self.stdin_data or b""), received)
+                if tracing.enabled():
+                    tracing.record(tracing.short_command(self.command), "ssh", self.host, start, end,
+                                   command=tracing.short_command(self.command, 500), returncode=returncode,
+                                   bytes_in=len(self.stdin_data or b""), bytes_out=received, stream=True)
+
+class Transport:
+    max_channels = None
+
+    def __init__(self):
+        self.stats = defaultdict(HostStats)
+        self._channel_slots = {}
+        # An async context manager held around every command, e.g. a share of the ssh budget
+        # of a Fleet (bench/fleet.py). Streams are left out: they are long-lived and often
+        # wait for other commands to finish, which could then never get a slot.
+        self.slots = None
+
+    @asynccontextmanager
+    async def session(self, host, shared=True):
+        stats = self.stats[host]
+        stats.active += 1
+        try:
+            async with AsyncExitStack() as stack:
+                if self.max_channels is not None:
+                    await stack.enter_async_context(self._channel_slots.setdefault(host, asyncio.Semaphore(self.max_channels)))
+                if shared and self.slots is not None:
+                    await stack.enter_async_context(self.slots)
+                yield
+        finally:
+            stats.active -= 1
+
+    async def open(self, host, command):
+        raise NotImplementedError
+
+    async def run(self, host, command, stdin_data=None, stdout=None, stderr=None):
+        start = time.monotonic()
+        returncode = -1
+        out = err = None
+        n_out = 0
+        try:
+            async with self.session(host):
+                out, err, returncode, n_out = await self._run(host, command, stdin_data, stdout, stderr)
+        finally:
+            end = time.monotonic()
+            self.stats[host].record(start, end, returncode, len(stdin_data or b""), n_out)
+            if tracing.enabled():
+                tracing.record(tracing.short_command(command), "ssh", host, start, end, command=tracing.short_command(command, 500),
+                               returncode=returncode, bytes_in=len(stdin_data or b""), bytes_out=n_out)
+        return out, err, returncode
+
+    async def _run(self, host, command, stdin_data, stdout, stderr):
+        channel = await self.open(host, command)
+        try:
+            _, (out, n_out), (err, n_err) = await asyncio.gather(
+                _feed(channel, stdin_data),
+                _drain(channel.stdout, stdout, sys.stdout.buffer),
+                _drain(channel.stderr, stderr, sys.stderr.buffer))
+            return out, err, await channel.wait(), n_out + n_err
+        except asyncio.CancelledError:
+            channel.terminate()
+            raise
+
+    def stream(self, host, command, stdin_data=None):
+        return CommandStream(self, host, command, stdin_data)
+
+    async def forward(self, host, remote_port, remote_host="localhost"):
+        raise NotImplementedError
+
+    async def relogin(self, host):
+        pass
+
+    async def close(self):
+        pass
+
+class SubprocessTransport(Transport):
+    def argv(self, host, command):
+        raise NotImplementedError
+
+    def popen_kwargs(self, host):
+        return {}
+
+    async def open(self, host, command):
+        proc = await asyncio.create_subprocess_exec(*self.argv(host, command), stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                    **self.popen_kwargs(host))
+        return SubprocessChannel(proc)
+
+    async def _run(self, host, command, stdin_data, stdout, stderr):
+        # Inherited output goes straight to our terminal instead of being copied through Python.
+        proc = await asyncio.create_subprocess_exec(*self.argv(host, command), stdin=asyncio.subprocess.PIPE,
+                                                    stdout=stdout, stderr=stderr, **self.popen_kwargs(host))
+        try:
+            out, err = await proc.communicate(stdin_data)
+        except asyncio.CancelledError:
+            SubprocessChannel(proc).terminate()
+            await proc.wait()
+            raise
+        return out, err, proc.returncode, len(out or b"") + len(err or b"")
+
+class SshTransport(SubprocessTransport):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def argv(self, host, command):
+        return ["bin/ssh", self.name, host, command]
+
+    async def relogin(self, host):
+        proc = await asyncio.create_subprocess_exec("bin/ssh", self.name, "-Ostop", host)
+        await proc.wait()
+
+    async def forward(self, host, remote_port, remote_host="localhost"):
+        port = free_local_port()
+        proc = await asyncio.create_subprocess_exec("bin/ssh", self.name, "-N", "-o", "ExitOnForwardFailure=yes",
+                                                    "-L", f"127.0.0.1:{port}:{remote_host}:{remote_port}", host)
+        async def close():
+            SubprocessChannel(proc).terminate()
+            await proc.wait()
+        try:
+            await wait_for_port("127.0.0.1", port)
+        except BaseException:
+            await close()
+            raise
+        return PortForward("127.0.0.1", port, close)
+
+class LocalTransport(SubprocessTransport):
+    # Runs "remote" commands with local bash. With a root directory, every host
+    # gets its own working and home directory, which makes it a stand-in for a cluster.
+    def __init__(self, root=None):
+        super().__init__()
+        self.root = root
+
+    def host_dir(self, host):
+        path = os.path.join(self.root, host)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def argv(self, host, command):
+        return ["bash", "-c", command]
+
+    async def forward(self, host, remote_port, remote_host="localhost"):
+        return PortForward(remote_host, remote_port)
+
+    def popen_kwargs(self, host):
+        if self.root is None:
+            return {}
+        path = self.host_dir(host)
+        return {"cwd": path, "env": {**os.environ, "HOME": path}}
+
+class AsyncsshTransport(Transport):
+    # OpenSSH servers allow 10 sessions per connection by default (MaxSessions).
+    max_channels = 8
+
+    def __init__(self, name, ssh_config=None):
+        super().__init__()
+        self.name = name
+        self.ssh_config = ssh_config or f"{name}/ssh_config"
+        self._connections = {}
+        # Open channels per connection, and connections replaced by relogin() which are
+        # closed once their last channel is.
+        self._channels = Counter()
+        self._retired = set()
+
+    async def connection(self, host):
+        if host not in self._connections:
+            import asyncssh
+            self._connections[host] = asyncio.ensure_future(asyncssh.connect(host, config=[self.ssh_config], known_hosts=None))
+        try:
+            return await asyncio.shield(self._connections[host])
+        except Exception:
+            self._connections.pop(host, None)
+            raise
+
+    async def open(self, host, command):
+        conn = await self.connection(host)
+        self._channels[conn] += 1
+        try:
+            process = await conn.create_process(command, encoding=None)
+        except BaseException:
+            self._release(conn)
+            raise
+        return SshChannel(process, lambda: self._release(conn))
+
+    def _release(self, conn):
+        self._channels[conn] -= 1
+        if self._channels[conn] <= 0:
+            del self._channels[conn]
+            if conn in self._retired:
+                self._retired.discard(conn)
+                conn.close()
+
+    async def forward(self, host, remote_port, remote_host="localhost"):
+        conn = await self.connection(host)
+        listener = await conn.forward_local_port("127.0.0.1", 0, remote_host, remote_port)
+        async def close():
+            listener.close()
+            await listener.wait_closed()
+        return PortForward("127.0.0.1", listener.get_port(), close)
+
+    async def relogin(self, host):
+        # New commands get a new connection; the old one is closed when its running commands finish.
+        pending = self._connections.pop(host, None)
+        if pending is None:
+            return
+        try:
+            conn = await pending
+        except Exception:
+            return
+        if self._channels[conn]:
+            self._retired.add(conn)
+        else:
+            del self._channels[conn]
+            conn.close()
+
+    async def close(self):
+        connections = list(self._retired)
+        self._retired.clear()
+        for host in list(self._connections):
+            try:
+                connections.append(await self._connections.pop(host))
+            except Exception:
+                pass
+        for conn in connections:
+            conn.close()
+            await conn.wait_closed()
+
+TRANSPORTS = {"ssh": SshTransport, "asyncssh": AsyncsshTransport}
+
+def default_transport(name):
+    # BENCH_TRANSPORT picks the backend: "ssh" (a bin/ssh process per command), "asyncssh"
+    # (multiplexed connections in this process), or "auto", asyncssh when it is installed.
+    backend = os.environ.get("BENCH_TRANSPORT", "auto")
+    if backend == "auto":
+        try:
+            import asyncssh
+            backend = "asyncssh"
+        except ImportError:
+            backend = "ssh"
+    if backend not in TRANSPORTS:
+        raise ValueError(f"BENCH_TRANSPORT={backend}: expected one of auto, {', '.join(TRANSPORTS)}")
+    print(f"{name}: using the {backend} transport", file=sys.stderr)
+    return TRANSPORTS[backend](name)
@@ -0,0 +1,237 @@
+import asyncio
+import inspect
+import math
+import operator
+import re
+import sys
+import time
+from collections import namedtuple
+from bench.prometheus import PrometheusClient
+
+# Conditions over Prometheus expressions, which scripts await (or attach
+# callbacks to) instead of sleeping for a worst-case guess:
+#
+#     await d.wait_for('max(scylla_io_queue_queue_length{class="sl:default"}) > 80 for 3s')
+#     await d.wait_for("sum(scylla_compaction_manager_compactions) == 0 for 3 polls")
+#
+# All active conditions are evaluated by one polling loop, in one query per
+# poll (PrometheusClient.query_many).
+# The loop polls as often as the most urgent condition needs: a condition
+# whose value approaches its threshold is polled sooner the closer it gets
+# (from the slope of its last two values), one which is holding is polled at
+# its shortest interval, and one which is far away or moving away at its longest.
+
+OPERATORS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le, "==": operator.eq, "!=": operator.ne}
+CONDITION = re.compile(r"^(?P<expr>.*\S)\s*(?P<op>>=|<=|==|!=|>|<)\s*(?P<threshold>[-+]?[\d.]+(?:e[-+]?\d+)?)"
+                       r"(?:\s+for\s+(?P<duration>[\d.]+)\s*(?P<unit>s|polls?))?\s*$")
+
+# value is None when the expression returned no series.
+Observation = namedtuple('Observation', ['time', 'value'])
+
+class Condition:
+    # Met when `value op threshold` held on `polls` consecutive polls spanning at least
+    # for_seconds. An expression returning several series is judged by its largest value
+    # (its smallest for < and <=), so it should usually aggregate, e.g. with max() or sum().
+    def __init__(self, expr, op, threshold, for_seconds=0, polls=1, min_interval=0.5, max_interval=5.0):
+        if op not in OPERATORS:
+            raise ValueError(f"Unknown operator: {op}")
+        self.expr = expr
+        self.op = op
+        self.threshold = threshold
+        self.for_seconds = for_seconds
+        self.polls = polls
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    @classmethod
+    def parse(cls, text, **kwargs):
+        # "expr > 80", "expr > 80 for 3s", "expr == 0 for 3 polls"
+        m = CONDITION.match(text.strip())
+        if m is None:
+            raise ValueError(f"Can't parse condition: {text!r}")
+        if m["duration"] is not None:
+            if m["unit"] == "s":
+                kwargs.setdefault("for_seconds", float(m["duration"]))
+            else:
+                kwargs.setdefault("polls", int(m["duration"]))
+        return cls(m["expr"], m["op"], float(m["threshold"]), **kwargs)
+
+    def reduce(self, values):
+        if not values:
+            return None
+        return min(values) if self.op in ("<", "<=") else max(values)
+
+    def holds(self, value):
+        return value is not None and OPERATORS[self.op](value, self.threshold)
+
+    def __str__(self):
+        hold = []
+        if self.for_seconds:
+            hold.append(f"{self.for_seconds:g}s")
+        if self.polls > 1:
+            hold.append(f"{self.polls} polls")
+        return f"{self.expr} {self.op} {self.threshold:g}{' for ' + ' and '.join(hold) if hold else ''}"
+
+class Trigger:
+    # Resolves `future` with the Observation which met the condition. With once=False, the
+    # trigger stays active and calls its callback every time the condition becomes met again.
+    def __init__(self, condition, callback=None, once=True):
+        self.condition = condition
+        self.callback = callback
+        self.once = once
+        self.future = asyncio.get_running_loop().create_future()
+        self.history = []
+        self.streak = []
+        self.met = False
+        self.next_poll = 0.0
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def observe(self, t, value):
+        # Returns True when the condition became met.
+        c = self.condition
+        self.history.append(Observation(t, value))
+        if c.holds(value):
+            self.streak.append(t)
+        else:
+            self.streak = []
+            self.met = False
+        became_met = (not self.met and len(self.streak) >= c.polls and self.streak[-1] - self.streak[0] >= c.for_seconds)
+        if became_met:
+            self.met = True
+        self.next_poll = t + self.interval()
+        return became_met
+
+    def interval(self):
+        c = self.condition
+        if self.streak:
+            # Holding: check soon whether it still does, but no more often than the hold needs.
+            remaining = c.for_seconds - (self.streak[-1] - self.streak[0])
+            return min(c.max_interval, max(c.min_interval, remaining))
+        if len(self.history) < 2 or self.history[-1].value is None or self.history[-2].value is None:
+            return c.min_interval
+        (t0, v0), (t1, v1) = self.history[-2:]
+        slope = (v1 - v0) / (t1 - t0) if t1 > t0 else 0.0
+        distance = c.threshold - v1
+        if slope == 0 or distance / slope <= 0:
+            return c.max_interval
+        # Half the estimated time to the threshold, so that a steady approach isn't overshot.
+        return min(c.max_interval, max(c.min_interval, distance / slope / 2))
+
+def last_values(series):
+    return [float(s.values[-1]) for s in series.values() if len(s.values) and not math.isnan(s.values[-1])]
+
+class TriggerScheduler:
+    # prometheus is an async function returning a PrometheusClient, e.g. Deployment.prometheus.
+    # The polling loop only runs while there are active triggers.
+    def __init__(self, prometheus, verbose=True):
+        self.prometheus = prometheus
+        self.verbose = verbose
+        self.triggers = []
+        self.polls = 0
+        self.loop = None
+        self.wakeup = asyncio.Event()
+
+    def add(self, condition, callback=None, once=True):
+        if isinstance(condition, str):
+            condition = Condition.parse(condition)
+        trigger = Trigger(condition, callback, once)
+        self.triggers.append(trigger)
+        if self.loop is None or self.loop.done():
+            self.loop = asyncio.create_task(self.run())
+        self.wakeup.set()
+        return trigger
+
+    def remove(self, trigger):
+        if trigger in self.triggers:
+            self.triggers.remove(trigger)
+        if not trigger.future.done():
+            trigger.future.cancel()
+
+    async def wait(self, condition, timeout=None):
+        # Returns the Observation which met the condition; raises asyncio.TimeoutError after timeout seconds.
+        trigger = self.add(condition)
+        if self.verbose:
+            print(f"waiting for {trigger.condition}")
+        try:
+            return await asyncio.wait_for(asyncio.shield(trigger.future), timeout)
+        finally:
+            self.remove(trigger)
+
+    async def fire(self, trigger, observation):
+        if self.verbose:
+            print(f"condition met: {trigger.condition} (value {observation.value:g})")
+        if trigger.once:
+            self.triggers.remove(trigger)
+        if not trigger.future.done():
+            trigger.future.set_result(observation)
+        if trigger.callback is not None:
+            result = trigger.callback(observation)
+            if inspect.isawaitable(result):
+                await result
+
+    async def poll(self):
+        triggers = list(self.triggers)
+        exprs = []
+        for trigger in triggers:
+            if trigger.condition.expr not in exprs:
+                exprs.append(trigger.condition.expr)
+        prometheus = await self.prometheus()
+        results = await prometheus.query_many(exprs)
+        self.polls += 1
+        t = time.monotonic()
+        values = {expr: last_values(series) for expr, series in zip(exprs, results)}
+        for trigger in triggers:
+            value = trigger.condition.reduce(values[trigger.condition.expr])
+            if trigger.observe(t, value) and trigger in self.triggers:
+                await self.fire(trigger, Observation(t, value))
+
+    async def run(self):
+        while self.triggers:
+            try:
+                await self.poll()
+            except Exception as e:
+                # Resolved with the error, so that waiters don't hang on a broken Prometheus.
+                print(f"trigger polling failed: {e!r}")
+                for trigger in list(self.triggers):
+                    self.triggers.remove(trigger)
+                    if not trigger.future.done():
+                        trigger.future.set_exception(e)
+                return
+            if not self.triggers:
+                break
+            delay = min(trigger.next_poll for trigger in self.triggers) - time.monotonic()
+            self.wakeup.clear()
+            if delay > 0:
+                # New triggers are polled right away.
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def close(self):
+        for trigger in list(self.triggers):
+            self.remove(trigger)
+        if self.loop is not None and not self.loop.done():
+            self.loop.cancel()
+            try:
+                await self.loop
+            except asyncio.CancelledError:
+                pass
+
+async def main():
+    # python -m bench.triggers host:port "condition" ["condition" ...]: waits for all the conditions.
+    host, port = sys.argv[1].rsplit(":", 1)
+    client = PrometheusClient(host, int(port))
+    async def prometheus():
+        return client
+    scheduler = TriggerScheduler(prometheus)
+    try:
+        await asyncio.gather(*(scheduler.wait(c) for c in sys.argv[2:]))
+    finally:
+        client.close()
+    print(f"{scheduler.polls} polls")
+
+if __name__ == "__main__":
+    asyncio.run(main())
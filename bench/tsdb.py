@@ -0,0 +1,414 @@
+import argparse
+import json
+import mmap
+import os
+import re
+import shutil
+import time
+from collections import namedtuple
+import numpy as np
+from bench.prometheus import Series, labels_key
+
+# Offline reader for Prometheus TSDB blocks, as found in a snapshot directory
+# (data/snapshots/<name>/<ULID>/{meta.json,index,chunks/,tombstones}).
+# Only the v2 index format and XOR (float) chunks are supported; native histogram chunks are skipped.
+
+INDEX_MAGIC = 0xBAAAD700
+CHUNKS_MAGIC = 0x85BD40DD
+TOMBSTONES_MAGIC = 0x0130BA30
+CHUNK_ENCODING_XOR = 1
+STALE_NAN = 0x7ff0000000000002
+
+ULID_RE = re.compile(r"^[0-9A-HJKMNP-TV-Z]{26}$")
+
+class TsdbError(Exception):
+    pass
+
+def is_block_dir(path):
+    return ULID_RE.match(os.path.basename(path)) is not None and os.path.exists(os.path.join(path, "meta.json"))
+
+def list_blocks(data_dir):
+    if not os.path.isdir(data_dir):
+        return []
+    return sorted(name for name in os.listdir(data_dir) if is_block_dir(os.path.join(data_dir, name)))
+
+def install_blocks(incoming_dir, data_dir, keep):
+    # Moves fully downloaded blocks from incoming_dir into data_dir and removes
+    # the local blocks which are not in `keep` (e.g. compacted away on the server).
+    os.makedirs(data_dir, exist_ok=True)
+    for name in list_blocks(incoming_dir):
+        os.replace(os.path.join(incoming_dir, name), os.path.join(data_dir, name))
+    shutil.rmtree(incoming_dir, ignore_errors=True)
+    removed = [name for name in list_blocks(data_dir) if name not in keep]
+    for name in removed:
+        shutil.rmtree(os.path.join(data_dir, name))
+    return removed
+
+def uvarint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def varint(buf, pos):
+    u, pos = uvarint(buf, pos)
+    return (u >> 1) ^ -(u & 1), pos
+
+def be32(buf, pos):
+    return int.from_bytes(buf[pos:pos + 4], "big")
+
+def decode_xor(data):
+    n = int.from_bytes(data[0:2], "big")
+    timestamps = [0] * n
+    values = [0] * n
+    if n == 0:
+        return timestamps, values
+    t, pos = varint(data, 2)
+    buf = bytes(data) + bytes(9)
+    bitpos = pos * 8
+    def read(nbits):
+        nonlocal bitpos
+        word = int.from_bytes(buf[bitpos >> 3:(bitpos >> 3) + 9], "big")
+        bits = (word >> (72 - (bitpos & 7) - nbits)) & ((1 << nbits) - 1)
+        bitpos += nbits
+        return bits
+    v = read(64)
+    timestamps[0], values[0] = t, v
+    delta = 0
+    leading = trailing = 0
+    for i in range(1, n):
+        if i == 1:
+            delta, pos = uvarint(buf, bitpos >> 3)
+            bitpos = pos * 8
+        else:
+            # Delta-of-delta with a 1-4 bit prefix selecting the width.
+            prefix = 0
+            for _ in range(4):
+                bit = read(1)
+                prefix = (prefix << 1) | bit
+                if not bit:
+                    break
+            if prefix == 0b1111:
+                dod = read(64)
+                if dod >= 1 << 63:
+                    dod -= 1 << 64
+            elif prefix:
+                size = {0b10: 14, 0b110: 17, 0b1110: 20}[prefix]
+                dod = read(size)
+                if dod > 1 << (size - 1):
+                    dod -= 1 << size
+            else:
+                dod = 0
+            delta += dod
+        t += delta
+        if read(1):
+            if read(1):
+                leading = read(5)
+                significant = read(6) or 64
+                trailing = 64 - leading - significant
+            v ^= read(64 - leading - trailing) << trailing
+        timestamps[i], values[i] = t, v
+    return timestamps, values
+
+class Matcher(namedtuple('Matcher', ['name', 'op', 'value'])):
+    def __new__(cls, name, op, value):
+        self = super().__new__(cls, name, op, value)
+        self.regex = re.compile(value) if op in ("=~", "!~") else None
+        return self
+
+    def matches(self, value):
+        if self.op == "=":
+            return value == self.value
+        if self.op == "!=":
+            return value != self.value
+        found = self.regex.fullmatch(value) is not None
+        return found if self.op == "=~" else not found
+
+SELECTOR_RE = re.compile(r'^\s*([a-zA-Z_:][a-zA-Z0-9_:]*)?\s*(?:\{(.*)\})?\s*$', re.S)
+MATCHER_RE = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*(=~|!~|!=|=)\s*"((?:[^"\\]|\\.)*)"\s*(?:,|$)')
+
+def parse_selector(selector):
+    # A plain series selector: metric{label="value", label!="value", label=~"regex", label!~"regex"}.
+    m = SELECTOR_RE.match(selector)
+    if m is None:
+        raise TsdbError(f"Invalid selector: {selector}")
+    matchers = []
+    if m.group(1):
+        matchers.append(Matcher("__name__", "=", m.group(1)))
+    body = (m.group(2) or "").strip()
+    pos = 0
+    while pos < len(body):
+        mm = MATCHER_RE.match(body, pos)
+        if mm is None:
+            raise TsdbError(f"Invalid selector: {selector}")
+        matchers.append(Matcher(mm.group(1), mm.group(2), json.loads(f'"{mm.group(3)}"')))
+        pos = mm.end()
+    if not matchers:
+        raise TsdbError(f"Empty selector: {selector}")
+    return matchers
+
+def _map(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class IndexReader:
+    def __init__(self, path):
+        self.buf = _map(path)
+        if be32(self.buf, 0) != INDEX_MAGIC:
+            raise TsdbError(f"{path}: not a TSDB index")
+        if self.buf[4] != 2:
+            raise TsdbError(f"{path}: unsupported index version {self.buf[4]}")
+        toc = len(self.buf) - 52
+        symbols_offset, _, _, _, _, postings_table_offset = (
+            int.from_bytes(self.buf[toc + 8 * i:toc + 8 * i + 8], "big") for i in range(6))
+        self.symbols = self._read_symbols(symbols_offset)
+        self.postings_offsets = self._read_postings_table(postings_table_offset)
+
+    def _read_symbols(self, offset):
+        count = be32(self.buf, offset + 4)
+        pos = offset + 8
+        symbols = []
+        for _ in range(count):
+            n, pos = uvarint(self.buf, pos)
+            symbols.append(self.buf[pos:pos + n].decode("utf-8"))
+            pos += n
+        return symbols
+
+    def _read_postings_table(self, offset):
+        count = be32(self.buf, offset + 4)
+        pos = offset + 8
+        table = {}
+        for _ in range(count):
+            _, pos = uvarint(self.buf, pos)
+            n, pos = uvarint(self.buf, pos)
+            name = self.buf[pos:pos + n].decode("utf-8")
+            pos += n
+            n, pos = uvarint(self.buf, pos)
+            value = self.buf[pos:pos + n].decode("utf-8")
+            pos += n
+            postings, pos = uvarint(self.buf, pos)
+            table.setdefault(name, {})[value] = postings
+        return table
+
+    def postings(self, name, value):
+        offset = self.postings_offsets.get(name, {}).get(value)
+        if offset is None:
+            return np.empty(0, np.uint32)
+        count = be32(self.buf, offset + 4)
+        return np.frombuffer(self.buf, dtype=">u4", count=count, offset=offset + 8).astype(np.uint32)
+
+    def select(self, matchers):
+        # Series refs for the label values selected by the positive matchers, then
+        # the series themselves, filtered by all matchers.
+        refs = None
+        for m in matchers:
+            if m.op not in ("=", "=~") or m.matches(""):
+                continue
+            values = self.postings_offsets.get(m.name, {})
+            union = [self.postings(m.name, v) for v in values if m.matches(v)]
+            selected = np.unique(np.concatenate(union)) if union else np.empty(0, np.uint32)
+            refs = selected if refs is None else np.intersect1d(refs, selected, assume_unique=True)
+        if refs is None:
+            refs = self.postings("", "")
+        for ref in refs:
+            labels, chunks = self.series(int(ref))
+            if all(m.matches(labels.get(m.name, "")) for m in matchers):
+                yield int(ref), labels, chunks
+
+    def series(self, ref):
+        # In the v2 format series are 16-byte aligned and referenced by offset / 16.
+        _, pos = uvarint(self.buf, ref * 16)
+        count, pos = uvarint(self.buf, pos)
+        labels = {}
+        for _ in range(count):
+            name, pos = uvarint(self.buf, pos)
+            value, pos = uvarint(self.buf, pos)
+            labels[self.symbols[name]] = self.symbols[value]
+        count, pos = uvarint(self.buf, pos)
+        chunks = []
+        maxt = chunk_ref = 0
+        for i in range(count):
+            if i == 0:
+                mint, pos = varint(self.buf, pos)
+            else:
+                d, pos = uvarint(self.buf, pos)
+                mint = maxt + d
+            d, pos = uvarint(self.buf, pos)
+            maxt = mint + d
+            if i == 0:
+                chunk_ref, pos = uvarint(self.buf, pos)
+            else:
+                d, pos = varint(self.buf, pos)
+                chunk_ref += d
+            chunks.append((mint, maxt, chunk_ref))
+        return labels, chunks
+
+class ChunkReader:
+    def __init__(self, path):
+        self.path = path
+        self.segments = {}
+
+    def segment(self, seq):
+        if seq not in self.segments:
+            buf = _map(os.path.join(self.path, f"{seq + 1:06d}"))
+            if be32(buf, 0) != CHUNKS_MAGIC:
+                raise TsdbError(f"{self.path}/{seq + 1:06d}: not a chunk segment")
+            self.segments[seq] = buf
+        return self.segments[seq]
+
+    def chunk(self, ref):
+        # The upper 32 bits of a chunk ref pick the segment file, the lower 32 the offset in it.
+        buf = self.segment(ref >> 32)
+        n, pos = uvarint(buf, ref & 0xffffffff)
+        return buf[pos], buf[pos + 1:pos + 1 + n]
+
+def read_tombstones(path):
+    intervals = {}
+    if not os.path.exists(path):
+        return intervals
+    with open(path, "rb") as f:
+        buf = f.read()
+    if len(buf) < 9 or be32(buf, 0) != TOMBSTONES_MAGIC:
+        return intervals
+    pos = 5
+    while pos < len(buf) - 4:
+        ref, pos = uvarint(buf, pos)
+        mint, pos = varint(buf, pos)
+        maxt, pos = varint(buf, pos)
+        intervals.setdefault(ref, []).append((mint, maxt))
+    return intervals
+
+class Block:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.min_time = self.meta["minTime"]
+        self.max_time = self.meta["maxTime"]
+        self._index = None
+        self._chunks = None
+        self._tombstones = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = IndexReader(os.path.join(self.path, "index"))
+        return self._index
+
+    @property
+    def chunks(self):
+        if self._chunks is None:
+            self._chunks = ChunkReader(os.path.join(self.path, "chunks"))
+        return self._chunks
+
+    @property
+    def tombstones(self):
+        if self._tombstones is None:
+            self._tombstones = read_tombstones(os.path.join(self.path, "tombstones"))
+        return self._tombstones
+
+    def select(self, matchers, mint=None, maxt=None):
+        # Yields (labels, timestamps in ms, values) for every matching series with samples in [mint, maxt].
+        mint = -(1 << 63) if mint is None else mint
+        maxt = (1 << 63) - 1 if maxt is None else maxt
+        for ref, labels, chunks in self.index.select(matchers):
+            timestamps, values = [], []
+            for chunk_mint, chunk_maxt, chunk_ref in chunks:
+                if chunk_maxt < mint or chunk_mint > maxt:
+                    continue
+                encoding, data = self.chunks.chunk(chunk_ref)
+                if encoding != CHUNK_ENCODING_XOR:
+                    continue
+                t, v = decode_xor(data)
+                timestamps.extend(t)
+                values.extend(v)
+            if not timestamps:
+                continue
+            t = np.array(timestamps, dtype=np.int64)
+            bits = np.array(values, dtype=np.uint64)
+            keep = (t >= mint) & (t <= maxt) & (bits != STALE_NAN)
+            for lo, hi in self.tombstones.get(ref, ()):
+                keep &= (t < lo) | (t > hi)
+            if keep.any():
+                yield labels, t[keep], bits[keep].view(np.float64)
+
+    def close(self):
+        if isinstance(getattr(self._index, "buf", None), mmap.mmap):
+            self._index.buf.close()
+        if self._chunks is not None:
+            for buf in self._chunks.segments.values():
+                if isinstance(buf, mmap.mmap):
+                    buf.close()
+
+def read_series(data_dir, selector, start=None, end=None):
+    # Like PrometheusClient.query_range without the step: all raw samples of the matching series
+    # between start and end (unix seconds), keyed by label set. Timestamps are in seconds.
+    matchers = parse_selector(selector)
+    mint = None if start is None else int(start * 1000)
+    maxt = None if end is None else int(end * 1000)
+    parts = {}
+    for name in list_blocks(data_dir):
+        block = Block(os.path.join(data_dir, name))
+        if (mint is not None and block.max_time <= mint) or (maxt is not None and block.min_time > maxt):
+            continue
+        try:
+            for labels, t, v in block.select(matchers, mint, maxt):
+                parts.setdefault(labels_key(labels), []).append((t, v))
+        finally:
+            block.close()
+    series = {}
+    for key, chunks in parts.items():
+        t = np.concatenate([c[0] for c in chunks])
+        v = np.concatenate([c[1] for c in chunks])
+        # Blocks may overlap (e.g. the head block cut by the snapshot); keep one sample per timestamp.
+        t, first = np.unique(t, return_index=True)
+        series[key] = Series(t / 1000.0, v[first])
+    return series
+
+def to_columns(series):
+    # Long format: one row per sample, one column per label name.
+    names = sorted({name for key in series for name, _ in key})
+    columns = {"timestamp": [], "value": [], **{name: [] for name in names}}
+    for key, s in series.items():
+        labels = dict(key)
+        columns["timestamp"].append(s.timestamps)
+        columns["value"].append(s.values)
+        for name in names:
+            columns[name].append(np.full(len(s.timestamps), labels.get(name), dtype=object))
+    return {name: (np.concatenate(parts) if parts else np.empty(0)) for name, parts in columns.items()}
+
+def write_parquet(series, path):
+    import pyarrow
+    import pyarrow.parquet
+    columns = to_columns(series)
+    table = pyarrow.table({name: pyarrow.array(values) for name, values in columns.items()})
+    pyarrow.parquet.write_table(table, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Read series from Prometheus TSDB blocks without running Prometheus")
+    parser.add_argument("data_dir", help="directory containing the TSDB blocks, e.g. the data/ written by download_metrics")
+    parser.add_argument("selector", help='series selector, e.g. scylla_reactor_utilization{shard="0"}')
+    parser.add_argument("--start", type=float, default=None, help="unix time in seconds")
+    parser.add_argument("--end", type=float, default=None, help="unix time in seconds")
+    parser.add_argument("--parquet", default=None, help="write the samples to this Parquet file (requires pyarrow)")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    series = read_series(args.data_dir, args.selector, args.start, args.end)
+    samples = sum(len(s.timestamps) for s in series.values())
+    print(f"{len(series)} series, {samples} samples in {time.monotonic() - start:.2f}s")
+    if args.parquet:
+        write_parquet(series, args.parquet)
+    else:
+        for key, s in series.items():
+            labels = ",".join(f'{name}="{value}"' for name, value in key)
+            print(f"{{{labels}}}: {len(s.timestamps)} samples, {s.timestamps[0]:.3f}..{s.timestamps[-1]:.3f}")
+
+if __name__ == "__main__":
+    main()
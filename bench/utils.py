@@ -1,29 +1,57 @@
 import asyncio
 import shlex
 import os
+import time
 from typing import List, Dict, Sequence
 import yaml
 import json
 import subprocess
 import urllib.parse
+from contextlib import nullcontext
+from functools import cached_property
+from bench.inventory import load_inventory
+from bench.transport import default_transport
+from bench.fanout import fanout, BEST_EFFORT
+from bench.readiness import ReadinessMonitor, start_nodes
+from bench.prometheus import PrometheusClient, scalar
+from bench.triggers import Condition, TriggerScheduler
+from bench import tsdb
+from bench.telemetry import CsTelemetry
+from bench.chunked import ChunkState, run_chunks
+import bench.snapshot
+from bench.collect import collect_archives
+from bench.scylla_config import ScyllaConfig
+from bench.profiling import ProfileCapture
+from bench.saturation import ClientSampler
+from bench import tracing
+from bench import hostsetup
+
+CASSANDRA_STRESS_URL = "https://github.com/scylladb/cassandra-stress/releases/download/v3.17.0/cassandra-stress-3.17.0-bin.tar.gz"
+SCYLLA_MONITORING_VERSION = "4.8.3"
+# Downloaded once into the monitor's artifact cache.
+ARTIFACTS = [CASSANDRA_STRESS_URL]
 
 def load_yaml(stream):
     return yaml.load(stream, Loader=yaml.SafeLoader)
 def dump_yaml(stream):
     return yaml.dump(stream, Dumper=yaml.SafeDumper)
 
-def load_inventory(deployment_name):
-    inventory_yaml = subprocess.run(['bin/ansible-inventory', deployment_name, '--list', '--yaml'], check=True, capture_output=True).stdout
-    return load_yaml(inventory_yaml)["all"]["children"]
-
 async def run(command: Sequence[str], stdin_data=None, **kwargs):
+    start = time.monotonic()
+    returncode = None
+    stdout = stderr = None
     try:
         proc = await asyncio.create_subprocess_exec(*command, **kwargs);
         stdout, stderr = await proc.communicate(stdin_data)
+        returncode = proc.returncode
         return stdout, stderr, proc.returncode
     except asyncio.exceptions.CancelledError:
         proc.terminate()
         raise
+    finally:
+        if tracing.enabled():
+            tracing.record(os.path.basename(command[0]), "run", None, start, time.monotonic(), command=tracing.short_command(command, 500),
+                           returncode=returncode, bytes_in=len(stdin_data or b""), bytes_out=len(stdout or b"") + len(stderr or b""))
 
 async def check_output(command: Sequence[str]):
     stdout, stderr, returncode = await run(command, stdout=asyncio.subprocess.PIPE)
@@ -41,30 +69,81 @@ async def clean_cancel(task):
     except asyncio.CancelledError:
         pass
 
+# ssh and ssh_output are left out: the commands themselves are traced by the transport.
+@tracing.traced_methods(exclude=("ssh", "ssh_output", "ssh_relogin"))
 class Deployment:
-    def __init__(self, name):
+    def __init__(self, name, transport=None, inventory=None):
+        # The inventory (and with it the host lists) is only loaded when first used.
         self.name = name
-        self.inventory = load_inventory(name)
-        self.server_hosts = self.inventory.get("server", {}).get("hosts", {})
-        self.client_hosts = self.inventory.get("client", {}).get("hosts", {})
-        self.monitor_host = next(iter(self.inventory["monitor"]["hosts"]))
+        self.transport = transport or default_transport(name)
+        if inventory is not None:
+            self.inventory = inventory
+        self.readiness = ReadinessMonitor(self)
+        self.tablets = None
+        self._prometheus = None
+        self._prometheus_forward = None
+        self._prometheus_lock = asyncio.Lock()
+        self.triggers = TriggerScheduler(self.prometheus)
+        # Setup downloads packages and artifacts through caches on the monitor. cache is its
+        # (host, private ip), looked up in the inventory when None; see find_cache().
+        self.use_cache = True
+        self.cache = None
+        self._setup_cache = None
+        # Async context managers held around every rsync and every HDR processing job; a Fleet
+        # (bench/fleet.py) sets them to shares of budgets which several deployments draw from.
+        self.rsync_slots = None
+        self.hdr_slots = None
+
+    @cached_property
+    def inventory(self):
+        return load_inventory(self.name)
+
+    @cached_property
+    def server_hosts(self):
+        return self.inventory.get("server", {}).get("hosts", {})
+
+    @cached_property
+    def client_hosts(self):
+        return self.inventory.get("client", {}).get("hosts", {})
+
+    @cached_property
+    def monitor_host(self):
+        return next(iter(self.inventory["monitor"]["hosts"]))
 
     async def ssh(self, host, command: str, stdout=None, stderr=None, stdin_data=None):
-        return await run(["bin/ssh", self.name, host, command], stdin=asyncio.subprocess.PIPE, stdout=stdout, stderr=stderr, stdin_data=stdin_data);
+        return await self.transport.run(host, command, stdin_data=stdin_data, stdout=stdout, stderr=stderr)
     async def ssh_relogin(self, host):
-        return await run(["bin/ssh", self.name, "-Ostop", host])
+        return await self.transport.relogin(host)
     async def ssh_output(self, host, command: str, stdin=None, stdout=None, stderr=None):
-        return await check_output(["bin/ssh", self.name, host, command])
-    async def pssh(self, hosts: Sequence[str], command: str, stdout=None, stderr=None):
-        await asyncio.gather(*[self.ssh(host, command) for host in hosts])
+        stdout, stderr, returncode = await self.transport.run(host, command, stdout=asyncio.subprocess.PIPE)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, stdout)
+        return stdout
+    def ssh_stream(self, host, command: str, stdin_data=None):
+        return self.transport.stream(host, command, stdin_data=stdin_data)
+    async def close(self):
+        await self.readiness.close()
+        await self.triggers.close()
+        if self._prometheus is not None:
+            self._prometheus.close()
+            await self._prometheus_forward.close()
+            self._prometheus = None
+        await self.transport.close()
+    async def pssh(self, hosts: Sequence[str], command: str, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                   stdin_data=None, limit=None, timeout=None, policy=BEST_EFFORT, ok_codes=(0,)):
+        result = await fanout(hosts, lambda host: self.ssh(host, command, stdout=stdout, stderr=stderr, stdin_data=stdin_data),
+                              limit=limit, timeout=timeout, policy=policy, ok_codes=ok_codes)
+        if not result.ok and policy == BEST_EFFORT:
+            print(f"pssh {command.strip().splitlines()[0]!r}: {result.report()}")
+        return result
 
     async def wait_for_cql(self, host):
-        cmd = 'until grep -q "^[^:]*:9042" <(ss -tln); do sleep 1; done'
-        await self.ssh(host, cmd)
+        await self.readiness.wait_for_cql(host)
 
-    async def wait_for_machine_image(self):
+    async def wait_for_machine_image(self, server_hosts: Sequence[str] = None):
+        server_hosts = server_hosts or self.server_hosts
         cmd = 'until test -e /etc/scylla/machine_image_configured; do sleep 1; done'
-        await self.pssh(self.server_hosts, cmd)
+        (await self.pssh(server_hosts, cmd)).check()
 
     async def configure_prometheus_yaml(self):
         path = "scylla-monitoring/prometheus/prometheus.yml.template"
@@ -74,10 +153,12 @@ class Deployment:
         path = "scylla-monitoring/grafana/datasource.yml"
         await self.ssh(self.monitor_host, fr"sed -i {path} -e 's/^    timeInterval:.*$/    timeInterval: '\'1s\''/'")
 
-    async def configure_scylla_yaml(self, extra_opts={}):
-        yamls_raw = await asyncio.gather(*[self.ssh_output(k, "cat /etc/scylla/scylla.yaml") for k in self.server_hosts])
-        yamls = list(zip(self.server_hosts.items(), (load_yaml(x) for x in yamls_raw)))
-        for (k, v), y in yamls:
+    async def configure_scylla_yaml(self, extra_opts={}, files=None, restart=False):
+        # Only nodes whose scylla.yaml (or /etc/scylla.d `files`, {name: contents}) actually change are
+        # written; see bench/scylla_config.py. Live-updatable options are applied with SIGHUP. Running
+        # nodes which need a restart are restarted one at a time with restart=True, else only reported.
+        def desired(host, y):
+            v = self.server_hosts[host]
             y["seed_provider"][0]["parameters"][0]["seeds"] = v["seed"]
             y["cluster_name"] = "sso-cluster"
             if v["private_ip"] == v["seed"]:
@@ -87,26 +168,76 @@ class Deployment:
                 y["ring_delay_ms"] = 10000
             y["enable_tablets"] = "true"
             y.update(extra_opts)
-        await asyncio.gather(*[self.ssh(k, "sudo tee /etc/scylla/scylla.yaml >/dev/null", stdin_data=dump_yaml(y).encode("utf-8")) for (k, v), y in yamls])
-        await self.pssh(self.server_hosts, "sudo pkill -SIGHUP scylla")
+            self.tablets = str(y["enable_tablets"]).lower() == "true"
+            return y
+        plan = await self.scylla_config.plan(desired, files)
+        print(plan)
+        return await self.scylla_config.apply(plan, restart=restart)
+
+    @cached_property
+    def scylla_config(self):
+        return ScyllaConfig(self)
+
+    def find_cache(self):
+        # None without use_cache, or while there is no monitor yet, e.g. while provision() is still
+        # creating the instances (on_host may set self.cache from the monitor's instance instead).
+        # Until then the inventory is read without being kept, so a partial one isn't frozen
+        # into the inventory and host properties.
+        if not self.use_cache:
+            return None
+        if self.cache is None:
+            inventory = self.__dict__.get("inventory")
+            if inventory is None:
+                try:
+                    inventory = load_inventory(self.name)
+                except (OSError, subprocess.CalledProcessError):
+                    return None
+            for host, host_vars in inventory.get("monitor", {}).get("hosts", {}).items():
+                if host_vars.get("private_ip"):
+                    self.cache = (host, host_vars["private_ip"])
+                break
+        return self.cache
+
+    async def setup(self, hosts: Sequence[str], steps, force=False):
+        # Applies fingerprinted setup steps, skipping the hosts which already have them; see bench/hostsetup.py.
+        return await hostsetup.run_setup(self, hosts, steps, force=force)
+
+    async def setup_cache(self):
+        # The package and artifact caches on the monitor; returns their address, or None without them.
+        # setup_monitor, setup_servers and setup_clients may run concurrently, so the caches are set up
+        # once and the others wait for them. A failed setup is retried by the next caller.
+        cache = self.find_cache()
+        if cache is None:
+            return None
+        if self._setup_cache is None:
+            self._setup_cache = asyncio.ensure_future(self.setup(
+                [cache[0]],
+                [hostsetup.apt_install(["apt-cacher-ng", "docker.io", "unzip", "wget", "fish", "python3"]),
+                 hostsetup.artifact_server(),
+                 *(hostsetup.cache_artifact(url) for url in ARTIFACTS)]))
+        future = self._setup_cache
+        try:
+            await asyncio.shield(future)
+        except BaseException:
+            if future.done() and self._setup_cache is future:
+                self._setup_cache = None
+            raise
+        return cache[1]
 
     async def setup_monitor(self):
-        aptget = "apt-get -oDPkg::Lock::Timeout=-1"
-        command = f"""sudo bash <<EOF
-               {aptget} update
-               {aptget} install -y docker.io unzip wget fish
-               #python3 -m pip install pyyaml
-               #python3 -m pip install -I -U psutil
-               systemctl start docker 
-               usermod -aG docker $USER
-        \nEOF"""
-        await self.ssh(self.monitor_host, command)
-        await self.ssh_relogin(self.monitor_host)
-        command = """bash <<EOF
-            git -C scylla-monitoring fetch -q origin || git clone -q https://github.com/scylladb/scylla-monitoring
-            git -C scylla-monitoring checkout -q 4.8.3
-        \nEOF"""
-        await self.ssh(self.monitor_host, command)
+        cache_ip = await self.setup_cache()
+        steps = [hostsetup.apt_install(["docker.io", "unzip", "wget", "fish"])] if cache_ip is None else []
+        steps += [
+            hostsetup.SetupStep("docker", "sudo systemctl start docker\nsudo usermod -aG docker $USER"),
+            hostsetup.SetupStep("scylla-monitoring", f"""
+git -C scylla-monitoring fetch -q origin || git clone -q https://github.com/scylladb/scylla-monitoring
+git -C scylla-monitoring checkout -q {SCYLLA_MONITORING_VERSION}
+"""),
+        ]
+        report = await self.setup([self.monitor_host], steps)
+        if hostsetup.applied(report, "docker"):
+            # The docker group only applies to new logins.
+            await self.ssh_relogin(self.monitor_host)
         config = [{
             "targets": [f'{v["private_ip"]}:9180' for v in self.server_hosts.values()],
             "labels": {"cluster": "cluster1", "dc": "dc1"},
@@ -116,50 +247,126 @@ class Deployment:
         await self.ssh(self.monitor_host, "tee scylla-monitoring/prometheus/scylla_servers.yml >/dev/null", stdin_data=dump_yaml(config).encode("utf-8"))
         await self.ssh(self.monitor_host, "cd scylla-monitoring; ./start-all.sh -d ../data -v 2024.2 -b --web.enable-admin-api --no-loki --no-renderer")
 
-    async def setup_clients(self):
-        aptget = "apt-get -oDPkg::Lock::Timeout=-1"
-        command = f"""sudo bash -xeu <<EOF
-               {aptget} update
-               {aptget} install -y openjdk-11-jre fish
-               wget https://github.com/scylladb/cassandra-stress/releases/download/v3.17.0/cassandra-stress-3.17.0-bin.tar.gz
-               tar xf cassandra-stress*.tar.gz
-        \nEOF"""
-        await asyncio.gather(
-            self.pssh(self.client_hosts, command),
-        )
-
-    async def setup_servers(self):
-        aptget = "apt-get -oDPkg::Lock::Timeout=-1"
-        command = f"""sudo bash -xeu <<EOF
-               {aptget} update
-               {aptget} install -y linux-tools-common linux-tools-$(uname -r) blktrace fio fish rsync less openjdk-11-jre-headless lttng-tools htop
-        \nEOF"""
-        await self.pssh(self.server_hosts, command)
+    def package_steps(self, packages):
+        return [hostsetup.apt_proxy(), hostsetup.apt_install(packages)]
+
+    async def setup_clients(self, client_hosts: Sequence[str] = None, force=False):
+        client_hosts = client_hosts or self.client_hosts
+        await hostsetup.point_to_cache(self, client_hosts, await self.setup_cache())
+        await self.setup(client_hosts, [
+            *self.package_steps(["openjdk-11-jre", "fish"]),
+            hostsetup.fetch_and_unpack("cassandra-stress", CASSANDRA_STRESS_URL),
+        ], force=force)
+
+    async def setup_servers(self, server_hosts: Sequence[str] = None, force=False):
+        server_hosts = server_hosts or self.server_hosts
+        await hostsetup.point_to_cache(self, server_hosts, await self.setup_cache())
+        steps = self.package_steps(["blktrace", "fio", "fish", "rsync", "less", "openjdk-11-jre-headless", "lttng-tools", "htop"])
+        # linux-tools must match the running kernel. The release is part of its step, so a kernel
+        # upgrade reapplies it; hosts on different kernels are set up separately.
+        releases = (await self.pssh(server_hosts, "uname -r")).check()
+        by_release = {}
+        for host in server_hosts:
+            by_release.setdefault(releases[host].stdout.decode().strip(), []).append(host)
+        await asyncio.gather(*(self.setup(hosts, [*steps, hostsetup.apt_install(["linux-tools-common", f"linux-tools-{release}"], name="linux-tools")],
+                                          force=force)
+                               for release, hosts in by_release.items()))
 
     async def rsync(self, src, dest, *options):
-        await run(["rsync", *options, "-r", "-e", f"bin/ssh {self.name}", src, dest])
+        async with self.rsync_slots or nullcontext():
+            await run(["rsync", *options, "-r", "-e", f"bin/ssh {self.name}", src, dest])
 
     async def collect(self, hosts: Sequence[str], src, dest_dir, *options):
         await run(["mkdir", "-p", dest_dir])
         await asyncio.gather(*[self.rsync(f"{host}:{src}", f"{dest_dir}/{host}/", "--mkpath", *options) for host in hosts])
 
+    async def collect_archive(self, hosts: Sequence[str], root, dest_dir, **kwargs):
+        # Streams root from every host into {dest_dir}/{host}/ as one compressed tar stream per host.
+        # See bench/collect.py for the filters, size limits and the shared `bandwidth` limit.
+        return await collect_archives(self.transport, hosts, root, dest_dir, **kwargs)
+
+    def profile(self, hosts: Sequence[str], kinds=("perf",), dest_dir="profiles", phase=None, duration=None, **options):
+        # A ProfileCapture (see bench/profiling.py): use it as `async with` around a phase of the
+        # test, pass it to cs(profile=...), or await its run() for a fixed window of `duration` seconds.
+        return ProfileCapture(self, hosts, kinds, dest_dir, phase, duration, **options)
+
     async def stop_cs(self, /, client_hosts: Sequence[str] = None):
         client_hosts = client_hosts or self.client_hosts
-        await self.pssh(client_hosts, "pkill --full org.apache.cassandra.stress")
-
-    async def cs(self, /, options, server_hosts: Sequence[str] = None, client_hosts: Sequence[str] = None, cs = "cassandra-stress"):
+        return await self.pssh(client_hosts, "pkill --full org.apache.cassandra.stress", ok_codes=(0, 1))
+
+    async def cs(self, /, options, server_hosts: Sequence[str] = None, client_hosts: Sequence[str] = None, cs = "cassandra-stress",
+                 telemetry: CsTelemetry = None, saturation: ClientSampler = None, profile: ProfileCapture = None):
+        # With telemetry, the clients' intervals are merged and streamed while the load is running
+        # (see CsTelemetry.windows() and keep_windows). If its SLO is violated, the clients are stopped and cs()
+        # raises SloViolation. With saturation, the clients' CPU, network and GC are sampled during
+        # the load and judged in saturation.report (see bench/saturation.py). With profile (a capture
+        # from self.profile()), the load is profiled, and the capture is tagged with this cs() phase.
+        if profile is not None:
+            if profile.phase is None:
+                profile.phase = options.split()[0]
+            profile.cs_options = options
+            async with profile:
+                return await self.cs(options, server_hosts, client_hosts, cs, telemetry, saturation)
         server_hosts = server_hosts or self.server_hosts
         client_hosts = client_hosts or self.client_hosts
-        await self.pssh(client_hosts, "pkill --full org.apache.cassandra.stress")
+        await self.stop_cs(client_hosts=client_hosts)
         node = "-node {}".format(','.join(v["private_ip"] for v in server_hosts.values()))
         mode = "-mode native cql3 protocolVersion=4 maxPending=4096"
         command = f"{cs} {options} {node} {mode}"
-        await self.pssh(client_hosts, command)
-
-    async def populate(self, /, n_rows, options, server_hosts: Sequence[str] = None, client_hosts: Sequence[str] = None, cs = "cassandra-stress", tablets: bool = False):
+        if telemetry is None and saturation is None:
+            return await self.pssh(client_hosts, command, stdout=None)
+        if telemetry is None:
+            # The GC columns are read from the output, so it is streamed.
+            telemetry = CsTelemetry()
+
+        if telemetry.on_violation is None:
+            async def on_violation(violation):
+                print(f'{violation}. Stopping cassandra-stress.')
+                await self.stop_cs(client_hosts=client_hosts)
+            telemetry.on_violation = on_violation
+
+        async def client(host):
+            tail = None
+            if telemetry.source == "hdr":
+                await self.ssh(host, f"rm -f {telemetry.hdr_file}")
+                tail = asyncio.create_task(telemetry.follow_hdr(self.ssh_stream(host, f"exec tail -n +1 -F {telemetry.hdr_file} 2>/dev/null"), host))
+            stream = self.ssh_stream(host, command)
+            try:
+                await telemetry.follow_stdout(stream if saturation is None else saturation.watch(host, stream), host)
+                if tail is not None:
+                    # Give the tail a chance to pick up the last intervals.
+                    await asyncio.sleep(2 * telemetry.interval)
+            finally:
+                if tail is not None:
+                    await clean_cancel(tail)
+                await telemetry.finish(host)
+            return None, None, stream.returncode
+
+        telemetry.start(client_hosts)
+        if saturation is not None:
+            saturation.start(client_hosts)
+        try:
+            result = await fanout(client_hosts, client)
+        finally:
+            await telemetry.close()
+            if saturation is not None:
+                print(await saturation.stop())
+        if telemetry.violation is not None:
+            raise telemetry.violation
+        if not result.ok:
+            print(f"cs: {result.report()}")
+        return result
+
+    async def populate(self, /, n_rows, options, server_hosts: Sequence[str] = None, client_hosts: Sequence[str] = None, cs = "cassandra-stress", tablets: bool = False,
+                       chunk_size: int = None, concurrency: int = 1, state_file: str = None, saturation: ClientSampler = None):
+        # By default every client loads one fixed range of keys. With chunk_size, the keys are
+        # split into chunks which the clients (`concurrency` cassandra-stress processes each) take
+        # from a shared queue. With state_file, completed chunks are recorded there and a rerun
+        # after an interruption only loads the rest. With saturation, the clients' CPU and network
+        # are sampled during the load (GC isn't, the output of the loads isn't parsed).
         server_hosts = server_hosts or self.server_hosts
         client_hosts = client_hosts or self.client_hosts
-        await self.pssh(client_hosts, f"pkill --full org.apache.cassandra.stress")
+        await self.stop_cs(client_hosts=client_hosts)
 
         n = n_rows
         k = len(client_hosts)
@@ -176,108 +383,159 @@ class Deployment:
         # Create schema.
         await self.ssh(next(iter(self.client_hosts)), f'{cs} write no-warmup cl=ALL n=1 -pop seq=1..1 {node} {mode} {options} >/dev/null')
         await self.ssh(server_0_name, f'cqlsh -e "ALTER KEYSPACE keyspace1 WITH DURABLE_WRITES = false;" {server_0_vars["private_ip"]}')
-        await asyncio.gather(*[
-            self.ssh(host, f'{cs} write no-warmup cl=ALL n={range_end-range_start} -pop seq={range_start+1}..{range_end} {node} {mode} {options}')
-            for (host, (range_start, range_end)) in zip(self.client_hosts, ranges)
-        ])
+        if saturation is not None:
+            saturation.start(client_hosts)
+        try:
+            if chunk_size is None:
+                await asyncio.gather(*[
+                    self.ssh(host, f'{cs} write no-warmup cl=ALL n={range_end-range_start} -pop seq={range_start+1}..{range_end} {node} {mode} {options}')
+                    for (host, (range_start, range_end)) in zip(self.client_hosts, ranges)
+                ])
+            else:
+                state = ChunkState(n_rows, chunk_size, state_file, key=options)
+                def load_chunk(host, chunk):
+                    (range_start, range_end) = chunk
+                    return self.ssh(host, f'{cs} write no-warmup cl=ALL n={range_end-range_start} -pop seq={range_start+1}..{range_end} {node} {mode} {options}',
+                                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                await run_chunks(state, list(client_hosts), load_chunk, concurrency=concurrency)
+        finally:
+            if saturation is not None:
+                print(await saturation.stop())
         await self.ssh(server_0_name, f'cqlsh -e "ALTER KEYSPACE keyspace1 WITH DURABLE_WRITES = true;" {server_0_vars["private_ip"]}')
 
-    async def start_cluster(self, server_hosts: Sequence[str] = None):
+    async def start_cluster(self, server_hosts: Sequence[str] = None, concurrent_bootstrap: bool = None, limit: int = None):
+        # Non-seed nodes bootstrap one at a time unless the caller says concurrent
+        # bootstrap is safe, which we assume for tablets clusters: enable_tablets is read
+        # from the seed's scylla.yaml unless configure_scylla_yaml just set it.
+        # Returns the time-to-CQL of every node.
         server_hosts = {x: self.server_hosts[x] for x in (server_hosts or self.server_hosts)}
         seed = next(k for (k, v) in server_hosts.items() if v["private_ip"] == v["seed"])
         non_seeds = [x for x in server_hosts if x != seed]
-        await self.ssh(seed, 'sudo systemctl start scylla-server')
-        await self.wait_for_cql(seed)
-        # Does it really have to be sequential?
-        for x in non_seeds:
-            await self.ssh(x, 'sudo systemctl start scylla-server')
-            await self.wait_for_cql(x)
+        if concurrent_bootstrap is None:
+            if self.tablets is None:
+                config = (await self.scylla_config.remote_state(seed))["config"]
+                self.scylla_config.save_cache()
+                self.tablets = str(config.get("enable_tablets", False)).lower() == "true"
+            concurrent_bootstrap = self.tablets
+        concurrency = (limit or len(non_seeds) or 1) if concurrent_bootstrap else 1
+        return await start_nodes(self, [seed], non_seeds, concurrency=concurrency)
 
     async def start_nodes_in_parallel(self, server_hosts: Sequence[str] = None):
         server_hosts = {x: self.server_hosts[x] for x in (server_hosts or self.server_hosts)}
-        await self.pssh(server_hosts, 'sudo systemctl start scylla-server')
-        for x in server_hosts:
-            await self.wait_for_cql(x)
+        return await start_nodes(self, [], list(server_hosts), concurrency=len(server_hosts) or 1)
 
     async def stop_cluster(self):
-        await self.pssh(self.server_hosts, 'sudo systemctl stop scylla-server')
+        (await self.pssh(self.server_hosts, 'sudo systemctl stop scylla-server')).check()
 
     async def reset_cluster(self):
-        await self.pssh(self.server_hosts, """
+        (await self.pssh(self.server_hosts, """
             sudo bash <<EOF
             shopt -s extglob
             systemctl stop scylla-server
             rm -rf /var/lib/scylla/!(backup)
             sudo mkdir /var/lib/scylla/{data,hints,view_hints,commitlog}
             sudo chown scylla /var/lib/scylla/{data,hints,view_hints,commitlog}
-            \nEOF""")
+            \nEOF""")).check()
 
     async def download_metrics(self, dest_dir):
+        # Incremental: blocks are immutable and named by ULID, so only the blocks
+        # which are not in {dest_dir}/data yet are fetched. Local blocks which are
+        # no longer in the snapshot (compacted into bigger ones) are removed.
         response = await self.ssh_output(self.monitor_host, "curl --silent -XPOST http://localhost:9090/api/v1/admin/tsdb/snapshot")
         snapshot_name = json.loads(response.decode("utf-8"))["data"]["name"]
-        await self.rsync(f'{self.monitor_host}:data/snapshots/{snapshot_name}/', f"{dest_dir}/data", "--mkpath")
+        snapshot_dir = f"data/snapshots/{snapshot_name}"
+        remote_blocks = (await self.ssh_output(self.monitor_host, f"ls {snapshot_dir}")).decode("utf-8").split()
+        local_blocks = set(tsdb.list_blocks(f"{dest_dir}/data"))
+        missing = [block for block in remote_blocks if block not in local_blocks]
+        print(f'Metrics snapshot {snapshot_name}: {len(remote_blocks)} blocks, {len(missing)} to download')
+        incoming = f"{dest_dir}/data/.incoming"
+        if missing:
+            command = ["rsync", "-r", "--mkpath", "--files-from=-", "-e", f"bin/ssh {self.name}", f"{self.monitor_host}:{snapshot_dir}/", f"{incoming}/"]
+            async with self.rsync_slots or nullcontext():
+                _, _, returncode = await run(command, stdin_data="\n".join(missing).encode("utf-8"), stdin=asyncio.subprocess.PIPE)
+            if returncode != 0:
+                # Leave the partial download in .incoming; only complete blocks are ever installed.
+                raise subprocess.CalledProcessError(returncode, command)
+        tsdb.install_blocks(incoming, f"{dest_dir}/data", set(remote_blocks))
+        # Snapshot blocks are hard links which pin the disk space of compacted blocks on the monitor.
+        await self.ssh(self.monitor_host, f"rm -rf {snapshot_dir}")
 
     async def clean_metrics(self):
         # %2B is * in URL encoding, so '__name__=~".%2B"' means 'any name'
         await self.ssh(self.monitor_host, """curl --silent -X POST -g 'http://localhost:9090/api/v1/admin/tsdb/delete_series?match[]={__name__=~".%2B"}'""")
 
+    async def prometheus(self):
+        # One forwarded, kept-alive connection to the monitor's Prometheus, shared by all callers.
+        async with self._prometheus_lock:
+            if self._prometheus is None:
+                self._prometheus_forward = await self.transport.forward(self.monitor_host, 9090)
+                self._prometheus = PrometheusClient(self._prometheus_forward.host, self._prometheus_forward.port)
+            return self._prometheus
+
     async def query_prometheus(self, query_string):
-        url = f"http://localhost:9090/api/v1/query"
-        response = await self.ssh_output(self.monitor_host, f"curl --silent {shlex.quote(url)} --data-urlencode query={shlex.quote(query_string)}")
-        return json.loads(response.decode("utf-8"))
+        return await (await self.prometheus()).query_raw(query_string)
+
+    async def wait_for(self, condition, timeout=None, **kwargs):
+        # Waits until a condition over a Prometheus expression is met, e.g. "sum(x) == 0 for 3 polls"
+        # or a bench.triggers.Condition; keyword arguments go to Condition (min_interval, max_interval...).
+        # Returns the Observation which met it. See bench/triggers.py.
+        if isinstance(condition, str):
+            condition = Condition.parse(condition, **kwargs)
+        return await self.triggers.wait(condition, timeout)
+
+    def on(self, condition, callback, once=True):
+        # Calls callback(observation) when the condition is met (every time it becomes met
+        # again, without once). Returns the Trigger; stop it with self.triggers.remove().
+        return self.triggers.add(condition, callback, once)
 
     async def wait_for_compaction_end(self, poll_period=20, required_good_polls=3):
-        query_string=r'sum(scylla_compaction_manager_compactions{})'
-        print(f'Waiting for all compactions to end. Checking every {poll_period}s, waiting for 3 consecutive zero results:')
-        good_polls = 0
-        while True:
-            response = await self.query_prometheus(query_string)
-            #print(response)
-            ongoing_compactions = int(response["data"]["result"][0]["value"][1])
-            print(f'Number of ongoing compactions: {ongoing_compactions}')
-            if ongoing_compactions == 0:
-                good_polls += 1
-            else:
-                good_polls = 0
-            if good_polls >= required_good_polls:
-                break
-            else:
-                await asyncio.sleep(poll_period)
-
-    async def wait_for_long_queue(self):
-        query_string=r'max(scylla_io_queue_queue_length{class="sl:default"})'
-        poll_period=0.5
-        print(f'Waiting for long sl:default IO queue. Checking every {poll_period}s:')
-        while True:
-            response = await self.query_prometheus(query_string)
-            print(response)
-            result = int(response["data"]["result"][0]["value"][1])
-            print(f'Queue length: {result}')
-            if result > 80:
-                break
-            await asyncio.sleep(poll_period)
+        # No compactions on required_good_polls polls in a row, spanning at least (required_good_polls - 1) * poll_period.
+        await self.wait_for(Condition("sum(scylla_compaction_manager_compactions{})", "==", 0, polls=required_good_polls,
+                                      for_seconds=poll_period * (required_good_polls - 1), max_interval=poll_period))
+
+    async def wait_for_long_queue(self, threshold=80, for_seconds=0):
+        await self.wait_for(Condition('max(scylla_io_queue_queue_length{class="sl:default"})', ">", threshold,
+                                      for_seconds=for_seconds, max_interval=2.0))
 
     async def quiesce(self):
-        await self.pssh(self.server_hosts, "nodetool flush")
+        (await self.pssh(self.server_hosts, "nodetool flush")).check()
         await self.wait_for_compaction_end()
 
-    async def backup_data(self):
-        await self.pssh(self.server_hosts, """
-            sudo bash <<EOF
-            shopt -s extglob
-            systemctl stop scylla-server
-            rm -rf /var/lib/scylla/backup
-            mkdir /var/lib/scylla/backup
-            sudo cp -aR --reflink=auto /var/lib/scylla/!(backup) /var/lib/scylla/backup/
-            \nEOF""")
-
-    async def restore_data(self):
-        await self.pssh(self.server_hosts, """
+    async def snapshot_engine(self, hosts, *args):
+        # Runs bench/snapshot.py on the hosts and returns the per-host results it prints.
+        with open(bench.snapshot.__file__, "rb") as f:
+            source = f.read()
+        result = (await self.pssh(hosts, f"sudo python3 - {shlex.join(args)}", stdin_data=source)).check()
+        return {r.host: json.loads(r.stdout.decode("utf-8").strip().splitlines()[-1]) for r in result}
+
+    def print_snapshot_stats(self, what, stats):
+        for host, s in stats.items():
+            print(f"{host}: {what} {s['files']} files, {s['bytes'] / 2**30:.2f} GiB in {s['seconds']:.1f}s "
+                  f"(reflinked {s['reflinked_bytes'] / 2**30:.2f} GiB, copied {s['copied_bytes'] / 2**30:.2f} GiB, "
+                  f"unchanged {s['skipped_files']} files / {s['skipped_bytes'] / 2**30:.2f} GiB, removed {s['removed_files']} files)")
+            if s['copied_bytes'] and not s['reflink']:
+                print(f"{host}: reflinks are not supported on /var/lib/scylla, files were fully copied")
+
+    async def backup_data(self, name="default"):
+        # Named snapshots live in /var/lib/scylla/backup/{name}, with a manifest of sizes and mtimes (no hashes,
+        # see snapshot.py). A backup taken before snapshots were named is moved into "default" on first use.
+        (await self.pssh(self.server_hosts, "sudo systemctl stop scylla-server")).check()
+        stats = await self.snapshot_engine(self.server_hosts, "snapshot", "/var/lib/scylla", f"/var/lib/scylla/backup/{name}", "--exclude", "backup")
+        self.print_snapshot_stats(f"snapshot {name}:", stats)
+        return stats
+
+    async def restore_data(self, name="default", verify=False):
+        # Only the files which differ from the snapshot are copied back; verify also compares their contents.
+        (await self.pssh(self.server_hosts, "sudo systemctl stop scylla-server")).check()
+        stats = await self.snapshot_engine(self.server_hosts, "restore", f"/var/lib/scylla/backup/{name}", "/var/lib/scylla", "--exclude", "backup",
+                                           *(["--verify"] if verify else []))
+        (await self.pssh(self.server_hosts, """
             sudo bash <<EOF
-            shopt -s extglob
-            systemctl stop scylla-server
-            rm -rf /var/lib/scylla/!(backup)
-            sudo cp -aR --reflink=auto /var/lib/scylla/backup/* /var/lib/scylla/
-            sudo mkdir /var/lib/scylla/{data,hints,view_hints,commitlog}
-            sudo chown scylla /var/lib/scylla/{data,hints,view_hints,commitlog}
-            \nEOF""")
+            mkdir -p /var/lib/scylla/{data,hints,view_hints,commitlog}
+            chown scylla /var/lib/scylla/{data,hints,view_hints,commitlog}
+            \nEOF""")).check()
+        self.print_snapshot_stats(f"restore {name}:", stats)
+        return stats
+
+    async def list_backups(self):
+        return await self.snapshot_engine(self.server_hosts, "list", "/var/lib/scylla/backup")
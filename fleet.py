@@ -0,0 +1,36 @@
+import asyncio
+import json
+import shlex
+import sys
+import bench.utils
+from bench.experiment import Experiment, expand_matrix
+from bench.fleet import Fleet, FleetLimits
+from bench.results import ResultStore
+
+# The sweep of sweep.py on several deployments, from one process: python fleet.py <deployment> [<deployment> ...]
+dnames = sys.argv[1:]
+for dname in dnames:
+    assert shlex.quote(dname)
+CS="JAVA=$(realpath /usr/lib/jvm/java-11*/bin/java) CLASSPATH=$(echo `ls -1 cas*/lib/*.jar cas*/tools/lib/*.jar` | tr ' ' ':') cas*/tools/bin/cassandra-stress"
+
+runs = expand_matrix(
+    scylla_yaml={"compaction_static_shares": [0, 100]},
+    cs={"rate": ["fixed=12000/s", "fixed=24000/s"]},
+)
+
+fleet = Fleet(FleetLimits(ssh=64, rsync=8))
+
+async def sweep(d):
+    fleet.set_phase(d, "sweep")
+    e = Experiment(d, f"{d.name}/sweep", runs=runs, cs=CS, server_hosts=list(d.server_hosts)[:3], store=ResultStore(f"{d.name}/results.db"), cs_options=
+        "read no-warmup cl=QUORUM duration=10m -rate threads=300 {rate} -col 'size=FIXED(128) n=FIXED(8)' "
+        "-pop 'dist=gauss(1..100000000,50000000,1500000)' -log hdrfile={hdr_file} interval=1s")
+    return await e.sweep()
+
+async def full():
+    for dname in dnames:
+        fleet.add(bench.utils.Deployment(dname), sweep)
+    results = await fleet.run()
+    print(json.dumps({name: repr(r) if isinstance(r, Exception) else r for name, r in results.items()}, indent=1))
+
+asyncio.run(full())
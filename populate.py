@@ -3,7 +3,7 @@ import shlex
 import os
 import sys
 from textwrap import dedent
-import bench.hdr, bench.utils
+import bench.hdr, bench.utils, bench.scylla_config
 from datetime import datetime
 from bench.utils import run
 import time
@@ -38,6 +38,8 @@ async def full():
         n_rows=100000000,
         options="-rate threads=300 -schema 'replication(strategy=SimpleStrategy,replication_factor=3)' -col 'size=FIXED(128)' 'n=FIXED(8)'",
         tablets=True,
+        chunk_size=1000000,
+        state_file=f"{dname}/populate-state.json",
     ))
     await d.stop_cluster()
     await d.start_nodes_in_parallel(list(d.server_hosts)[:3])
@@ -45,9 +47,10 @@ async def full():
     await d.quiesce()
     await d.backup_data()
 
-    #await d.configure_scylla_yaml()
-    #await asyncio.gather(*[d.rsync("fake_io_properties.yaml", f"{s}:/etc/scylla.d/io_properties.yaml", "--rsync-path=sudo rsync") for s in d.server_hosts])
-    #await asyncio.gather(*[d.rsync("fake_io.conf", f"{s}:/etc/scylla.d/io.conf", "--rsync-path=sudo rsync") for s in d.server_hosts])
-    #await asyncio.gather(*[d.rsync("fake_cpuset.conf", f"{s}:/etc/scylla.d/cpuset.conf", "--rsync-path=sudo rsync") for s in d.server_hosts])
+    #await d.configure_scylla_yaml(files=bench.scylla_config.scylla_d_files({
+    #    "io_properties.yaml": "fake_io_properties.yaml",
+    #    "io.conf": "fake_io.conf",
+    #    "cpuset.conf": "fake_cpuset.conf",
+    #}), restart=True)
 
 asyncio.run(full())
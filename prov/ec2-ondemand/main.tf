@@ -325,6 +325,22 @@ resource "aws_security_group" "monitor" {
     cidr_blocks = ["0.0.0.0/0"]
   }
 
+  ingress {
+    description = "apt-cacher-ng"
+    from_port   = 3142
+    to_port     = 3142
+    protocol    = "tcp"
+    cidr_blocks = [aws_vpc.main.cidr_block]
+  }
+
+  ingress {
+    description = "Artifact cache"
+    from_port   = 8080
+    to_port     = 8080
+    protocol    = "tcp"
+    cidr_blocks = [aws_vpc.main.cidr_block]
+  }
+
   egress {
     from_port   = 0
     to_port     = 0
@@ -1,10 +1,89 @@
+import hashlib
 import json
 import os
+import queue
 import sys
 import subprocess
 import shutil
+import threading
 
-def apply(deployment_name, terraform_plan, config):
+INSTANCE_TYPES = ["aws_instance", "aws_spot_instance_request"]
+
+def init_if_needed(tf_dir):
+    # `terraform init` is slow, and only needed when the configuration or the provider lock file changed.
+    def digest():
+        h = hashlib.sha256()
+        for name in sorted(os.listdir(tf_dir)):
+            if name.endswith(".tf") or name == ".terraform.lock.hcl":
+                with open(f"{tf_dir}/{name}", "rb") as f:
+                    h.update(name.encode() + b"\0" + f.read() + b"\0")
+        return h.hexdigest()
+    stamp = f"{tf_dir}/.init-stamp"
+    if os.path.isdir(f"{tf_dir}/.terraform") and os.path.exists(stamp):
+        with open(stamp) as f:
+            if f.read() == digest():
+                return
+    subprocess.check_call("terraform init", shell=True, cwd=tf_dir)
+    with open(stamp, "w") as f:
+        f.write(digest())
+
+def load_state(tf_dir):
+    try:
+        with open(f"{tf_dir}/terraform.tfstate") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"resources": []}
+
+def instances_from_state(state):
+    # {group: [instance]} for the instances which already have addresses, in count.index order.
+    instances = {}
+    for resource in state["resources"]:
+        if resource["type"] in INSTANCE_TYPES and resource.get("mode", "managed") == "managed":
+            group = resource["name"]
+            instances.setdefault(group, [])
+            for i, instance in enumerate(resource["instances"]):
+                attributes = instance["attributes"]
+                if not attributes.get("public_ip") or not attributes.get("private_ip"):
+                    continue
+                instances[group].append({
+                    "index": instance.get("index_key", i),
+                    "public_ip": attributes["public_ip"],
+                    "private_ip": attributes["private_ip"],
+                })
+            instances[group].sort(key=lambda instance: instance["index"])
+    return instances
+
+def render(deployment_name, instances, config):
+    def debug(text):
+      print(text)
+      return ''
+
+    import jinja2
+    jinja_env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader("templates"),
+        autoescape=jinja2.select_autoescape(),
+        undefined=jinja2.StrictUndefined,
+        trim_blocks=True,
+    )
+    jinja_env.filters['debug']=debug
+    ssh_template = jinja_env.get_template("ssh_config")
+    inventory_template = jinja_env.get_template("inventory")
+
+    def write(path, text):
+        with open(f"{path}.tmp", "w") as f:
+            f.write(text)
+        os.replace(f"{path}.tmp", path)
+
+    write(f'{deployment_name}/ssh_config', ssh_template.render(instances=instances, var=config))
+    # The inventory needs the seed, i.e. server-0.
+    servers = instances.get("server", [])
+    if servers and servers[0]["index"] == 0:
+        write(f'{deployment_name}/inventory', inventory_template.render(instances=instances, var=config, seed=servers[0]["private_ip"]))
+
+def apply(deployment_name, terraform_plan, config, on_instance=None, auto_approve=False, poll_interval=1.0):
+    # on_instance(group, instance) is called for every instance as soon as terraform
+    # has created it and ssh_config (and, once server-0 exists, inventory) include it,
+    # while the apply goes on. Instances which existed before are reported at the end.
     config['private_key_path'] = os.path.realpath(config['private_key_path'])
     config['public_key_path'] = os.path.realpath(config['public_key_path'])
     config['deployment_name'] = deployment_name
@@ -20,47 +99,84 @@ def apply(deployment_name, terraform_plan, config):
         "cwd": f"{tf_dir}",
     }
 
-    cmd = f'terraform init'
-    subprocess.check_call(cmd, **tf_env)
+    init_if_needed(tf_dir)
 
-    cmd = f'terraform apply -var-file tfvars.candidate.json'
-    subprocess.check_call(cmd, **tf_env)    
+    cmd = f'terraform plan -var-file tfvars.candidate.json -out tfplan'
+    subprocess.check_call(cmd, **tf_env)
+    if not auto_approve and input("Apply this plan? Only 'yes' will be accepted: ").strip() != "yes":
+        raise Exception("Apply cancelled")
 
-    shutil.move(f"{tf_dir}/tfvars.candidate.json", f"{tf_dir}/tfvars.json")
+    # Instances are announced by apply_complete events, but their addresses are only in the
+    # state file, which terraform persists as it goes. While there are announced instances
+    # without addresses, the state file is re-read on every event and every `poll_interval`
+    # seconds, since the last instances may be created long before the apply ends.
+    reported = set()
+    created = set()
+    state_mtime = None
 
-    with open(f"{tf_dir}/terraform.tfstate") as f:
-        state = json.load(f)
+    def report_ready():
+        nonlocal state_mtime
+        try:
+            mtime = os.stat(f"{tf_dir}/terraform.tfstate").st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == state_mtime:
+            return
+        state_mtime = mtime
+        instances = instances_from_state(load_state(tf_dir))
+        ready = [(group, instance) for group in instances for instance in instances[group]
+                 if (group, instance["index"]) in created - reported]
+        if ready:
+            render(deployment_name, instances, config)
+            for group, instance in ready:
+                reported.add((group, instance["index"]))
+                if on_instance is not None:
+                    on_instance(group, instance)
 
-    def debug(text):
-      print(text)
-      return ''
-
-    import jinja2
-    jinja_env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader("templates"),
-        autoescape=jinja2.select_autoescape(),
-        undefined=jinja2.StrictUndefined,
-        trim_blocks=True,
-    )
-    jinja_env.filters['debug']=debug
-    ssh_template = jinja_env.get_template("ssh_config")
-    inventory_template = jinja_env.get_template("inventory")
+    proc = subprocess.Popen("terraform apply -json tfplan", stdout=subprocess.PIPE, text=True, **tf_env)
+    lines = queue.Queue()
+    def read_lines():
+        for line in proc.stdout:
+            lines.put(line)
+        lines.put(None)
+    threading.Thread(target=read_lines, daemon=True).start()
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=poll_interval)
+            except queue.Empty:
+                line = ""
+            if line is None:
+                break
+            if line:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    print(line, end="")
+                    event = {}
+                if event.get("type") not in (None, "apply_progress", "version"):
+                    print(event.get("@message", line.strip()))
+                resource = event.get("hook", {}).get("resource", {})
+                if event.get("type") == "apply_complete" and resource.get("resource_type") in INSTANCE_TYPES:
+                    created.add((resource["resource_name"], resource.get("resource_key", 0)))
+            if created - reported:
+                report_ready()
+    finally:
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, "terraform apply -json tfplan")
 
-    instances = {}
-    for resource in state["resources"]:
-        if resource["type"] in ["aws_instance", "aws_spot_instance_request"]:
-            group = resource["name"]
-            instances.setdefault(group, [])
-            for i, instance in enumerate(resource["instances"]):
-                instances[group].append({
-                    "public_ip": instance["attributes"]["public_ip"],
-                    "private_ip": instance["attributes"]["private_ip"],
-                })
+    shutil.move(f"{tf_dir}/tfvars.candidate.json", f"{tf_dir}/tfvars.json")
 
-    with open(f'{deployment_name}/ssh_config', 'w') as ssh_config_file:
-        ssh_config_file.write(ssh_template.render(instances=instances, var=config))
-    with open(f'{deployment_name}/inventory', 'w') as inventory_file:
-        inventory_file.write(inventory_template.render(instances=instances, var=config, seed=instances["server"][0]["private_ip"]))
+    instances = instances_from_state(load_state(tf_dir))
+    render(deployment_name, instances, config)
+    # Precompiled inventory for bench.utils.Deployment, which would otherwise run ansible-inventory on every start.
+    subprocess.check_call([sys.executable, "-m", "bench.inventory", deployment_name])
+    for group in instances:
+        for instance in instances[group]:
+            if (group, instance["index"]) not in reported and on_instance is not None:
+                on_instance(group, instance)
+    return instances
 
 def destroy(deployment_name):
     tf_dir = f"{deployment_name}/tf"
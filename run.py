@@ -5,7 +5,7 @@ import sys
 from textwrap import dedent
 import bench.hdr, bench.utils
 from datetime import datetime
-from bench.utils import run
+from bench.utils import clean_cancel
 import time
 
 dname = sys.argv[1]
@@ -19,6 +19,17 @@ async def setup_cluster():
     await d.configure_scylla_yaml()
     await d.start_cluster(list(d.server_hosts)[:3])
 
+async def wait_until(condition, timeout, *tasks):
+    # Awaits the condition, but at most timeout seconds (the old fixed sleep: it may never be met),
+    # and returns early, raising its error if it failed, when one of the tasks finishes first.
+    waiter = asyncio.create_task(condition)
+    done, _ = await asyncio.wait([waiter, *tasks], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    if waiter not in done:
+        await clean_cancel(waiter)
+        print(f"going on without the condition: {'a task finished first' if done else f'not met after {timeout}s'}")
+    for task in done:
+        task.result()
+
 async def full():
     await d.stop_cs()
     await d.restore_data()
@@ -27,20 +38,24 @@ async def full():
         cs=CS,
         options = f"read no-warmup cl=QUORUM duration=800m -rate threads=300 fixed=24000/s -col 'size=FIXED(128) n=FIXED(8)' -pop 'dist=gauss(1..100000000,50000000,1500000)'",
     ))
-    await asyncio.sleep(20)
+    # The load is up once the cluster serves close to its rate.
+    await wait_until(d.wait_for("sum(rate(scylla_transport_requests_served[5s])) > 20000 for 5s"), 20, load)
 
     bootstrap = asyncio.create_task(d.start_nodes_in_parallel(list(d.server_hosts)[3:]))
-    await asyncio.sleep(50)
-    await d.pssh(d.server_hosts, f"""
+    # The trace is dumped when the queue goes long, or 50s into the bootstrap at the latest.
+    await wait_until(d.wait_for_long_queue(for_seconds=3), 50, bootstrap, load)
+    # The dumped traces are moved out of the way before collecting, so that a rerun collects only its own,
+    # and removed once they are collected, as in bench/experiment.py.
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    traces = f"/var/lib/scylla/backup/experiments/run-{stamp}/traces"
+    (await d.pssh(d.server_hosts, f"""
         bash <<EOF
-        curl -X POST 127.0.0.1:10000/system/dump_trace
-        sudo rm -r ~/snapshots
-        mkdir ~/snapshots
-        sudo mv /var/lib/scylla/traces/* ~/snapshots
-        chown -R scyllaadm snapshots
-        \nEOF""")
-    await run(["mkdir", "-p", "traces"])
-    await d.collect(d.server_hosts, f"snapshots/*", "traces/")
+        curl -s -X POST 127.0.0.1:10000/system/dump_trace
+        sudo mkdir -p {traces}
+        sudo find /var/lib/scylla/traces -mindepth 1 -maxdepth 1 -exec mv -t {traces} {{}} +
+        \nEOF""")).check()
+    await d.collect_archive(d.server_hosts, traces, f"traces/{stamp}", sudo=True)
+    (await d.pssh(d.server_hosts, f"sudo rm -rf {os.path.dirname(traces)}")).check()
     await bootstrap
     await load
 
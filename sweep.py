@@ -0,0 +1,26 @@
+import asyncio
+import shlex
+import sys
+import json
+import bench.utils
+from bench.experiment import Experiment, expand_matrix
+from bench.results import ResultStore
+
+dname = sys.argv[1]
+assert shlex.quote(dname)
+d = bench.utils.Deployment(dname)
+CS="JAVA=$(realpath /usr/lib/jvm/java-11*/bin/java) CLASSPATH=$(echo `ls -1 cas*/lib/*.jar cas*/tools/lib/*.jar` | tr ' ' ':') cas*/tools/bin/cassandra-stress"
+
+runs = expand_matrix(
+    scylla_yaml={"compaction_static_shares": [0, 100]},
+    cs={"rate": ["fixed=12000/s", "fixed=24000/s"]},
+)
+
+async def full():
+    e = Experiment(d, f"{dname}/sweep", runs=runs, cs=CS, server_hosts=list(d.server_hosts)[:3], store=ResultStore(f"{dname}/results.db"), cs_options=
+        "read no-warmup cl=QUORUM duration=10m -rate threads=300 {rate} -col 'size=FIXED(128) n=FIXED(8)' "
+        "-pop 'dist=gauss(1..100000000,50000000,1500000)' -log hdrfile={hdr_file} interval=1s")
+    results = await e.sweep()
+    print(json.dumps(results, indent=1))
+
+asyncio.run(full())
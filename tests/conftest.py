@@ -0,0 +1,60 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+class FakePrometheus(ThreadingHTTPServer):
+    # Answers every query with answer(path, params): a list of {"metric": ..., "value"/"values": ...}
+    # results, or a (status code, errorType, error) tuple. Records the queries and connections.
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakePrometheusHandler)
+        self.port = self.server_address[1]
+        self.answer = lambda path, params: []
+        self.delay = 0
+        self.drop_connections = False
+        self.queries = []
+        self.connections = 0
+
+class FakePrometheusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        params = dict(urllib.parse.parse_qsl(self.rfile.read(int(self.headers["Content-Length"])).decode()))
+        self.server.queries.append((self.path, params))
+        time.sleep(self.server.delay)
+        answer = self.server.answer(self.path, params)
+        if isinstance(answer, tuple):
+            code, error_type, error = answer
+            body = {"status": "error", "errorType": error_type, "error": error}
+        else:
+            code = 200
+            result_type = "matrix" if self.path.endswith("query_range") else "vector"
+            body = {"status": "success", "data": {"resultType": result_type, "result": answer}}
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        # Like a server whose keep-alive timeout expired: closes without telling the client.
+        self.close_connection = self.server.drop_connections
+
+@pytest.fixture
+def fake_prometheus():
+    server = FakePrometheus()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,123 @@
+import asyncio
+import pytest
+from bench.fleet import FairBudget, Fleet, FleetLimits
+from bench.transport import LocalTransport
+from bench.utils import Deployment
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_freed_slot_goes_to_the_owner_holding_fewest():
+    budget = FairBudget("ssh", 2)
+    order = []
+    async def take(owner):
+        await budget.acquire(owner)
+        order.append(owner)
+    async def main():
+        await take("big")
+        await take("big")
+        waiters = [asyncio.create_task(take("big")) for _ in range(3)]
+        await settle()
+        waiters.append(asyncio.create_task(take("small")))
+        await settle()
+        assert budget.waiters("big") == 3 and budget.waiters("small") == 1
+        budget.release("big")
+        await settle()
+        # small came last but holds nothing.
+        assert order[2:] == ["small"]
+        for _ in range(3):
+            budget.release("big")
+            await settle()
+        await asyncio.gather(*waiters)
+    run(main())
+    assert order == ["big", "big", "small", "big", "big", "big"]
+    assert budget.in_use == 2 and dict(budget.held) == {"big": 1, "small": 1}
+    assert budget.granted == {"big": 5, "small": 1}
+
+def test_owners_holding_the_same_are_served_in_turn():
+    budget = FairBudget("rsync", 1)
+    order = []
+    async def take(owner):
+        await budget.acquire(owner)
+        order.append(owner)
+        await asyncio.sleep(0.01)
+        budget.release(owner)
+    async def main():
+        await asyncio.gather(*(take(owner) for owner in ["a", "a", "a", "b", "b", "b", "c"]))
+    run(main())
+    assert order == ["a", "b", "c", "a", "b", "a", "b"]
+    assert budget.in_use == 0 and not budget.waiting
+
+def test_cancelled_waiter_leaves_no_trace():
+    budget = FairBudget("hdr", 1)
+    async def main():
+        await budget.acquire("a")
+        waiter = asyncio.create_task(budget.acquire("b"))
+        await settle()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not budget.waiting
+        budget.release("a")
+    run(main())
+    assert budget.in_use == 0 and budget.granted == {"a": 1}
+
+def test_waiter_cancelled_after_its_grant_gives_the_slot_back():
+    budget = FairBudget("hdr", 1)
+    async def main():
+        await budget.acquire("a")
+        b = asyncio.create_task(budget.acquire("b"))
+        c = asyncio.create_task(budget.acquire("c"))
+        await settle()
+        # Grants b's slot, but b is cancelled before it runs again.
+        budget.release("a")
+        b.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await b
+        await c
+        assert dict(budget.held) == {"a": 0, "b": 0, "c": 1}
+        budget.release("c")
+    run(main())
+    assert budget.in_use == 0 and not budget.waiting
+
+def test_unlimited_budget():
+    budget = FairBudget("ssh", None)
+    async def main():
+        for _ in range(100):
+            await budget.acquire("a")
+    run(main())
+    assert budget.in_use == 100 and str(budget) == "ssh 100/∞ waiting 0"
+
+def test_fleet(tmp_path, monkeypatch):
+    peak = 0
+    grant = FairBudget._grant
+    def counting_grant(self, owner):
+        nonlocal peak
+        grant(self, owner)
+        if self.name == "ssh":
+            peak = max(peak, self.in_use)
+    monkeypatch.setattr(FairBudget, "_grant", counting_grant)
+    fleet = Fleet(FleetLimits(ssh=3), progress_interval=None)
+    async def job(d):
+        fleet.set_phase(d, "sleeping")
+        hosts = [f"host-{i}" for i in range(4)]
+        (await d.pssh(hosts, "sleep 0.05")).check()
+        if d.name == "d2":
+            raise RuntimeError("broken")
+        return d.name
+    for name in ["d0", "d1", "d2"]:
+        fleet.add(Deployment(name, transport=LocalTransport(str(tmp_path / name)), inventory={}), job)
+    with pytest.raises(ValueError):
+        fleet.add(Deployment("d0", transport=LocalTransport(str(tmp_path / "d0")), inventory={}), job)
+    results = run(fleet.run())
+    assert results["d0"] == "d0" and results["d1"] == "d1" and isinstance(results["d2"], RuntimeError)
+    assert fleet.failed == ["d2"]
+    assert peak == 3
+    ssh = fleet.budgets["ssh"]
+    assert ssh.in_use == 0 and ssh.granted == {"d0": 4, "d1": 4, "d2": 4}
+    assert [m.commands for m in fleet.members.values()] == [(4, 0)] * 3
+    assert "d2 failed" in fleet.progress()
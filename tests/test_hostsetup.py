@@ -0,0 +1,89 @@
+import asyncio
+import os
+import pytest
+from bench import hostsetup
+from bench.fanout import FanoutError
+from bench.transport import LocalTransport
+from bench.utils import Deployment
+
+HOSTS = ["server-0", "server-1"]
+
+# Stand-ins for the commands setup runs as root: sudo only logs the command, and uname
+# prints the kernel release in ~/kernel.
+FAKE_BIN = {
+    "sudo": '#!/bin/bash\necho "$*" >> ~/sudo.log\nif [ "$1" = tee ]; then cat >/dev/null; fi\n',
+    "uname": "#!/bin/bash\ncat ~/kernel\n",
+}
+
+class FakeHosts(LocalTransport):
+    def __init__(self, root, bin_dir):
+        super().__init__(root)
+        self.bin_dir = bin_dir
+
+    def popen_kwargs(self, host):
+        kwargs = super().popen_kwargs(host)
+        kwargs["env"]["PATH"] = f"{self.bin_dir}:{os.environ['PATH']}"
+        return kwargs
+
+@pytest.fixture
+def deployment(tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, script in FAKE_BIN.items():
+        (bin_dir / name).write_text(script)
+        os.chmod(bin_dir / name, 0o755)
+    inventory = {"server": {"hosts": {host: {"private_ip": f"10.0.0.{i}"} for i, host in enumerate(HOSTS)}}}
+    return Deployment("test", transport=FakeHosts(str(tmp_path / "hosts"), str(bin_dir)), inventory=inventory)
+
+def steps(first="echo one >> ~/log", second="echo two >> ~/log"):
+    return [hostsetup.SetupStep("first", first), hostsetup.SetupStep("second", second)]
+
+def log(tmp_path, host, name="log"):
+    path = tmp_path / "hosts" / host / name
+    return path.read_text().splitlines() if path.exists() else []
+
+def test_applied_steps_are_skipped(deployment, tmp_path):
+    report = asyncio.run(deployment.setup(HOSTS, steps()))
+    assert report == {"first": hostsetup.StepResult(HOSTS, []), "second": hostsetup.StepResult(HOSTS, [])}
+    report = asyncio.run(deployment.setup(HOSTS, steps()))
+    assert report == {"first": hostsetup.StepResult([], HOSTS), "second": hostsetup.StepResult([], HOSTS)}
+    # A new host only gets the steps it is missing.
+    report = asyncio.run(deployment.setup([*HOSTS, "server-2"], steps()))
+    assert report["first"] == hostsetup.StepResult(["server-2"], HOSTS)
+    assert all(log(tmp_path, host) == ["one", "two"] for host in [*HOSTS, "server-2"])
+    asyncio.run(deployment.setup(HOSTS, steps(), force=True))
+    assert log(tmp_path, "server-0") == ["one", "two"] * 2
+
+def test_changed_step_reapplies_it_and_the_steps_after_it(deployment, tmp_path):
+    asyncio.run(deployment.setup(HOSTS, steps()))
+    report = asyncio.run(deployment.setup(HOSTS, steps(second="echo TWO >> ~/log")))
+    assert report["first"].applied == [] and report["second"].applied == HOSTS
+    report = asyncio.run(deployment.setup(HOSTS, steps(first="echo ONE >> ~/log", second="echo TWO >> ~/log")))
+    assert report["first"].applied == HOSTS and report["second"].applied == HOSTS
+    assert log(tmp_path, "server-1") == ["one", "two", "TWO", "ONE", "TWO"]
+
+def test_failed_step_stops_the_setup_and_is_retried(deployment, tmp_path):
+    failing = steps(first='echo one >> ~/log\n[ "$(basename $HOME)" != server-1 ] || [ -f ~/fixed ]')
+    with pytest.raises(FanoutError):
+        asyncio.run(deployment.setup(HOSTS, failing))
+    # The second step ran nowhere, not even on server-0 where the first one succeeded.
+    assert log(tmp_path, "server-0") == ["one"] and log(tmp_path, "server-1") == ["one"]
+    (tmp_path / "hosts" / "server-1" / "fixed").touch()
+    report = asyncio.run(deployment.setup(HOSTS, failing))
+    assert report["first"] == hostsetup.StepResult(["server-1"], ["server-0"])
+    assert report["second"].applied == HOSTS
+
+def test_kernel_upgrade_reinstalls_linux_tools(deployment, tmp_path):
+    def installs(host):
+        return [line for line in log(tmp_path, host, "sudo.log") if " install " in line]
+    for host in HOSTS:
+        os.makedirs(tmp_path / "hosts" / host)
+        (tmp_path / "hosts" / host / "kernel").write_text("6.1.0-1-aws\n")
+    asyncio.run(deployment.setup_servers())
+    assert all(installs(host)[-1].endswith("install -y linux-tools-common linux-tools-6.1.0-1-aws") for host in HOSTS)
+    asyncio.run(deployment.setup_servers())
+    assert all(len(installs(host)) == 2 for host in HOSTS)
+    (tmp_path / "hosts" / "server-1" / "kernel").write_text("6.1.0-2-aws\n")
+    asyncio.run(deployment.setup_servers())
+    assert len(installs("server-0")) == 2
+    assert installs("server-1")[2:] == ["DEBIAN_FRONTEND=noninteractive apt-get -oDPkg::Lock::Timeout=-1 install -y linux-tools-common linux-tools-6.1.0-2-aws"]
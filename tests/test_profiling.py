@@ -0,0 +1,44 @@
+import os
+import shutil
+from bench.profiling import fold_perf_script, io_latency_histograms, process_host_dir, read_folded
+
+DATA = os.path.join(os.path.dirname(__file__), "data", "profiling")
+
+def test_fold_perf_script():
+    with open(f"{DATA}/perf.script") as f:
+        folded = fold_perf_script(f)
+    assert folded == {
+        "reactor-3;main;seastar::reactor::run;seastar::reactor::run_tasks": 2,
+        "reactor-3;main;seastar::reactor::run;seastar::reactor::run_tasks;"
+        "cql_transport::cql_server::connection::process_request;__memmove_avx_unaligned_erms": 1,
+        # Spaces in the command name are replaced; unknown symbols are named after their dso.
+        "java_VM_Thread;start_thread;[libjvm.so]": 1,
+        "swapper;[unknown];cpuidle_enter_state;intel_idle": 1,
+    }
+
+def test_blkparse_latencies():
+    with open(f"{DATA}/blkparse-nvme0n1.txt") as f:
+        histograms = io_latency_histograms(f)
+    # The completion of an IO queued before the trace started (sector 32768) is left out.
+    assert {key: h.total_count for key, h in histograms.items()} == {
+        ("read", "d2c"): 2, ("read", "q2c"): 2, ("write", "d2c"): 1, ("write", "q2c"): 1,
+        ("discard", "d2c"): 1, ("discard", "q2c"): 1,
+    }
+    def close_to(value_ns, us):
+        return abs(value_ns / 1000 - us) <= us * 0.01
+    assert close_to(histograms["read", "d2c"].min_value(), 100) and close_to(histograms["read", "d2c"].max_value(), 200)
+    assert close_to(histograms["read", "q2c"].min_value(), 110) and close_to(histograms["read", "q2c"].max_value(), 210)
+    assert close_to(histograms["write", "d2c"].max_value(), 400) and close_to(histograms["write", "q2c"].max_value(), 500)
+    assert close_to(histograms["discard", "d2c"].max_value(), 1000)
+
+def test_process_host_dir(tmp_path):
+    host_dir = tmp_path / "server-0"
+    shutil.copytree(DATA, host_dir)
+    results = process_host_dir(str(host_dir), title="capture")
+    assert results["perf_samples"] == 5
+    assert results["ios"] == {"read d2c": 2, "read q2c": 2, "write d2c": 1, "write q2c": 1, "discard d2c": 1, "discard q2c": 1}
+    assert sum(read_folded(host_dir / "perf.folded").values()) == 5
+    svg = (host_dir / "flamegraph.svg").read_text()
+    assert "capture server-0" in svg and "seastar::reactor::run_tasks (3 samples, 60.00%)" in svg
+    io_latency = (host_dir / "io-latency.txt").read_text()
+    assert io_latency.startswith("discard d2c: 1 IOs") and "read d2c: 2 IOs" in io_latency
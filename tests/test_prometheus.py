@@ -0,0 +1,63 @@
+import asyncio
+import re
+import time
+import pytest
+from bench.prometheus import PrometheusClient, PrometheusError, batch_query, scalar
+
+def sample(value, **labels):
+    return {"metric": labels, "value": [time.time(), str(value)]}
+
+def test_concurrent_queries_share_one_request(fake_prometheus):
+    fake_prometheus.delay = 0.2
+    fake_prometheus.answer = lambda path, params: [sample(len(fake_prometheus.queries))]
+    client = PrometheusClient("127.0.0.1", fake_prometheus.port, ttl=0.3)
+    async def main():
+        first = await asyncio.gather(*(client.query("up") for _ in range(5)))
+        cached = await client.query("up")
+        await asyncio.sleep(0.4)
+        return first, cached, await client.query("up")
+    first, cached, expired = asyncio.run(main())
+    assert [scalar(s) for s in first] == [1.0] * 5 and scalar(cached) == 1.0
+    assert scalar(expired) == 2.0
+    assert client.requests == 2
+    client.close()
+
+def test_error_status(fake_prometheus):
+    fake_prometheus.answer = lambda path, params: (400, "bad_data", "parse error")
+    client = PrometheusClient("127.0.0.1", fake_prometheus.port, ttl=10)
+    async def main():
+        for _ in range(2):
+            with pytest.raises(PrometheusError, match="bad_data: parse error"):
+                await client.query("up{")
+    asyncio.run(main())
+    # Failures aren't cached.
+    assert len(fake_prometheus.queries) == 2
+    client.close()
+
+def test_reconnect(fake_prometheus):
+    fake_prometheus.answer = lambda path, params: [sample(1)]
+    client = PrometheusClient("127.0.0.1", fake_prometheus.port, ttl=0)
+    async def main():
+        await client.query("up")
+        await client.query("up")
+        assert fake_prometheus.connections == 1
+        fake_prometheus.drop_connections = True
+        await client.query("up")
+        await asyncio.sleep(0.1)
+        await client.query("up")
+    asyncio.run(main())
+    assert client.requests == 4 and len(fake_prometheus.queries) == 4 and fake_prometheus.connections == 2
+    client.close()
+
+def test_query_many_is_one_request(fake_prometheus):
+    def answer(path, params):
+        exprs = re.findall(r'label_replace\(\((\w+)\), "(\w+)", "(\d+)"', params["query"])
+        return [sample(float(i) * 10 + shard, __bench_batch=i, shard=str(shard)) for _, _, i in exprs for shard in range(2)]
+    fake_prometheus.answer = answer
+    client = PrometheusClient("127.0.0.1", fake_prometheus.port)
+    results = asyncio.run(client.query_many(["a", "b", "c"]))
+    assert fake_prometheus.queries == [("/api/v1/query", {"query": batch_query(["a", "b", "c"])})]
+    assert [sorted((dict(k)["shard"], float(s.values[-1])) for k, s in r.items()) for r in results] == \
+           [[("0", 0.0), ("1", 1.0)], [("0", 10.0), ("1", 11.0)], [("0", 20.0), ("1", 21.0)]]
+    assert asyncio.run(client.query_many([])) == []
+    client.close()
@@ -0,0 +1,43 @@
+import os
+from bench.saturation import SaturationThresholds, analyze_recordings, parse_recording, read_recordings
+
+# Recorded sampler output of three clients over 5 seconds: client-0 is fine, client-1 is
+# CPU-bound and pauses in GC, client-2 fills its 10Gbit/s link.
+DATA = os.path.join(os.path.dirname(__file__), "data", "saturation")
+
+def test_parse_recording():
+    with open(f"{DATA}/client-2.proc") as f:
+        speeds, snapshots, gc = parse_recording(f)
+    # Interfaces without a speed (lo, or virtual NICs reporting -1) are left out.
+    assert speeds == {"eth0": 10000}
+    assert len(snapshots) == 6 and sorted(snapshots[0].cpu) == ["cpu", "cpu0", "cpu1"]
+    assert list(snapshots[0].net) == ["eth0"]
+    assert [g.time for g in gc] == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+def test_incomplete_snapshot_is_dropped():
+    with open(f"{DATA}/client-0.proc") as f:
+        lines = f.read().splitlines()
+    # Cut off in the middle of the last snapshot's cpu lines.
+    last = max(i for i, line in enumerate(lines) if line.startswith("@"))
+    _, snapshots, _ = parse_recording(lines[:last + 2])
+    assert len(snapshots) == 5
+
+def test_verdicts():
+    report = analyze_recordings(read_recordings(DATA))
+    assert report.client_bound and report.bound_hosts == ["client-1", "client-2"]
+    ok, cpu_bound, net_bound = (report.verdicts[f"client-{i}"] for i in range(3))
+    assert ok.reasons == [] and ok.samples == 5
+    assert abs(ok.cpu_p90 - 0.30) < 0.01 and abs(ok.net_gbps_p90 - 0.1) < 0.01
+    assert cpu_bound.reasons == ["cpu >= 90%", "gc >= 10% of the time"]
+    assert abs(cpu_bound.steal_mean - 0.04) < 0.01 and cpu_bound.gc_max_ms == 400.0
+    assert net_bound.reasons == ["network >= 90% of 10Gbit/s"]
+    assert abs(net_bound.net_gbps_p90 - 9.6) < 0.01
+    assert str(ok) == "client-0: ok: cpu p90=30% steal=0% net p90=0.10Gbit/s gc max=0%/0ms"
+
+def test_thresholds():
+    recordings = read_recordings(DATA)
+    # The link speed of client-0 is unknown; net_gbps supplies it.
+    report = analyze_recordings(recordings, SaturationThresholds(net_gbps=0.1))
+    assert report.verdicts["client-0"].reasons == ["network >= 90% of 0.1Gbit/s"]
+    report = analyze_recordings(recordings, SaturationThresholds(cpu=0.99, gc_fraction=0.5, gc_max_ms=300))
+    assert report.verdicts["client-1"].reasons == ["gc pause of 400ms"]
@@ -0,0 +1,94 @@
+import json
+import os
+from bench import snapshot
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def make_tree(root):
+    write(f"{root}/data/ks/t1/a-Data.db", "a" * 1000)
+    write(f"{root}/data/ks/t1/a-Index.db", "index")
+    write(f"{root}/data/ks/t2/b-Data.db", "b" * 500)
+    write(f"{root}/commitlog/CommitLog-1.log", "log")
+    os.makedirs(f"{root}/hints")
+
+def tree(root, exclude=()):
+    _, files = snapshot.scan(root, exclude)
+    return {f: read(os.path.join(root, f)) for f in files}
+
+def test_snapshot_and_restore(tmp_path):
+    root, backups = str(tmp_path / "scylla"), str(tmp_path / "scylla" / "backup")
+    make_tree(root)
+    before = tree(root, exclude=("backup",))
+    stats = snapshot.snapshot(root, f"{backups}/default", exclude=("backup",))
+    assert stats["files"] == 4 and stats["bytes"] == 1508
+    manifest = snapshot.load_manifest(f"{backups}/default")
+    # No hashes unless asked for: a reflinked snapshot shouldn't read all the data.
+    assert all(entry[2] is None for entry in manifest["files"].values())
+    assert "hints" in manifest["dirs"]
+
+    write(f"{root}/data/ks/t1/a-Data.db", "changed")
+    write(f"{root}/data/ks/t3/c-Data.db", "extra")
+    os.remove(f"{root}/commitlog/CommitLog-1.log")
+    stats = snapshot.restore(f"{backups}/default", root, exclude=("backup",))
+    assert tree(root, exclude=("backup",)) == before
+    assert not os.path.exists(f"{root}/data/ks/t3")
+    # a-Index.db and b-Data.db were left alone.
+    assert stats["skipped_files"] == 2 and stats["files"] == 2 and stats["removed_files"] == 1
+
+def test_named_snapshots(tmp_path):
+    root, backups = str(tmp_path / "scylla"), str(tmp_path / "scylla" / "backup")
+    make_tree(root)
+    snapshot.snapshot(root, f"{backups}/populated", exclude=("backup",))
+    write(f"{root}/data/ks/t1/a-Data.db", "compacted")
+    snapshot.snapshot(root, f"{backups}/compacted", exclude=("backup",), hash=True)
+    assert sorted(snapshot.list_snapshots(backups)) == ["compacted", "populated"]
+    snapshot.restore(f"{backups}/populated", root, exclude=("backup",))
+    assert read(f"{root}/data/ks/t1/a-Data.db") == "a" * 1000
+    snapshot.restore(f"{backups}/compacted", root, exclude=("backup",))
+    assert read(f"{root}/data/ks/t1/a-Data.db") == "compacted"
+
+def test_verify(tmp_path):
+    root, backups = str(tmp_path / "scylla"), str(tmp_path / "scylla" / "backup")
+    make_tree(root)
+    snapshot.snapshot(root, f"{backups}/hashed", exclude=("backup",), hash=True)
+    assert snapshot.verify(f"{backups}/hashed") == {"files": 4, "bytes": 1508, "unhashed": 0, "bad": []}
+    # Same size and mtime, different contents.
+    path = f"{backups}/hashed/data/ks/t2/b-Data.db"
+    st = os.stat(path)
+    write(path, "c" * 500)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert snapshot.verify(f"{backups}/hashed")["bad"] == ["data/ks/t2/b-Data.db"]
+
+def test_verifying_restore_without_hashes(tmp_path):
+    root, backups = str(tmp_path / "scylla"), str(tmp_path / "scylla" / "backup")
+    make_tree(root)
+    snapshot.snapshot(root, f"{backups}/default", exclude=("backup",))
+    path = f"{root}/data/ks/t1/a-Data.db"
+    st = os.stat(path)
+    write(path, "x" * 1000)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    stats = snapshot.restore(f"{backups}/default", root, exclude=("backup",))
+    assert read(path) == "x" * 1000 and stats["files"] == 0
+    stats = snapshot.restore(f"{backups}/default", root, exclude=("backup",), verify=True)
+    assert read(path) == "a" * 1000 and stats["files"] == 1
+
+def test_legacy_backup_becomes_default(tmp_path, capsys):
+    root, backups = str(tmp_path / "scylla"), str(tmp_path / "scylla" / "backup")
+    make_tree(root)
+    # The old backup_data: a plain copy of /var/lib/scylla's entries into backup/.
+    make_tree(backups)
+    write(f"{backups}/experiments/run1/traces/t", "trace")
+    write(f"{root}/data/ks/t1/a-Data.db", "changed")
+    snapshot.main(["list", backups])
+    assert list(json.loads(capsys.readouterr().out.splitlines()[-1])) == ["default"]
+    assert sorted(os.listdir(backups)) == ["default", "experiments"]
+    snapshot.restore(f"{backups}/default", root, exclude=("backup",))
+    assert read(f"{root}/data/ks/t1/a-Data.db") == "a" * 1000
+    assert not snapshot.migrate_legacy(backups)
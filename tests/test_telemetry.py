@@ -0,0 +1,101 @@
+import asyncio
+import os
+import pytest
+from bench.hdrhistogram import HdrHistogram
+from bench.telemetry import CsTelemetry, LatencySlo, SloViolation, parse_cs_interval
+from bench.transport import LocalTransport
+from bench.utils import Deployment
+
+# A stand-in for cassandra-stress: prints a header and one "total" interval line per interval,
+# with a p99 of 2ms, or of 50ms from interval $SLOW_FROM on. The name matches stop_cs()'s pkill.
+FAKE_CS = """#!/bin/bash
+slow_from=$1 count=$2
+echo "type, total ops, op/s, pk/s, row/s, mean, med, .95, .99, .999, max, time, stderr, errors, gc: #, max ms, sum ms, sdv ms, mb"
+for i in $(seq 1 $count); do
+    p99=2.0; [ $i -ge $slow_from ] && p99=50.0
+    echo "total, $((i * 1000)), 1000, 1000, 1000, 1.0, 0.8, 1.5, $p99, $p99, $p99, $i.0, 0.0, 0, 0, 0.0, 0.0, 0.0, 0.0"
+    sleep 0.05
+done
+"""
+
+SERVERS = {"server-0": {"private_ip": "127.0.0.1"}}
+CLIENTS = ["client-0", "client-1"]
+
+@pytest.fixture
+def deployment(tmp_path):
+    cs = tmp_path / "org.apache.cassandra.stress"
+    cs.write_text(FAKE_CS)
+    os.chmod(cs, 0o755)
+    d = Deployment("test", transport=LocalTransport(str(tmp_path / "hosts")), inventory={})
+    return d, str(cs)
+
+def test_cs_windows_are_merged(deployment):
+    d, cs = deployment
+    telemetry = CsTelemetry(slo=LatencySlo(10), passthrough=False, keep_windows=True)
+    async def run():
+        try:
+            await d.cs("1000 5", server_hosts=SERVERS, client_hosts=CLIENTS, cs=cs, telemetry=telemetry)
+        finally:
+            await d.close()
+    asyncio.run(run())
+    assert [w.time for w in telemetry.history] == [1.0, 2.0, 3.0, 4.0, 5.0]
+    for w in telemetry.history:
+        assert w.tag == "total" and w.clients == 2
+        assert w.op_rate == 2000
+        assert w.percentiles[99] == 2.0
+    assert telemetry.violation is None and telemetry.judged == 5
+
+def test_cs_slo_violation_stops_the_clients(deployment):
+    d, cs = deployment
+    telemetry = CsTelemetry(slo=LatencySlo(10), consecutive=3, passthrough=False, keep_windows=True)
+    async def run():
+        try:
+            await d.cs("4 1000", server_hosts=SERVERS, client_hosts=CLIENTS, cs=cs, telemetry=telemetry)
+        finally:
+            await d.close()
+    with pytest.raises(SloViolation) as e:
+        asyncio.run(asyncio.wait_for(run(), 30))
+    assert [w.time for w in e.value.windows] == [4.0, 5.0, 6.0]
+    # The clients were stopped long before their 1000 intervals.
+    assert len(telemetry.history) < 100
+
+def test_hdr_windows_have_a_pooled_total():
+    telemetry = CsTelemetry(source="hdr", hdr_file="cs.hdr", slo=LatencySlo(10), keep_windows=True)
+    def histogram(tag, start_ms, latency_ms, count):
+        h = HdrHistogram(1, 60_000_000_000, 3)
+        h.tag = tag
+        h.start_time_ms, h.end_time_ms = start_ms, start_ms + 1000
+        h.record_values([int(latency_ms * 1e6)], count)
+        return h
+    async def run():
+        telemetry.start(CLIENTS)
+        for host in CLIENTS:
+            await telemetry.add(host, "READ-rt", 1.0, histogram("READ-rt", 1000, 1, 900))
+            await telemetry.add(host, "WRITE-rt", 1.0, histogram("WRITE-rt", 1000, 20, 100))
+            await telemetry.add(host, "READ-st", 1.0, histogram("READ-st", 1000, 1, 900))
+        await telemetry.close()
+    asyncio.run(run())
+    windows = {w.tag: w for w in telemetry.history}
+    assert list(windows) == ["total", "READ-rt", "READ-st", "WRITE-rt"]
+    total = windows["total"]
+    # The service-time tag is left out of the total.
+    assert total.clients == 2 and total.ops == 2000
+    assert total.percentiles[99] == pytest.approx(20, rel=0.01)
+    assert telemetry.judged == 1
+
+def test_kept_windows_are_bounded():
+    def interval(i, p99):
+        return parse_cs_interval(f"total, {i * 1000}, 1000, 1000, 1000, 1.0, 0.8, 1.5, {p99}, {p99}, {p99}, {i}.0, 0.0, 0, 0, 0.0, 0.0, 0.0, 0.0")
+    async def run(telemetry):
+        telemetry.start(["client-0"])
+        for i in range(1, 11):
+            await telemetry.add("client-0", "total", float(i), interval(i, 50.0 if i > 7 else 2.0))
+        await telemetry.close()
+        return [w.time async for w in telemetry.windows()]
+    judged_only = CsTelemetry(slo=LatencySlo(10))
+    assert asyncio.run(run(judged_only)) == [] and not judged_only.history
+    assert judged_only.judged == 10 and judged_only.violation is not None
+    bounded = CsTelemetry(keep_windows=3)
+    assert asyncio.run(run(bounded)) == [9.0, 10.0]
+    assert [w.time for w in bounded.history] == [8.0, 9.0, 10.0]
+    assert bounded.dropped == 8
@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import sys
+import time
+import pytest
+from bench.provision import load_terraform_module
+
+pytestmark = pytest.mark.skipif(shutil.which("rsync") is None, reason="apply copies the plan with rsync")
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A stand-in for terraform. All commands are logged, `init` creates .terraform, and
+# `apply -json tfplan` plays $FAKE_TF_SCENARIO: a list of steps which print an event,
+# write the state file with the given instances ({group: [index, ...]}), or sleep.
+FAKE_TERRAFORM = """#!PYTHON
+import json, os, sys, time
+with open(os.environ["FAKE_TF_LOG"], "a") as f:
+    f.write(sys.argv[1] + "\\n")
+if sys.argv[1] == "init":
+    os.makedirs(".terraform", exist_ok=True)
+if sys.argv[1] != "apply":
+    sys.exit(0)
+with open(os.environ["FAKE_TF_SCENARIO"]) as f:
+    scenario = json.load(f)
+for step in scenario:
+    if "created" in step:
+        group, index = step["created"]
+        print(json.dumps({"type": "apply_complete", "@message": f"aws_instance.{group}[{index}]: Creation complete",
+                          "hook": {"resource": {"resource_type": "aws_instance", "resource_name": group, "resource_key": index}}}), flush=True)
+    elif "state" in step:
+        resources = [{"type": "aws_instance", "name": group, "mode": "managed",
+                      "instances": [{"index_key": i, "attributes": {"public_ip": f"10.0.{g}.{i}", "private_ip": f"192.168.{g}.{i}"}}
+                                    for i in indexes]}
+                     for g, (group, indexes) in enumerate(sorted(step["state"].items()))]
+        with open("terraform.tfstate.tmp", "w") as f:
+            json.dump({"resources": resources}, f)
+        os.replace("terraform.tfstate.tmp", "terraform.tfstate")
+    else:
+        time.sleep(step["sleep"])
+"""
+
+FAKE_ANSIBLE_INVENTORY = """#!/bin/bash
+echo "all: {children: {}}"
+"""
+
+@pytest.fixture
+def terraform(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "fakebin"
+    bin_dir.mkdir()
+    (bin_dir / "terraform").write_text(FAKE_TERRAFORM.replace("PYTHON", sys.executable))
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "ansible-inventory").write_text(FAKE_ANSIBLE_INVENTORY)
+    for path in (bin_dir / "terraform", tmp_path / "bin" / "ansible-inventory"):
+        os.chmod(path, 0o755)
+    (tmp_path / "plan").mkdir()
+    (tmp_path / "plan" / "main.tf").write_text("# instances\n")
+    os.symlink(f"{REPO}/templates", tmp_path / "templates")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("PYTHONPATH", REPO)
+    monkeypatch.setenv("FAKE_TF_LOG", str(tmp_path / "terraform.log"))
+    monkeypatch.setenv("FAKE_TF_SCENARIO", str(tmp_path / "scenario.json"))
+    return load_terraform_module()
+
+def run_apply(terraform, tmp_path, scenario, on_instance=None):
+    (tmp_path / "scenario.json").write_text(json.dumps(scenario))
+    config = {"private_key_path": "key", "public_key_path": "key.pub", "server_user": "ubuntu", "client_user": "ubuntu"}
+    return terraform.apply("test", "plan", config, on_instance, auto_approve=True, poll_interval=0.1)
+
+def commands(tmp_path):
+    return (tmp_path / "terraform.log").read_text().split()
+
+def test_init_only_when_the_configuration_changes(terraform, tmp_path):
+    scenario = [{"state": {"server": [0]}}]
+    run_apply(terraform, tmp_path, scenario)
+    run_apply(terraform, tmp_path, scenario)
+    assert commands(tmp_path) == ["init", "plan", "apply", "plan", "apply"]
+    (tmp_path / "plan" / "main.tf").write_text("# more instances\n")
+    run_apply(terraform, tmp_path, scenario)
+    assert commands(tmp_path)[5:] == ["init", "plan", "apply"]
+
+def test_instances_are_handed_over_as_they_are_created(terraform, tmp_path):
+    run_apply(terraform, tmp_path, [{"state": {"server": [0]}}])
+    calls = []
+    def on_instance(group, instance):
+        # Rendered before the hand-over.
+        with open("test/ssh_config") as f:
+            ssh_config = f.read()
+        calls.append((group, instance["index"], f"HostName {instance['public_ip']}\n" in ssh_config, os.path.exists("test/inventory")))
+    scenario = [
+        {"created": ["client", 0]}, {"state": {"server": [0], "client": [0]}},
+        {"created": ["server", 1]}, {"state": {"server": [0, 1], "client": [0]}},
+        {"sleep": 0.2},
+    ]
+    instances = run_apply(terraform, tmp_path, scenario, on_instance)
+    # server-0 existed before the apply, so it is only reported at its end.
+    assert calls == [("client", 0, True, True), ("server", 1, True, True), ("server", 0, True, True)]
+    assert [i["index"] for i in instances["server"]] == [0, 1]
+
+def test_inventory_waits_for_the_seed(terraform, tmp_path):
+    seen = []
+    def on_instance(group, instance):
+        seen.append((group, instance["index"], os.path.exists("test/inventory")))
+    scenario = [
+        {"created": ["client", 0]}, {"state": {"client": [0]}},
+        {"created": ["server", 0]}, {"state": {"server": [0], "client": [0]}},
+    ]
+    run_apply(terraform, tmp_path, scenario, on_instance)
+    assert seen == [("client", 0, False), ("server", 0, True)]
+
+def test_late_state_is_picked_up_without_more_events(terraform, tmp_path):
+    reported = {}
+    def on_instance(group, instance):
+        reported[f"{group}-{instance['index']}"] = time.monotonic()
+    # The state file is written after the last event, and the apply goes on for a while.
+    scenario = [{"created": ["server", 0]}, {"sleep": 0.3}, {"state": {"server": [0]}}, {"sleep": 1.5}]
+    run_apply(terraform, tmp_path, scenario, on_instance)
+    assert time.monotonic() - reported["server-0"] > 1.0
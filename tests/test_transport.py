@@ -0,0 +1,127 @@
+import asyncio
+import pytest
+from bench import transport
+from bench.transport import LocalTransport
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_run(tmp_path):
+    t = LocalTransport(str(tmp_path))
+    async def main():
+        out, err, code = await t.run("a", "cat; echo oops >&2; pwd", stdin_data=b"in\n",
+                                     stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        assert (out, err, code) == (f"in\n{tmp_path}/a\n".encode(), b"oops\n", 0)
+        _, _, code = await t.run("b", "exit 3", stdout=asyncio.subprocess.PIPE)
+        assert code == 3
+    run(main())
+    a, b = t.stats["a"], t.stats["b"]
+    assert (a.commands, a.failures, a.active, a.bytes_in) == (1, 0, 0, 3)
+    assert a.bytes_out == len(f"in\n{tmp_path}/a\n") + len("oops\n")
+    assert (b.commands, b.failures, b.active) == (1, 1, 0)
+
+def test_hosts_have_own_home(tmp_path):
+    t = LocalTransport(str(tmp_path))
+    async def main():
+        await t.run("a", "echo 1 > ~/f")
+        out, _, _ = await t.run("b", "cat ~/f 2>/dev/null || echo missing", stdout=asyncio.subprocess.PIPE)
+        assert out == b"missing\n"
+    run(main())
+    assert (tmp_path / "a" / "f").read_text() == "1\n"
+
+def test_stream(tmp_path):
+    t = LocalTransport(str(tmp_path))
+    async def main():
+        stream = t.stream("a", "echo one; echo two >&2; cat; exit 2", stdin_data=b"three\n")
+        lines = [item async for item in stream]
+        assert sorted(lines) == [("stderr", b"two\n"), ("stdout", b"one\n"), ("stdout", b"three\n")]
+        assert stream.returncode == 2
+    run(main())
+    a = t.stats["a"]
+    assert (a.commands, a.failures, a.active, a.bytes_in, a.bytes_out) == (1, 1, 0, 6, 14)
+
+def test_stream_stopped_early(tmp_path):
+    t = LocalTransport(str(tmp_path))
+    async def main():
+        stream = t.stream("a", "yes")
+        lines = stream.__aiter__()
+        assert await lines.__anext__() == ("stdout", b"y\n")
+        await lines.aclose()
+        return stream.returncode
+    assert run(main()) is None
+    a = t.stats["a"]
+    assert (a.commands, a.failures, a.active) == (1, 1, 0)
+
+def test_cancelled_command_is_recorded(tmp_path):
+    t = LocalTransport(str(tmp_path))
+    async def main():
+        task = asyncio.create_task(t.run("a", "sleep 30"))
+        while not t.stats["a"].active:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    run(main())
+    a = t.stats["a"]
+    assert (a.commands, a.failures, a.active) == (1, 1, 0)
+
+def test_max_channels(tmp_path):
+    class Limited(LocalTransport):
+        max_channels = 2
+    t = Limited(str(tmp_path))
+    async def main():
+        out = await asyncio.gather(*(t.run("a", f"touch running-{i}; sleep 0.2; ls | wc -l; rm running-{i}", stdout=asyncio.subprocess.PIPE)
+                                     for i in range(6)))
+        return max(int(o) for o, _, _ in out)
+    assert run(main()) == 2
+
+def test_default_transport(monkeypatch, capsys):
+    monkeypatch.setenv("BENCH_TRANSPORT", "ssh")
+    assert type(transport.default_transport("x")) is transport.SshTransport
+    assert "x: using the ssh transport" in capsys.readouterr().err
+    monkeypatch.setenv("BENCH_TRANSPORT", "telnet")
+    with pytest.raises(ValueError):
+        transport.default_transport("x")
+
+class FakeProcess:
+    def __init__(self):
+        self.stdin = self.stdout = self.stderr = None
+        self.exit = asyncio.get_running_loop().create_future()
+
+    async def wait(self, check):
+        return await self.exit
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.processes = []
+
+    async def create_process(self, command, encoding):
+        self.processes.append(FakeProcess())
+        return self.processes[-1]
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+def test_relogin_waits_for_running_commands():
+    t = transport.AsyncsshTransport("x")
+    async def main():
+        old, new = FakeConnection(), FakeConnection()
+        t._connections["a"] = asyncio.ensure_future(asyncio.sleep(0, old))
+        channel = await t.open("a", "sleep 10")
+        await t.relogin("a")
+        t._connections["a"] = asyncio.ensure_future(asyncio.sleep(0, new))
+        await t.open("a", "true")
+        assert new.processes and not old.closed
+        old.processes[0].exit.set_result(type("Completed", (), {"exit_status": 0}))
+        assert await channel.wait() == 0
+        assert old.closed and not new.closed
+        await t.close()
+        assert new.closed
+    run(main())
@@ -0,0 +1,105 @@
+import asyncio
+import re
+import time
+import pytest
+from bench.prometheus import PrometheusClient, PrometheusError
+from bench.triggers import Condition, TriggerScheduler
+
+def fast(text):
+    return Condition.parse(text, min_interval=0.05, max_interval=0.2)
+
+@pytest.fixture
+def metrics(fake_prometheus):
+    # {expression: [value of each series]}, as the fake Prometheus answers them.
+    values = {}
+    def answer(path, params):
+        result = []
+        for expr, index in re.findall(r'label_replace\(\((.*?)\), "__bench_batch", "(\d+)"', params["query"]):
+            for i, value in enumerate(values.get(expr, [])):
+                result.append({"metric": {"__bench_batch": index, "shard": str(i)}, "value": [time.time(), str(value)]})
+        return result
+    fake_prometheus.answer = answer
+    return values
+
+@pytest.fixture
+def scheduler(fake_prometheus):
+    client = PrometheusClient("127.0.0.1", fake_prometheus.port, ttl=0)
+    async def prometheus():
+        return client
+    yield TriggerScheduler(prometheus, verbose=False)
+    client.close()
+
+def queried(fake_prometheus):
+    return [re.findall(r'label_replace\(\((.*?)\), ', params["query"]) for _, params in fake_prometheus.queries]
+
+def test_parse():
+    c = Condition.parse('max(scylla_io_queue_queue_length{class="sl:default"}) > 80 for 3s')
+    assert (c.expr, c.op, c.threshold, c.for_seconds, c.polls) == ('max(scylla_io_queue_queue_length{class="sl:default"})', ">", 80, 3, 1)
+    c = Condition.parse("sum(compactions) == 0 for 3 polls")
+    assert (c.expr, c.op, c.threshold, c.polls) == ("sum(compactions)", "==", 0, 3)
+    assert Condition.parse("x >= 1e3").threshold == 1000
+    assert str(Condition.parse("x<=2 for 2s")) == "x <= 2 for 2s"
+    with pytest.raises(ValueError):
+        Condition.parse("x is big")
+
+def test_conditions_are_polled_in_one_query(scheduler, metrics, fake_prometheus):
+    metrics.update({"queue": [10, 20], "compactions": [2]})
+    async def main():
+        async def change():
+            await asyncio.sleep(0.3)
+            metrics["queue"] = [10, 90]
+            await asyncio.sleep(0.3)
+            metrics["compactions"] = [0]
+        changer = asyncio.create_task(change())
+        # Two conditions on one expression are queried once.
+        results = await asyncio.gather(scheduler.wait(fast("queue > 80")), scheduler.wait(fast("queue >= 90")),
+                                       scheduler.wait(fast("compactions == 0")))
+        await changer
+        return results
+    queue, queue90, compactions = asyncio.run(main())
+    assert (queue.value, queue90.value, compactions.value) == (90, 90, 0)
+    assert queue.time < compactions.time
+    assert scheduler.polls == len(fake_prometheus.queries)
+    polls = queried(fake_prometheus)
+    assert sorted(polls[-1]) == ["compactions"] and all(len(p) == len(set(p)) for p in polls)
+    assert any(sorted(p) == ["compactions", "queue"] for p in polls)
+    assert not scheduler.triggers and scheduler.loop.done()
+
+def test_hold_for_polls(scheduler, fake_prometheus):
+    # One value per poll: the 1 resets the streak, so the condition is met on the 6th poll.
+    values = iter([0, 0, 1, 0, 0, 0, 0])
+    fake_prometheus.answer = lambda path, params: [{"metric": {"__bench_batch": "0"}, "value": [time.time(), str(next(values))]}]
+    observation = asyncio.run(scheduler.wait(fast("compactions == 0 for 3 polls")))
+    assert observation.value == 0 and scheduler.polls == 6
+
+def test_no_series(scheduler, metrics):
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await scheduler.wait(fast("missing < 1"), timeout=0.3)
+    asyncio.run(main())
+    assert not scheduler.triggers
+
+def test_repeating_callback(scheduler, metrics):
+    metrics["queue"] = [100]
+    fired = []
+    async def main():
+        trigger = scheduler.add(fast("queue > 80"), fired.append, once=False)
+        await asyncio.sleep(0.2)
+        metrics["queue"] = [0]
+        await asyncio.sleep(0.3)
+        metrics["queue"] = [95]
+        await asyncio.sleep(0.3)
+        await scheduler.close()
+        return trigger
+    trigger = asyncio.run(main())
+    # Fired when it became met, not on every poll which saw it hold.
+    assert [o.value for o in fired] == [100, 95]
+    assert trigger.future.done()
+
+def test_error_resolves_the_waiters(scheduler, fake_prometheus):
+    fake_prometheus.answer = lambda path, params: (422, "execution", "query timed out")
+    async def main():
+        return await asyncio.gather(scheduler.wait(fast("a > 1")), scheduler.wait(fast("b > 1")), return_exceptions=True)
+    errors = asyncio.run(main())
+    assert all(isinstance(e, PrometheusError) for e in errors)
+    assert len(fake_prometheus.queries) == 1